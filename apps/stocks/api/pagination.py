@@ -0,0 +1,107 @@
+import base64
+import json
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q, QuerySet
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Постраничный вывод по ключу сортировки без OFFSET
+
+    Курсор содержит значения полей сортировки последней записи страницы, а следующая страница
+    выбирается условием «после этих значений». Поэтому запрос страницы идет по индексу с
+    нужной записи и не зависит от того, насколько далеко листает клиент. Поля сортировки
+    задаются атрибутом представления keyset_ordering: поле и уникальное поле (id) с одинаковым
+    направлением, либо одно уникальное поле.
+
+    Attributes:
+        ordering (tuple): Поля сортировки по умолчанию
+        page_size (int): Размер страницы по умолчанию
+        max_page_size (int): Максимальный размер страницы
+    """
+    ordering = ('id',)
+    page_size = 100
+    max_page_size = 1000
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+
+    def paginate_queryset(self, queryset: QuerySet, request, view=None) -> List:
+        self.request = request
+        self.ordering = getattr(view, 'keyset_ordering', self.ordering)
+        page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+        cursor = self.decode_cursor(request, queryset)
+        if cursor is not None:
+            queryset = queryset.filter(self.get_keyset_filter(cursor))
+
+        page = list(queryset[:page_size + 1])
+        self.next_cursor = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            self.next_cursor = [getattr(page[-1], field.lstrip('-')) for field in self.ordering]
+        return page
+
+    def get_keyset_filter(self, cursor: Sequence) -> Q:
+        """Возвращает условие для записей после курсора. Условие
+        «field >= value и не (field = value и id <= last_id)» позволяет начать чтение
+        составного индекса с позиции курсора
+
+        Args:
+            cursor (Sequence): Значения полей сортировки последней записи страницы
+
+        Returns:
+            Q
+        """
+        field, *key = [field.lstrip('-') for field in self.ordering]
+        value, *key_value = cursor
+        after, through, before = ('gt', 'gte', 'lte')
+        if self.ordering[0].startswith('-'):
+            after, through, before = ('lt', 'lte', 'gte')
+        if not key:
+            return Q(**{f'{field}__{after}': value})
+        return Q(**{f'{field}__{through}': value}) & ~Q(**{field: value,
+                                                          f'{key[0]}__{before}': key_value[0]})
+
+    def get_page_size(self, request) -> int:
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def decode_cursor(self, request, queryset: QuerySet) -> Optional[List]:
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            opts = queryset.model._meta
+            if len(values) != len(self.ordering):
+                raise ValueError
+            return [opts.get_field(field.lstrip('-')).to_python(value)
+                    for field, value in zip(self.ordering, values)]
+        except (ValueError, TypeError, ValidationError):
+            raise NotFound('Invalid cursor')
+
+    def encode_cursor(self, values: Sequence) -> str:
+        encoded = json.dumps(values, cls=DjangoJSONEncoder).encode()
+        return base64.urlsafe_b64encode(encoded).decode()
+
+    def get_next_link(self) -> Optional[str]:
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param,
+                                   self.encode_cursor(self.next_cursor))
+
+    def get_paginated_response(self, data) -> Response:
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
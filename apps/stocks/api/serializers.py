@@ -82,3 +82,19 @@ class PriceDeltaSerializer(PriceSerializer):
 
     def get_absolute_delta(self, obj):
         return obj.absolute_delta
+
+
+class DeltaPeriodSerializer(serializers.Serializer):
+    period = serializers.ListField(child=serializers.DateTimeField())
+    absolute_delta = serializers.DecimalField(max_digits=20, decimal_places=3)
+    delta_days = serializers.IntegerField()
+    prices = PriceSerializer(many=True)
+
+
+class ResampledPriceSerializer(serializers.Serializer):
+    date = serializers.DateTimeField()
+    open = serializers.DecimalField(max_digits=12, decimal_places=3)
+    high = serializers.DecimalField(max_digits=12, decimal_places=3)
+    low = serializers.DecimalField(max_digits=12, decimal_places=3)
+    close = serializers.DecimalField(max_digits=12, decimal_places=3)
+    volume = serializers.IntegerField()
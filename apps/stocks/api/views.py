@@ -1,27 +1,49 @@
-from django.http import Http404
+import re
+from typing import Set
+
+from django.http import Http404, StreamingHttpResponse
+from django.views import View
 from rest_framework.generics import ListAPIView
+from rest_framework.permissions import BasePermission
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
+from ..cache import CachedAPIResponseMixin, ConditionalResponseMixin, result_cache
+from ..export import Exporter
+from ..metrics import is_metrics_allowed
 from ..models import Stock, Price, Trade
+from ..series import price_series
+from ..views import get_delta_params
+from .pagination import KeysetPagination
 from .serializers import (StockSerializer, PriceSerializer, TradeSerializer,
-                          InsiderTradesSerializer, PriceAnalyticsSerializer, PriceDeltaSerializer)
+                          InsiderTradesSerializer, PriceAnalyticsSerializer, PriceDeltaSerializer,
+                          DeltaPeriodSerializer, ResampledPriceSerializer)
 
 __all__ = (
     'stocks_list_api_view', 'stock_prices_list_api_view', 'stock_insiders_list_api_view',
     'insider_trades_list_api_view', 'stock_prices_analytics_api_view',
-    'stock_prices_delta_api_view'
+    'stock_prices_delta_api_view', 'stock_prices_resample_api_view', 'stocks_analytics_api_view',
+    'result_cache_stats_api_view', 'export_api_view'
 )
 
 
-class StocksListAPIView(ListAPIView):
+def get_stock_names(request) -> Set[str]:
+    """Возвращает названия акций, указанные через запятую в GET параметре stocks"""
+    return {name.strip().lower() for name in request.GET.get('stocks', '').split(',')} - {''}
+
+
+class StocksListAPIView(ConditionalResponseMixin, ListAPIView):
     serializer_class = StockSerializer
     queryset = Stock.objects.all()
 
 stocks_list_api_view = StocksListAPIView.as_view()
 
 
-class StockPricesListAPIView(ListAPIView):
+class StockPricesListAPIView(ConditionalResponseMixin, ListAPIView):
     serializer_class = PriceSerializer
-    queryset = Price.objects.all()
+    queryset = Price.objects.select_related('stock')
+    pagination_class = KeysetPagination
+    keyset_ordering = ('date', 'id')
     lookup_field = 'stock__name'
     lookup_url_kwarg = 'name'
 
@@ -32,9 +54,12 @@ class StockPricesListAPIView(ListAPIView):
 stock_prices_list_api_view = StockPricesListAPIView.as_view()
 
 
-class StockInsidersListAPIView(ListAPIView):
+class StockInsidersListAPIView(ConditionalResponseMixin, ListAPIView):
     serializer_class = TradeSerializer
-    queryset = Trade.objects.all().reverse()
+    queryset = Trade.objects.default()
+    pagination_class = KeysetPagination
+    # сначала новые сделки
+    keyset_ordering = ('-last_date', '-id')
     lookup_field = 'insider_relation__stock__name'
     lookup_url_kwarg = 'name'
 
@@ -50,11 +75,16 @@ class InsiderTradesListAPIView(StockInsidersListAPIView):
     lookup_field = 'insider_relation__insider__slug'
     lookup_url_kwarg = 'slug'
 
+    def get_stocks(self):
+        return Stock.objects.filter(relations__insider__slug=self.kwargs['slug'])
+
 insider_trades_list_api_view = InsiderTradesListAPIView.as_view()
 
 
-class StockPricesAnalyticsAPIView(StockPricesListAPIView):
+class StockPricesAnalyticsAPIView(CachedAPIResponseMixin, StockPricesListAPIView):
     serializer_class = PriceAnalyticsSerializer
+    # условие курсора изменило бы окно изменений цен, а результат состоит из двух цен
+    pagination_class = None
 
     def get_queryset(self):
         qs = super().get_queryset()
@@ -63,13 +93,135 @@ class StockPricesAnalyticsAPIView(StockPricesListAPIView):
 stock_prices_analytics_api_view = StockPricesAnalyticsAPIView.as_view()
 
 
-class StockPricesDeltaAPIView(StockPricesListAPIView):
+class StocksAnalyticsAPIView(ConditionalResponseMixin, ListAPIView):
+    """Разница цен в датах сразу для нескольких акций. Изменения всех акций считаются одним
+    запросом с окном по каждой акции, а результат группируется по акции
+    """
+    serializer_class = PriceAnalyticsSerializer
+    queryset = Price.objects.all()
+    max_stocks = 1000
+
+    def get_stocks(self):
+        return Stock.objects.filter(name__in=get_stock_names(self.request))
+
+    def get_queryset(self):
+        get_params = self.request.GET
+        if not all(get_params.get(param) for param in ('stocks', 'date_from', 'date_to')):
+            raise Http404('Stocks and dates aren\'t specified')
+        names = get_stock_names(self.request)
+        if len(names) > self.max_stocks:
+            raise Http404(f'More than {self.max_stocks} stocks are specified')
+        qs = super().get_queryset().filter(stock__name__in=names).select_related('stock')
+        return qs.get_delta_between_dates(self.request).order_by('stock__name', 'date')
+
+    def list(self, request, *args, **kwargs):
+        serializer = self.get_serializer(self.get_queryset(), many=True)
+        stocks = {}
+        for price in serializer.data:
+            stocks.setdefault(price['stock'], []).append(price)
+        return Response(stocks)
+
+stocks_analytics_api_view = StocksAnalyticsAPIView.as_view()
+
+
+class StockPricesDeltaAPIView(CachedAPIResponseMixin, StockPricesListAPIView):
     serializer_class = PriceDeltaSerializer
+    pagination_class = None
 
     def get_queryset(self):
-        if 'value' not in self.request.GET or 'type' not in self.request.GET:
-            raise Http404('Value and type aren\'t specified')
+        (value,), (price_type,) = get_delta_params(self.request)
         qs = super().get_queryset().reverse()
-        return qs.get_prices_for_delta(self.request)
+        return qs.get_prices_for_delta(value, price_type, self.kwargs[self.lookup_url_kwarg])
+
+    def list(self, request, *args, **kwargs):
+        """Если указано несколько значений или типов цены через запятую, то возвращает периоды,
+        сгруппированные по значению и типу цены
+        """
+        values, price_types = get_delta_params(request)
+        if len(values) == 1 and len(price_types) == 1:
+            return super().list(request, *args, **kwargs)
+
+        qs = super().get_queryset()
+        name = self.kwargs[self.lookup_url_kwarg]
+        periods = qs.get_periods_for_deltas(values, price_types, name)
+        return Response({
+            value: {price_type: DeltaPeriodSerializer(period).data if period else None
+                    for price_type, period in types.items()}
+            for value, types in periods.items()
+        })
 
 stock_prices_delta_api_view = StockPricesDeltaAPIView.as_view()
+
+
+class StockPricesResampleAPIView(ConditionalResponseMixin, CachedAPIResponseMixin, ListAPIView):
+    """Цены акции, объединенные в недельные (bucket=week), месячные (bucket=month) или
+    N-дневные (bucket=5d) бары, и/или прореженные до max_points баров для графиков
+    """
+    serializer_class = ResampledPriceSerializer
+    bucket_re = re.compile(r'^(?:(week|month)|([1-9]\d*)d)$')
+
+    def list(self, request, *args, **kwargs):
+        bucket = request.GET.get('bucket')
+        max_points = request.GET.get('max_points')
+        if not bucket and not max_points:
+            raise Http404('Bucket or max_points aren\'t specified')
+        match = self.bucket_re.match(bucket) if bucket else None
+        if bucket and match is None:
+            raise Http404('Unknown bucket')
+        if max_points and (not max_points.isdigit() or int(max_points) < 1):
+            raise Http404('Max_points isn\'t a positive number')
+        series = price_series.get(self.kwargs['name'])
+        if series is None:
+            raise Http404('Stock doesn\'t exist')
+
+        if match is not None:
+            period, days = match.groups()
+            series = series.resample(period or 'day', int(days or 1))
+        if max_points:
+            series = series.downsample(int(max_points))
+        return Response(self.get_serializer(series.get_rows(), many=True).data)
+
+stock_prices_resample_api_view = StockPricesResampleAPIView.as_view()
+
+
+class MetricsPermission(BasePermission):
+    """Доступ к внутренним счетчикам процесса на тех же условиях, что и к /metrics"""
+
+    def has_permission(self, request, view):
+        return is_metrics_allowed(request)
+
+
+class ResultCacheStatsAPIView(APIView):
+    """Счетчики попаданий и промахов кэша результатов в текущем процессе"""
+    permission_classes = (MetricsPermission,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(result_cache.get_stats())
+
+result_cache_stats_api_view = ResultCacheStatsAPIView.as_view()
+
+
+class ExportAPIView(ConditionalResponseMixin, View):
+    """Потоковая выгрузка цен (kind=prices) или сделок (kind=trades) акций, указанных через
+    запятую в параметре stocks, или всех акций в формате csv, ndjson или columns
+    """
+
+    def get_stocks(self):
+        names = get_stock_names(self.request)
+        return Stock.objects.filter(name__in=names) if names else Stock.objects.all()
+
+    def get(self, request, *args, **kwargs):
+        kind = kwargs['kind']
+        export_format = request.GET.get('format', 'csv')
+        if kind not in Exporter.columns:
+            raise Http404('Unknown export')
+        if export_format not in Exporter.content_types:
+            raise Http404('Unknown format')
+        exporter = Exporter(kind, get_stock_names(request) or None)
+        response = StreamingHttpResponse(exporter.stream(export_format),
+                                         content_type=Exporter.content_types[export_format])
+        extension = 'csv' if export_format == 'csv' else 'ndjson'
+        response['Content-Disposition'] = f'attachment; filename="{kind}.{extension}"'
+        return response
+
+export_api_view = ExportAPIView.as_view()
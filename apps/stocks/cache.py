@@ -0,0 +1,207 @@
+import hashlib
+import threading
+from calendar import timegm
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, Max
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag, urlencode
+from rest_framework.response import Response
+
+from .models import Stock
+
+
+class ResultCache:
+    """Двухуровневый кэш результатов запросов: LRU в памяти процесса и кэш Django
+
+    Ключ содержит версию цен акции, которую парсер увеличивает при записи цен, поэтому
+    результаты не нужно удалять: после записи новых цен запросы формируют новые ключи, а
+    старые записи вытесняются.
+
+    Attributes:
+        alias (str): Кэш Django
+        timeout (int): Время хранения в кэше Django, секунды
+        max_size (int): Максимальное количество записей в памяти процесса
+    """
+
+    def __init__(self, alias: str = 'default', timeout: int = None, max_size: int = 256):
+        self.alias = alias
+        self.timeout = timeout
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+
+    @staticmethod
+    def get_key(endpoint: str, stock_id: int, version: int, params: Dict) -> str:
+        """Возвращает ключ результата
+
+        Args:
+            endpoint (str): Название url
+            stock_id (int): Id акции
+            version (int): Версия цен акции
+            params (Dict): GET параметры запроса
+
+        Returns:
+            str
+        """
+        query = urlencode(sorted(params.lists()), doseq=True)
+        query_hash = hashlib.sha1(query.encode()).hexdigest()
+        return f'stocks:{endpoint}:{stock_id}:{version}:{query_hash}'
+
+    def count(self, stat: str):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def get(self, key: str) -> Optional[Any]:
+        """Возвращает результат из памяти процесса, а если его там нет, то из кэша Django
+
+        Args:
+            key (str): Ключ
+
+        Returns:
+            Результат или None
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats['local_hits'] += 1
+                return self.entries[key]
+        value = caches[self.alias].get(key)
+        if value is None:
+            self.count('misses')
+            return None
+        self.count('shared_hits')
+        self.set_local(key, value)
+        return value
+
+    def set(self, key: str, value: Any):
+        caches[self.alias].set(key, value, self.timeout)
+        self.set_local(key, value)
+
+    def set_local(self, key: str, value: Any):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            return dict(self.stats, size=len(self.entries))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            for stat in self.stats:
+                self.stats[stat] = 0
+
+
+result_cache = ResultCache(
+    alias=getattr(settings, 'RESULT_CACHE_ALIAS', 'default'),
+    timeout=getattr(settings, 'RESULT_CACHE_TIMEOUT', None),
+    max_size=getattr(settings, 'RESULT_CACHE_SIZE', 256),
+)
+
+
+class CachedResponseMixin:
+    """Примесь для представлений акции, которая кэширует отрисованный ответ по акции, url,
+    GET параметрам и версии цен акции. В заголовке X-Cache указывается, был ли ответ в кэше
+    """
+
+    def get_cache_key(self) -> Optional[str]:
+        stock = Stock.objects.filter(name=self.kwargs['name']).values_list(
+            'id', 'prices_version'
+        ).first()
+        if stock is None:
+            return None
+        return result_cache.get_key(self.request.resolver_match.url_name, *stock,
+                                    self.request.GET)
+
+    def get(self, request, *args, **kwargs):
+        key = self.get_cache_key()
+        if key is not None:
+            value = result_cache.get(key)
+            if value is not None:
+                response = self.get_cached_response(value)
+                response['X-Cache'] = 'HIT'
+                return response
+        response = super().get(request, *args, **kwargs)
+        if key is not None and response.status_code == 200:
+            result_cache.set(key, self.get_cache_value(response))
+            response['X-Cache'] = 'MISS'
+        return response
+
+    def get_cache_value(self, response):
+        response.render()
+        return response.content, response['Content-Type']
+
+    def get_cached_response(self, value):
+        content, content_type = value
+        return HttpResponse(content, content_type=content_type)
+
+
+class CachedAPIResponseMixin(CachedResponseMixin):
+    """Примесь для API представлений акции. Кэшируются данные ответа, а не отрисованный ответ,
+    поэтому формат ответа по-прежнему выбирается по запросу
+    """
+
+    def get_cache_value(self, response):
+        return response.data
+
+    def get_cached_response(self, value):
+        return Response(value)
+
+
+class ConditionalResponseMixin:
+    """Примесь, которая добавляет к ответу ETag, Last-Modified и Cache-Control и отвечает 304
+    на If-None-Match и If-Modified-Since до выполнения представления
+
+    Версия ответа строится по количеству акций, от данных которых зависит ответ, и времени
+    последнего изменения их данных, которое обновляет парсер. По умолчанию это акция из url
+    или все акции
+    """
+
+    def get_stocks(self):
+        if 'name' in self.kwargs:
+            return Stock.objects.filter(name=self.kwargs['name'])
+        return Stock.objects.all()
+
+    def get_data_version(self) -> Optional[Tuple[str, int]]:
+        """Возвращает ETag и время последнего изменения данных
+
+        Returns:
+            Tuple[str, int] or None: ETag и timestamp или None, если акций нет
+        """
+        data = self.get_stocks().aggregate(count=Count('id', distinct=True),
+                                           modified=Max('modified'))
+        if not data['count']:
+            return None
+        modified = data['modified']
+        etag = 'W/' + quote_etag(f'{data["count"]}-{modified.timestamp():.6f}')
+        return etag, timegm(modified.utctimetuple())
+
+    def dispatch(self, request, *args, **kwargs):
+        version = None
+        if request.method in ('GET', 'HEAD'):
+            version = self.get_data_version()
+        if version is None:
+            return super().dispatch(request, *args, **kwargs)
+
+        etag, last_modified = version
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = super().dispatch(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, public=True,
+                            max_age=getattr(settings, 'HTTP_CACHE_MAX_AGE', 0))
+        # ETag одинаков для всех форматов ответа API, поэтому кэши различают их по Accept
+        patch_vary_headers(response, ['Accept'])
+        return response
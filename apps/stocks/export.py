@@ -0,0 +1,128 @@
+import csv
+import io
+import json
+from datetime import date
+from decimal import Decimal
+from itertools import islice
+from typing import Iterator, List, Sequence, Tuple
+
+from .models import Price, Trade
+
+
+def to_json(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+class Exporter:
+    """Потоковая выгрузка цен или сделок акций в CSV, NDJSON или колоночном формате
+
+    Строки читаются курсором на стороне сервера пачками по chunk_size кортежами значений, без
+    создания объектов моделей и сериализаторов, а каждая пачка сразу отдается в виде текста,
+    поэтому расход памяти не зависит от объема выгрузки.
+
+    Колоночный формат (columns) содержит по одному JSON объекту на пачку: название колонки и
+    массив ее значений.
+
+    Attributes:
+        kind (str): prices или trades
+        names (Sequence[str]): Названия акций, по умолчанию все акции
+        chunk_size (int): Количество строк, читаемых из БД за раз
+    """
+    # название колонки и поле модели
+    columns = {
+        'prices': (
+            ('stock', 'stock__name'), ('date', 'date'), ('open', 'open'), ('high', 'high'),
+            ('low', 'low'), ('close', 'close'), ('volume', 'volume'),
+        ),
+        'trades': (
+            ('stock', 'insider_relation__stock__name'),
+            ('insider', 'insider_relation__insider__full_name'),
+            ('position', 'insider_relation__position'), ('last_date', 'last_date'),
+            ('transaction_type', 'transaction_type'), ('owner_type', 'owner_type'),
+            ('shares_traded', 'shares_traded'), ('last_price', 'last_price'),
+            ('shares_held', 'shares_held'),
+        ),
+    }
+    content_types = {
+        'csv': 'text/csv',
+        'ndjson': 'application/x-ndjson',
+        'columns': 'application/x-ndjson',
+    }
+
+    def __init__(self, kind: str, names: Sequence[str] = None, chunk_size: int = 2000):
+        if kind not in self.columns:
+            raise ValueError(f'Unknown export: {kind}')
+        self.kind = kind
+        self.names = [name.lower() for name in names] if names else None
+        self.chunk_size = chunk_size
+
+    def get_header(self) -> List[str]:
+        return [column for column, _ in self.columns[self.kind]]
+
+    def get_queryset(self):
+        if self.kind == 'prices':
+            # порядок совпадает с индексом (stock, date, id)
+            qs = Price.objects.order_by('stock_id', 'date')
+            if self.names is not None:
+                qs = qs.filter(stock__name__in=self.names)
+        else:
+            qs = Trade.objects.order_by('last_date', 'id')
+            if self.names is not None:
+                qs = qs.filter(insider_relation__stock__name__in=self.names)
+        return qs.values_list(*[field for _, field in self.columns[self.kind]])
+
+    def get_chunks(self) -> Iterator[List[Tuple]]:
+        """Возвращает строки выгрузки пачками
+
+        Returns:
+            Iterator[List[Tuple]]
+        """
+        rows = self.get_queryset().iterator(chunk_size=self.chunk_size)
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def csv(self) -> Iterator[str]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(self.get_header())
+        for chunk in self.get_chunks():
+            writer.writerows(chunk)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    def ndjson(self) -> Iterator[str]:
+        header = self.get_header()
+        for chunk in self.get_chunks():
+            yield ''.join(json.dumps(dict(zip(header, row)), default=to_json) + '\n'
+                          for row in chunk)
+
+    def columnar(self) -> Iterator[str]:
+        header = self.get_header()
+        for chunk in self.get_chunks():
+            yield json.dumps(dict(zip(header, map(list, zip(*chunk)))), default=to_json) + '\n'
+
+    def stream(self, export_format: str) -> Iterator[str]:
+        """Возвращает выгрузку частями
+
+        Args:
+            export_format (str): csv, ndjson или columns
+
+        Returns:
+            Iterator[str]
+        """
+        if export_format == 'csv':
+            return self.csv()
+        if export_format == 'ndjson':
+            return self.ndjson()
+        if export_format == 'columns':
+            return self.columnar()
+        raise ValueError(f'Unknown format: {export_format}')
@@ -0,0 +1,285 @@
+import csv
+import io
+import json
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO
+
+from django.db import connection, transaction
+from django.template.defaultfilters import slugify
+from django.utils import timezone
+
+from .models import Stock, Price, Insider, Relation, Trade
+from .querysets import PriceQuerySet
+
+
+class RowsReader(io.TextIOBase):
+    """Файл только для чтения, который отдает строки в формате CSV по мере чтения, чтобы
+    передать в COPY строки из NDJSON без промежуточного файла
+
+    Attributes:
+        rows (Iterator[List]): Строки
+    """
+
+    def __init__(self, rows: Iterable[List]):
+        self.rows = iter(rows)
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.data = ''
+
+    def readable(self):
+        return True
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.data) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.writer.writerow(row)
+            self.data += self.buffer.getvalue()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        if size < 0:
+            size = len(self.data)
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+
+class HistoryLoader:
+    """Загрузка истории цен или сделок из файлов выгрузки (apps.stocks.export)
+
+    Файлы копируются в COPY FROM STDIN во временную таблицу, а затем объединяются с таблицами
+    акций, владельцев, связей, цен и сделок несколькими запросами INSERT ... SELECT ... ON
+    CONFLICT, поэтому объекты моделей не создаются. Вся загрузка выполняется в одной
+    транзакции. Изменения сохраненных цен пересчитываются начиная с первой загруженной цены
+    каждой акции.
+
+    Attributes:
+        kind (str): prices или trades
+        defer_indexes (bool): Удалить вторичные индексы на время загрузки и построить заново.
+            Выгодно, если загружается много строк относительно размера таблицы
+        stats (Dict[str, float]): Количество строк и время этапов загрузки
+    """
+    # колонки временной таблицы в порядке колонок выгрузки
+    staging_columns = {
+        'prices': {
+            'stock': 'text', 'date': 'timestamptz', 'open': 'numeric', 'high': 'numeric',
+            'low': 'numeric', 'close': 'numeric', 'volume': 'bigint',
+        },
+        'trades': {
+            'stock': 'text', 'insider': 'text', 'position': 'smallint', 'last_date': 'date',
+            'transaction_type': 'text', 'owner_type': 'smallint', 'shares_traded': 'integer',
+            'last_price': 'numeric', 'shares_held': 'integer',
+        },
+    }
+
+    def __init__(self, kind: str, defer_indexes: bool = False):
+        if kind not in self.staging_columns:
+            raise ValueError(f'Unknown history: {kind}')
+        self.kind = kind
+        self.defer_indexes = defer_indexes
+        self.table = f'load_{kind}'
+        self.stats = {}
+
+    def load(self, files: Iterable[TextIO], file_format: str) -> Dict[str, float]:
+        """Загружает файлы выгрузки
+
+        Args:
+            files (Iterable[TextIO]): Открытые файлы
+            file_format (str): csv, ndjson или columns
+
+        Returns:
+            Dict[str, float]: Количество строк и время этапов загрузки
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            columns = ', '.join(f'{column} {column_type}' for column, column_type
+                                in self.staging_columns[self.kind].items())
+            cursor.execute(f'CREATE TEMP TABLE {self.table} ({columns}) ON COMMIT DROP')
+            started = time.monotonic()
+            for file in files:
+                self.stage(cursor, file, file_format)
+            cursor.execute(f'SELECT count(*) FROM {self.table}')
+            self.stats['staged'] = cursor.fetchone()[0]
+            cursor.execute(f'ANALYZE {self.table}')
+            self.stats['stage_time'] = time.monotonic() - started
+
+            model = Price if self.kind == 'prices' else Trade
+            # индексы уникальных ограничений нужны для ON CONFLICT и остаются
+            indexes = model._meta.indexes if self.defer_indexes else []
+            started = time.monotonic()
+            if indexes:
+                with connection.schema_editor(atomic=False) as schema_editor:
+                    for index in indexes:
+                        schema_editor.remove_index(model, index)
+            if self.kind == 'prices':
+                self.stats['merged'] = self.merge_prices(cursor)
+            else:
+                self.stats['merged'] = self.merge_trades(cursor)
+            self.stats['merge_time'] = time.monotonic() - started
+
+            started = time.monotonic()
+            if indexes:
+                # индекс нельзя построить, пока не проверены отложенные внешние ключи
+                cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+                with connection.schema_editor(atomic=False) as schema_editor:
+                    for index in indexes:
+                        schema_editor.add_index(model, index)
+                cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+            self.stats['index_time'] = time.monotonic() - started
+            # во внешней транзакции временные таблицы удаляются только при ее завершении
+            cursor.execute(f'DROP TABLE IF EXISTS {self.table}, {self.table}_insiders, '
+                           f'{self.table}_relations')
+        return self.stats
+
+    def stage(self, cursor, file: TextIO, file_format: str):
+        """Копирует файл во временную таблицу. CSV копируется как есть по колонкам из
+        заголовка, а строки NDJSON передаются в COPY в виде CSV
+
+        Args:
+            cursor: Курсор БД
+            file (TextIO): Файл
+            file_format (str): csv, ndjson или columns
+        """
+        expected = list(self.staging_columns[self.kind])
+        if file_format == 'csv':
+            header = next(csv.reader([file.readline()]), [])
+            if sorted(header) != sorted(expected):
+                raise ValueError(f'Unexpected columns: {", ".join(header)}')
+            columns = header
+        else:
+            columns = expected
+            file = RowsReader(self.read_json_rows(file, file_format, expected))
+        cursor.copy_expert(f'COPY {self.table} ({", ".join(columns)}) FROM STDIN '
+                           f'WITH (FORMAT csv)', file)
+
+    @staticmethod
+    def read_json_rows(file: TextIO, file_format: str, columns: List[str]) -> Iterator[List]:
+        for line in file:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            if file_format == 'ndjson':
+                yield [data[column] for column in columns]
+            else:
+                yield from zip(*[data[column] for column in columns])
+
+    def merge_stocks(self, cursor):
+        cursor.execute(f'''
+            INSERT INTO {Stock._meta.db_table} (name, company_name, prices_version, modified)
+            SELECT DISTINCT lower(stock), '', 0, %s FROM {self.table}
+            ON CONFLICT (name) DO NOTHING
+        ''', [timezone.now()])
+
+    def touch_stocks(self, cursor, stock_ids: List[int], prices: bool = False):
+        """Обновляет время изменения данных акций и версию цен, если изменились цены"""
+        version = ', prices_version = prices_version + 1' if prices else ''
+        cursor.execute(f'UPDATE {Stock._meta.db_table} SET modified = %s{version} '
+                       f'WHERE id = ANY(%s)', [timezone.now(), stock_ids])
+
+    def merge_prices(self, cursor) -> int:
+        """Объединяет загруженные цены с ценами в БД и пересчитывает изменения цен
+
+        Returns:
+            int: Количество вставленных или обновленных цен
+        """
+        self.merge_stocks(cursor)
+        types = PriceQuerySet.price_types
+        deltas = [f'{prefix}delta_{t}' for prefix in ('bar_', 'cum_') for t in types]
+        price_table = Price._meta.db_table
+        # одна строка на цену, иначе ON CONFLICT не может обновить цену дважды
+        cursor.execute(f'''
+            WITH changed AS (
+                INSERT INTO {price_table} (stock_id, date, {', '.join(types)},
+                                           {', '.join(deltas)})
+                SELECT DISTINCT ON (s.id, l.date) s.id, l.date, {', '.join(
+                    f'l.{t}' for t in types)}, {', '.join(['0'] * len(deltas))}
+                FROM {self.table} l JOIN {Stock._meta.db_table} s ON s.name = lower(l.stock)
+                ORDER BY s.id, l.date
+                ON CONFLICT (stock_id, date) DO UPDATE SET {', '.join(
+                    f'{t} = EXCLUDED.{t}' for t in types)}
+                WHERE ({', '.join(f'{price_table}.{t}' for t in types)})
+                    IS DISTINCT FROM ({', '.join(f'EXCLUDED.{t}' for t in types)})
+                RETURNING stock_id, date
+            )
+            SELECT stock_id, min(date), count(*) FROM changed GROUP BY stock_id
+        ''')
+        changed = cursor.fetchall()
+        for stock_id, date_from, _ in changed:
+            Price.objects.update_deltas(stock_id, date_from)
+        if changed:
+            self.touch_stocks(cursor, [stock_id for stock_id, _, _ in changed], prices=True)
+        return sum(count for _, _, count in changed)
+
+    def merge_trades(self, cursor) -> int:
+        """Объединяет загруженные сделки со сделками в БД, создавая акции, владельцев и связи
+
+        Returns:
+            int: Количество вставленных или обновленных сделок
+        """
+        self.merge_stocks(cursor)
+        # slug владельца считается так же, как при сохранении модели, поэтому имена
+        # владельцев копируются в отдельную временную таблицу
+        cursor.execute(f'SELECT DISTINCT insider FROM {self.table}')
+        insiders = [(full_name, slugify(full_name)) for full_name, in cursor.fetchall()]
+        cursor.execute(f'CREATE TEMP TABLE {self.table}_insiders (full_name text, slug text) '
+                       f'ON COMMIT DROP')
+        cursor.copy_expert(f'COPY {self.table}_insiders FROM STDIN WITH (FORMAT csv)',
+                           RowsReader(insiders))
+        cursor.execute(f'''
+            INSERT INTO {Insider._meta.db_table} (full_name, slug)
+            SELECT DISTINCT ON (slug) full_name, slug FROM {self.table}_insiders
+            ORDER BY slug, full_name
+            ON CONFLICT (slug) DO NOTHING
+        ''')
+        cursor.execute(f'''
+            CREATE TEMP TABLE {self.table}_relations ON COMMIT DROP AS
+            SELECT DISTINCT s.id AS stock_id, i.id AS insider_id, l.position
+            FROM {self.table} l
+            JOIN {Stock._meta.db_table} s ON s.name = lower(l.stock)
+            JOIN {self.table}_insiders li ON li.full_name = l.insider
+            JOIN {Insider._meta.db_table} i ON i.slug = li.slug
+        ''')
+        relation_table = Relation._meta.db_table
+        cursor.execute(f'''
+            INSERT INTO {relation_table} (stock_id, insider_id, position)
+            SELECT stock_id, insider_id, position FROM {self.table}_relations
+            ON CONFLICT (stock_id, insider_id, position) DO NOTHING
+        ''')
+
+        trade_table = Trade._meta.db_table
+        key = ('insider_relation_id', 'last_date', 'transaction_type', 'owner_type',
+               'shares_traded', 'shares_held')
+        cursor.execute(f'''
+            WITH changed AS (
+                INSERT INTO {trade_table} ({', '.join(key)}, last_price)
+                SELECT DISTINCT ON (r.id, {', '.join(f'l.{column}' for column in key[1:])})
+                    r.id, {', '.join(f'l.{column}' for column in key[1:])}, l.last_price
+                FROM {self.table} l
+                JOIN {Stock._meta.db_table} s ON s.name = lower(l.stock)
+                JOIN {self.table}_insiders li ON li.full_name = l.insider
+                JOIN {Insider._meta.db_table} i ON i.slug = li.slug
+                JOIN {relation_table} r ON r.stock_id = s.id AND r.insider_id = i.id
+                    AND r.position = l.position
+                ON CONFLICT ({', '.join(key)}) DO UPDATE SET last_price = EXCLUDED.last_price
+                WHERE {trade_table}.last_price IS DISTINCT FROM EXCLUDED.last_price
+                RETURNING insider_relation_id
+            )
+            SELECT r.stock_id, count(*) FROM changed c
+            JOIN {relation_table} r ON r.id = c.insider_relation_id
+            GROUP BY r.stock_id
+        ''')
+        changed = cursor.fetchall()
+        if changed:
+            self.touch_stocks(cursor, [stock_id for stock_id, _ in changed])
+        return sum(count for _, count in changed)
+
+    def get_rates(self) -> Dict[str, Optional[float]]:
+        """Возвращает скорость копирования и объединения в строках в секунду
+
+        Returns:
+            Dict[str, Optional[float]]
+        """
+        stats = self.stats
+        return {
+            'stage': stats['staged'] / stats['stage_time'] if stats.get('stage_time') else None,
+            'merge': stats['staged'] / stats['merge_time'] if stats.get('merge_time') else None,
+        }
@@ -0,0 +1,68 @@
+import random
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import List, Tuple
+
+import numpy as np
+from django.core.management import BaseCommand
+
+from ...series import PriceSeries
+from ...utils import get_min_period
+
+
+def get_synthetic_rows(size: int, seed: int = 0) -> List[Tuple]:
+    """Создает синтетический ряд изменений цены: случайное блуждание по дневным барам
+
+    Args:
+        size (int): Количество строк
+        seed (int): Зерно генератора случайных чисел
+
+    Returns:
+        List[Tuple]: Id, дата и изменение цены
+    """
+    rng = random.Random(seed)
+    start = datetime(1970, 1, 1)
+    return [(n, start + timedelta(days=n), Decimal(rng.randint(-500, 500)) / 100)
+            for n in range(size)]
+
+
+def get_synthetic_series(rows: List[Tuple]) -> PriceSeries:
+    """Создает колонки цен для синтетического ряда изменений цены
+
+    Args:
+        rows (List[Tuple]): Id, дата и изменение цены
+
+    Returns:
+        PriceSeries
+    """
+    deltas = np.array([int(delta.scaleb(3)) for _, _, delta in rows], dtype=np.int64)
+    dates = np.arange(len(rows), dtype=np.int64) * 24 * 60 * 60 * 10 ** 6
+    return PriceSeries(np.arange(len(rows), dtype=np.int64), dates,
+                       {'open': 100000 + np.cumsum(deltas)})
+
+
+class Command(BaseCommand):
+    help = 'Benchmark minimal period search on synthetic price series'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000])
+        parser.add_argument('--value', type=Decimal, default=Decimal('100'),
+                            help='Значение, на которое изменилась цена')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        for size in options['sizes']:
+            rows = get_synthetic_rows(size, options['seed'])
+            series = get_synthetic_series(rows)
+            series.get_sums('open')
+            for name, func in (('python', lambda: get_min_period(rows, options['value'])),
+                               ('numpy', lambda: series.get_min_period('open',
+                                                                      options['value']))):
+                start = time.perf_counter()
+                result = func()
+                elapsed = time.perf_counter() - start
+                self.stdout.write(
+                    f'{name}, {size} строк: {elapsed:.4f} с, {size / elapsed:,.0f} строк/с, '
+                    f'период {result["delta_days"] if result else None} дн.'
+                )
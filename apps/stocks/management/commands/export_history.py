@@ -0,0 +1,30 @@
+from django.core.management import BaseCommand
+
+from ...export import Exporter
+
+
+class Command(BaseCommand):
+    help = 'Export price or trade history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(Exporter.columns),
+                            help='Цены или сделки')
+        parser.add_argument('stocks', nargs='*',
+                            help='Названия акций, по умолчанию все акции')
+        parser.add_argument('--format', dest='export_format', default='csv',
+                            choices=sorted(Exporter.content_types),
+                            help='Формат выгрузки')
+        parser.add_argument('--output', default='-',
+                            help='Файл выгрузки, по умолчанию stdout')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Количество строк, читаемых из БД за раз')
+
+    def handle(self, *args, **options):
+        exporter = Exporter(options['kind'], options['stocks'], options['chunk_size'])
+        parts = exporter.stream(options['export_format'])
+        if options['output'] == '-':
+            for part in parts:
+                self.stdout.write(part, ending='')
+            return
+        with open(options['output'], 'w', newline='') as file:
+            file.writelines(parts)
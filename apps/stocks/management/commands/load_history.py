@@ -0,0 +1,36 @@
+from django.core.management import BaseCommand, CommandError
+
+from ...loader import HistoryLoader
+
+
+class Command(BaseCommand):
+    help = 'Load price or trade history from export files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(HistoryLoader.staging_columns),
+                            help='Цены или сделки')
+        parser.add_argument('files', nargs='+',
+                            help='Файлы выгрузки (export_history)')
+        parser.add_argument('--format', dest='file_format', default='csv',
+                            choices=['columns', 'csv', 'ndjson'],
+                            help='Формат файлов')
+        parser.add_argument('--defer-indexes', action='store_true',
+                            help='Построить вторичные индексы заново после загрузки')
+
+    def handle(self, *args, **options):
+        loader = HistoryLoader(options['kind'], options['defer_indexes'])
+        files = [open(path, newline='') for path in options['files']]
+        try:
+            stats = loader.load(files, options['file_format'])
+        except ValueError as error:
+            raise CommandError(error)
+        finally:
+            for file in files:
+                file.close()
+        rates = loader.get_rates()
+        self.stdout.write(f'Staged rows: {stats["staged"]} ({stats["stage_time"]:.2f} s, '
+                          f'{rates["stage"] or 0:.0f} rows/s)')
+        self.stdout.write(f'Merged rows: {stats["merged"]} ({stats["merge_time"]:.2f} s, '
+                          f'{rates["merge"] or 0:.0f} rows/s)')
+        if options['defer_indexes']:
+            self.stdout.write(f'Rebuilt indexes: {stats["index_time"]:.2f} s')
@@ -0,0 +1,27 @@
+from django.core.management import BaseCommand, CommandError
+
+from ...partitioning import SCHEMES, add_year_partitions, get_partitions, rebuild_price_table
+
+
+class Command(BaseCommand):
+    help = 'Change partitioning of the price table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scheme', nargs='?', choices=SCHEMES + ('none',),
+                            help='Секции по годам, по хэшу акции или обычная таблица')
+        parser.add_argument('--partitions', type=int, default=16,
+                            help='Количество секций по хэшу акции')
+        parser.add_argument('--until-year', type=int,
+                            help='Добавить секции по годам до указанного года включительно')
+
+    def handle(self, *args, **options):
+        scheme = options['scheme']
+        if scheme:
+            rebuild_price_table(None if scheme == 'none' else scheme, options['partitions'])
+        if options['until_year']:
+            try:
+                added = add_year_partitions(options['until_year'])
+            except ValueError as error:
+                raise CommandError(error)
+            self.stdout.write(f'Added partitions: {", ".join(map(str, added)) or "-"}')
+        self.stdout.write(f'Partitions: {len(get_partitions())}')
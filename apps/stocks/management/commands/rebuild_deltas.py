@@ -0,0 +1,20 @@
+from django.core.management import BaseCommand
+
+from ...models import Stock, Price
+
+
+class Command(BaseCommand):
+    help = 'Rebuild stored price deltas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('stocks', nargs='*',
+                            help='Названия акций, по умолчанию все акции')
+
+    def handle(self, *args, **options):
+        stocks = Stock.objects.order_by('name')
+        if options['stocks']:
+            stocks = stocks.filter(name__in=[stock.lower() for stock in options['stocks']])
+        total = 0
+        for stock in stocks.iterator():
+            total += Price.objects.update_deltas(stock.id)
+        self.stdout.write(f'Updated prices: {total}')
@@ -1,8 +1,44 @@
+import threading
+import time
+from contextlib import ExitStack
 from multiprocessing.pool import ThreadPool
+from typing import Callable, Iterable
 
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
 
-from ...parser import get_stocks_list, NasdaqParser
+from ... import metrics
+from ...profiling import profiler
+from ...parser import StocksFile, NasdaqParser
+from ...parser.cache import PageCache
+from ...parser.extractors import LxmlExtractor, SoupExtractor
+from ...parser.throttling import CircuitBreaker, FailedJournal, RateLimiter, Throttle
+
+EXTRACTORS = {
+    'lxml': LxmlExtractor,
+    'soup': SoupExtractor,
+}
+
+
+def imap_bounded(pool: ThreadPool, func: Callable, items: Iterable, size: int):
+    """Выполняет func для каждого элемента items в пуле потоков. Элементы передаются в пул
+    по мере выполнения заданий, не больше size одновременно, поэтому список заданий не
+    создается в памяти целиком
+
+    Args:
+        pool (ThreadPool): Пул потоков
+        func (Callable): Функция
+        items (Iterable): Элементы
+        size (int): Максимальное количество заданий в пуле
+    """
+    slots = threading.BoundedSemaphore(size)
+
+    def feed():
+        for item in items:
+            slots.acquire()
+            yield item
+
+    for _ in pool.imap_unordered(func, feed()):
+        slots.release()
 
 
 class Command(BaseCommand):
@@ -11,13 +47,157 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('threads', nargs='+', type=int)
+        parser.add_argument('--engine', choices=('threads', 'async', 'pipeline', 'queue'),
+                            default='threads')
+        parser.add_argument('--concurrency', type=int, default=100,
+                            help='Максимальное количество одновременных соединений (async)')
+        parser.add_argument('--limit-per-host', type=int, default=0,
+                            help='Максимальное количество соединений с одним хостом (async)')
+        parser.add_argument('--parsers', type=int,
+                            help='Количество процессов разбора страниц (pipeline), по умолчанию '
+                                 'по числу ядер')
+        parser.add_argument('--writers', type=int, default=2,
+                            help='Количество потоков записи в БД (pipeline)')
+        parser.add_argument('--queue-size', type=int, default=100,
+                            help='Максимальное количество страниц в конвейере (pipeline)')
+        parser.add_argument('--extractor', choices=tuple(EXTRACTORS), default='lxml')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Записывать только новые данные и не загружать страницы сделок '
+                                 'старше сохраненных')
+        parser.add_argument('--cache-dir',
+                            help='Директория дискового кэша страниц')
+        parser.add_argument('--cache-size', type=int, default=1024,
+                            help='Максимальный размер кэша страниц, МБ')
+        parser.add_argument('--replay', action='store_true',
+                            help='Разобрать только страницы из кэша, не обращаясь к Nasdaq.com')
+        parser.add_argument('--rate', type=float,
+                            help='Начальная скорость запросов в секунду, подстраивается под ответы '
+                                 'сервера (по умолчанию без ограничения)')
+        parser.add_argument('--max-rate', type=float, default=50,
+                            help='Максимальная скорость запросов в секунду')
+        parser.add_argument('--retries', type=int, default=3,
+                            help='Количество повторных попыток запроса')
+        parser.add_argument('--timeout', type=float, default=30,
+                            help='Таймаут запроса, секунды')
+        parser.add_argument('--breaker-threshold', type=int, default=5,
+                            help='Количество ошибок подряд, после которого запросы к хосту '
+                                 'приостанавливаются')
+        parser.add_argument('--breaker-pause', type=float, default=30,
+                            help='Длительность паузы запросов к хосту, секунды')
+        parser.add_argument('--journal',
+                            help='Файл журнала страниц, которые не удалось обработать')
+        parser.add_argument('--resume', action='store_true',
+                            help='Обработать только страницы из журнала')
+        parser.add_argument('--enqueue', action='store_true',
+                            help='Поставить все страницы в очередь заданий в БД и завершиться')
+        parser.add_argument('--lease', type=float, default=300,
+                            help='Время аренды задания воркером, секунды (queue)')
+        parser.add_argument('--batch-size', type=int, default=10,
+                            help='Количество заданий, которое поток берет за один раз (queue)')
+        parser.add_argument('--max-attempts', type=int, default=3,
+                            help='Максимальное количество попыток задания (queue)')
+        parser.add_argument('--metrics-file',
+                            help='Файл метрик в текстовом формате Prometheus для textfile '
+                                 'collector node_exporter')
+        parser.add_argument('--metrics-interval', type=float, default=15,
+                            help='Интервал записи файла метрик, секунды')
+        parser.add_argument('--profile-rate', type=float,
+                            help='Доля записей в БД, которые профилируются (по умолчанию '
+                                 'PROFILING_INGEST_RATE)')
+        parser.add_argument('--profile-dir',
+                            help='Директория профилей (по умолчанию PROFILING_DIR)')
 
     def handle(self, *args, **options):
         threads = options['threads']
-        stock_list = get_stocks_list('tickers.txt')
-        parser = NasdaqParser(stock_list)
-        stock_prices_urls = parser.get_prices_urls()
-        insider_trades_urls = parser.get_trades_urls()
-        with ThreadPool(threads[0]) as pool:
-            pool.map(parser.get_stock_prices, stock_prices_urls)
-            pool.map(parser.get_insider_trades, insider_trades_urls)
+        stock_list = StocksFile('tickers.txt')
+        incremental = options['incremental']
+        if options['replay'] and not options['cache_dir']:
+            raise CommandError('Для режима --replay необходимо указать --cache-dir')
+        if options['resume'] and not options['journal']:
+            raise CommandError('Для режима --resume необходимо указать --journal')
+        if options['profile_dir']:
+            profiler.directory = options['profile_dir']
+        if options['profile_rate'] is not None:
+            if not profiler.enabled:
+                raise CommandError('Для --profile-rate необходимо указать --profile-dir или '
+                                   'PROFILING_DIR')
+            profiler.ingest_rate = options['profile_rate']
+        cache = None
+        if options['cache_dir']:
+            cache = PageCache(options['cache_dir'], max_size=options['cache_size'] * 1024 ** 2)
+        limiter = None
+        if options['rate']:
+            limiter = RateLimiter(rate=options['rate'], max_rate=options['max_rate'])
+        throttle = Throttle(limiter=limiter, retries=options['retries'],
+                            breaker=CircuitBreaker(threshold=options['breaker_threshold'],
+                                                   pause=options['breaker_pause']))
+        journal = FailedJournal(options['journal']) if options['journal'] else None
+        resume = None
+        if options['resume']:
+            resume = journal.read()
+            # страницы из журнала загружаются целиком, без обхода страниц сделок по порядку
+            incremental = False
+        parser = NasdaqParser(stock_list, pool_size=threads[0],
+                              extractor=EXTRACTORS[options['extractor']](), incremental=incremental,
+                              cache=cache, replay=options['replay'], throttle=throttle,
+                              timeout=options['timeout'], journal=journal, resume=resume)
+        if incremental:
+            parser.load_high_water_marks()
+
+        started = time.monotonic()
+        with ExitStack() as stack:
+            if resume is not None:
+                # журнал заменяется новыми ошибками только после завершения запуска
+                stack.enter_context(journal.replacing())
+            if options['enqueue']:
+                from ...parser.crawl_queue import CrawlQueue
+                crawl_queue = CrawlQueue(parser, threads=threads[0],
+                                         batch_size=options['batch_size'], lease=options['lease'],
+                                         max_attempts=options['max_attempts'])
+                self.stdout.write(f'Поставлено в очередь заданий: {crawl_queue.enqueue()}')
+                return
+            if options['metrics_file']:
+                stack.enter_context(metrics.TextfileWriter(options['metrics_file'],
+                                                           options['metrics_interval']))
+            self.run(parser, options, threads[0], incremental)
+        elapsed = time.monotonic() - started
+        rows = metrics.rows_written.get()
+        self.stdout.write(f'Загружено страниц: {metrics.fetch_responses.get():.0f}, '
+                          f'записано строк: {rows:.0f} за {elapsed:.1f} с '
+                          f'({rows / elapsed if elapsed else 0:.0f} строк/с)')
+
+    def run(self, parser: NasdaqParser, options: dict, threads: int, incremental: bool):
+        """Обходит страницы выбранным движком
+
+        Args:
+            parser (NasdaqParser): Парсер
+            options (dict): Параметры команды
+            threads (int): Количество потоков
+            incremental (bool): Инкрементальная загрузка
+        """
+        if options['engine'] == 'queue':
+            from ...parser.crawl_queue import CrawlQueue
+            crawl_queue = CrawlQueue(parser, threads=threads, batch_size=options['batch_size'],
+                                     lease=options['lease'], max_attempts=options['max_attempts'])
+            crawl_queue.run()
+            return
+        # в режиме повтора нет сетевых запросов, поэтому асинхронный движок не нужен
+        if options['engine'] == 'async' and not options['replay']:
+            from ...parser.async_engine import AsyncEngine
+            engine = AsyncEngine(parser, concurrency=options['concurrency'],
+                                 limit_per_host=options['limit_per_host'], threads=threads)
+            engine.run()
+            return
+        if options['engine'] == 'pipeline':
+            from ...parser.pipeline import Pipeline
+            pipeline = Pipeline(parser, fetchers=threads, parsers=options['parsers'],
+                                writers=options['writers'], queue_size=options['queue_size'])
+            pipeline.run()
+            return
+        size = threads * 2
+        with ThreadPool(threads) as pool:
+            imap_bounded(pool, parser.get_stock_prices, parser.get_prices_urls(), size)
+            if incremental:
+                imap_bounded(pool, parser.get_stock_insider_trades, parser.stocks, size)
+            else:
+                imap_bounded(pool, parser.get_insider_trades, parser.get_trades_urls(), size)
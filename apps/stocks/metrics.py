@@ -0,0 +1,319 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+# границы корзин гистограмм по умолчанию, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Metric:
+    """Метрика в формате Prometheus со значениями по набору меток
+
+    Attributes:
+        registry (MetricsRegistry): Реестр, в котором зарегистрирована метрика
+        name (str): Название
+        documentation (str): Описание
+        labels (tuple): Названия меток
+    """
+    type = ''
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, documentation: str,
+                 labels: Sequence[str] = ()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, labels: Dict) -> Tuple:
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            lines += self.render_value(key, value)
+        return lines
+
+    def render_value(self, key: Tuple, value) -> List[str]:
+        return [f'{self.name}{format_labels(self.labels, key)} {value}']
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        if not self.registry.enabled:
+            return
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        with self.lock:
+            if labels:
+                return self.values.get(self.get_key(labels), 0)
+            return sum(self.values.values())
+
+
+class Histogram(Metric):
+    """Гистограмма: количество наблюдений по корзинам, их сумма и количество
+
+    Attributes:
+        buckets (tuple): Верхние границы корзин
+    """
+    type = 'histogram'
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, documentation: str,
+                 labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        if not self.registry.enabled:
+            return
+        key = self.get_key(labels)
+        # последняя корзина соответствует +Inf
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render_value(self, key: Tuple, value) -> List[str]:
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            labels = format_labels(self.labels, key, f'le="{bound}"')
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = format_labels(self.labels, key)
+        lines += [f'{self.name}_sum{labels} {total}', f'{self.name}_count{labels} {cumulative}']
+        return lines
+
+
+class MetricsRegistry:
+    """Реестр метрик процесса
+
+    Значения хранятся в памяти процесса. Когда метрики выключены, измерения сразу
+    возвращаются и не требуют блокировок.
+
+    Attributes:
+        enabled (bool): Собирать ли метрики
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.metrics = []
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        metric = Counter(self, name, documentation, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(self, name, documentation, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Возвращает метрики в текстовом формате Prometheus
+
+        Returns:
+            str
+        """
+        return ''.join(line + '\n' for metric in self.metrics for line in metric.render())
+
+    def write_textfile(self, path: str):
+        """Записывает метрики в файл для textfile collector node_exporter. Файл заменяется
+        целиком, поэтому collector не прочитает его наполовину записанным
+
+        Args:
+            path (str): Путь к файлу
+        """
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write(self.render())
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+
+registry = MetricsRegistry(enabled=getattr(settings, 'METRICS_ENABLED', True))
+
+fetch_seconds = registry.histogram(
+    'nasdaq_fetch_seconds', 'Nasdaq.com request latency in seconds',
+)
+fetch_responses = registry.counter(
+    'nasdaq_fetch_responses_total', 'Nasdaq.com responses by HTTP status', ['status'],
+)
+parse_seconds = registry.histogram(
+    'nasdaq_parse_seconds', 'Page parse time in seconds', ['method'],
+)
+write_seconds = registry.histogram(
+    'nasdaq_write_seconds', 'Database write time per page in seconds', ['stage'],
+)
+rows_written = registry.counter(
+    'nasdaq_rows_written_total', 'Rows inserted or updated by the parser', ['stage'],
+)
+ingest_queries = registry.counter(
+    'nasdaq_ingest_queries_total', 'Database queries executed by the parser', ['stage'],
+)
+view_seconds = registry.histogram(
+    'stocks_view_seconds', 'View latency in seconds', ['view'],
+)
+view_queries = registry.histogram(
+    'stocks_view_queries', 'Database queries per request', ['view'],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+
+
+def observe_fetch(seconds: float, status: str):
+    """Записывает время и статус запроса к Nasdaq.com
+
+    Args:
+        seconds (float): Время запроса
+        status (str): HTTP статус или error, если ответа нет
+    """
+    fetch_seconds.observe(seconds)
+    fetch_responses.inc(status=status)
+
+
+@contextmanager
+def ingest_stage(stage: str):
+    """Контекстный менеджер, который измеряет время записи страницы в БД и считает запросы
+    текущего потока
+
+    Args:
+        stage (str): Этап записи (prices или trades)
+    """
+    if not registry.enabled:
+        yield
+        return
+
+    def count(execute, sql, params, many, context):
+        ingest_queries.inc(stage=stage)
+        return execute(sql, params, many, context)
+
+    with write_seconds.time(stage=stage), connection.execute_wrapper(count):
+        yield
+
+
+class MetricsMiddleware:
+    """Middleware, которое записывает время ответа и количество запросов к БД по названию url.
+    Запросы, которые выполняются при отдаче потокового ответа, не учитываются
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not registry.enabled:
+            return self.get_response(request)
+        queries = 0
+
+        def count(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(count):
+            response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else 'unmatched'
+        view_seconds.observe(time.perf_counter() - start, view=view)
+        view_queries.observe(queries, view=view)
+        return response
+
+
+def is_metrics_allowed(request) -> bool:
+    """Метрики доступны персоналу, а также запросам с адресов METRICS_ALLOWED_IPS с
+    заголовком Authorization: Bearer METRICS_TOKEN, если токен задан
+
+    Args:
+        request: Запрос
+
+    Returns:
+        bool
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_active and user.is_staff:
+        return True
+    if request.META.get('REMOTE_ADDR') not in getattr(settings, 'METRICS_ALLOWED_IPS', ()):
+        return False
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token is None:
+        return True
+    return constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}')
+
+
+def metrics_view(request):
+    if not is_metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class TextfileWriter:
+    """Поток, который периодически записывает метрики в файл, пока работает парсер
+
+    Attributes:
+        path (str): Путь к файлу
+        interval (float): Интервал записи, секунды
+    """
+
+    def __init__(self, path: str, interval: float = 15):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            registry.write_textfile(self.path)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        registry.write_textfile(self.path)
@@ -0,0 +1,23 @@
+# Generated by Django 2.0.4 on 2026-10-18 17:45
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stocks', '0002_auto_20180418_0502'),
+    ]
+
+    operations = [
+        # оставляем только последнюю запись для каждой пары (stock, date)
+        migrations.RunSQL(
+            sql='DELETE FROM stocks_price a USING stocks_price b '
+                'WHERE a.stock_id = b.stock_id AND a.date = b.date AND a.id < b.id',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AlterUniqueTogether(
+            name='price',
+            unique_together={('stock', 'date')},
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 2.0.4 on 2026-10-18 17:46
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stocks', '0003_price_unique_stock_date'),
+    ]
+
+    operations = [
+        # переносим сделки на первую из повторяющихся связей и удаляем остальные
+        migrations.RunSQL(
+            sql=[
+                'UPDATE stocks_trade t SET insider_relation_id = d.keep_id FROM ('
+                '  SELECT r.id, MIN(r.id) OVER (PARTITION BY r.stock_id, r.insider_id, r.position)'
+                '  AS keep_id FROM stocks_relation r'
+                ') d WHERE t.insider_relation_id = d.id AND d.id <> d.keep_id',
+                'DELETE FROM stocks_relation a USING stocks_relation b '
+                'WHERE a.stock_id = b.stock_id AND a.insider_id = b.insider_id '
+                'AND a.position = b.position AND a.id > b.id',
+            ],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        # оставляем только последнюю из повторяющихся сделок
+        migrations.RunSQL(
+            sql='DELETE FROM stocks_trade a USING stocks_trade b '
+                'WHERE a.insider_relation_id = b.insider_relation_id '
+                'AND a.last_date = b.last_date AND a.transaction_type = b.transaction_type '
+                'AND a.owner_type = b.owner_type AND a.shares_traded = b.shares_traded '
+                'AND a.shares_held = b.shares_held AND a.id < b.id',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AlterUniqueTogether(
+            name='relation',
+            unique_together={('stock', 'insider', 'position')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='trade',
+            unique_together={('insider_relation', 'last_date', 'transaction_type', 'owner_type', 'shares_traded', 'shares_held')},
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.0.4 on 2026-10-18 17:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stocks', '0004_relation_trade_natural_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrawlJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('method', models.CharField(choices=[('prices', 'prices'), ('trades', 'trades')], max_length=10)),
+                ('stock', models.CharField(max_length=10)),
+                ('url', models.CharField(max_length=255, unique=True)),
+                ('page', models.PositiveSmallIntegerField(default=1)),
+                ('status', models.PositiveSmallIntegerField(choices=[(0, 'pending'), (1, 'running'), (2, 'done'), (3, 'failed')], default=0)),
+                ('worker', models.CharField(blank=True, default='', max_length=255)),
+                ('lease_expires', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='crawljob',
+            index=models.Index(fields=['status', 'id'], name='stocks_craw_status_32331b_idx'),
+        ),
+    ]
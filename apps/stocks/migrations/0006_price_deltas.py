@@ -0,0 +1,88 @@
+# Generated by Django 2.0.4 on 2026-10-18 18:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stocks', '0005_crawljob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='price',
+            name='bar_delta_close',
+            field=models.DecimalField(decimal_places=3, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='price',
+            name='bar_delta_high',
+            field=models.DecimalField(decimal_places=3, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='price',
+            name='bar_delta_low',
+            field=models.DecimalField(decimal_places=3, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='price',
+            name='bar_delta_open',
+            field=models.DecimalField(decimal_places=3, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='price',
+            name='bar_delta_volume',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='price',
+            name='cum_delta_close',
+            field=models.DecimalField(decimal_places=3, default=0, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='price',
+            name='cum_delta_high',
+            field=models.DecimalField(decimal_places=3, default=0, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='price',
+            name='cum_delta_low',
+            field=models.DecimalField(decimal_places=3, default=0, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='price',
+            name='cum_delta_open',
+            field=models.DecimalField(decimal_places=3, default=0, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='price',
+            name='cum_delta_volume',
+            field=models.BigIntegerField(default=0),
+        ),
+        # заполняем изменения цен для уже сохраненных цен
+        migrations.RunSQL(
+            sql='UPDATE stocks_price p SET '
+                'bar_delta_open = s.delta_open, cum_delta_open = s.sum_open, '
+                'bar_delta_high = s.delta_high, cum_delta_high = s.sum_high, '
+                'bar_delta_low = s.delta_low, cum_delta_low = s.sum_low, '
+                'bar_delta_close = s.delta_close, cum_delta_close = s.sum_close, '
+                'bar_delta_volume = s.delta_volume, cum_delta_volume = s.sum_volume '
+                'FROM (SELECT id, '
+                '  delta_open, SUM(ABS(delta_open)) OVER w AS sum_open, '
+                '  delta_high, SUM(ABS(delta_high)) OVER w AS sum_high, '
+                '  delta_low, SUM(ABS(delta_low)) OVER w AS sum_low, '
+                '  delta_close, SUM(ABS(delta_close)) OVER w AS sum_close, '
+                '  delta_volume, SUM(ABS(delta_volume)) OVER w AS sum_volume '
+                '  FROM (SELECT id, stock_id, date, '
+                '    open - LAG(open, 1, open) OVER w AS delta_open, '
+                '    high - LAG(high, 1, high) OVER w AS delta_high, '
+                '    low - LAG(low, 1, low) OVER w AS delta_low, '
+                '    close - LAG(close, 1, close) OVER w AS delta_close, '
+                '    volume - LAG(volume, 1, volume) OVER w AS delta_volume '
+                '    FROM stocks_price WINDOW w AS (PARTITION BY stock_id ORDER BY date)'
+                '  ) d WINDOW w AS (PARTITION BY stock_id ORDER BY date)'
+                ') s WHERE p.id = s.id',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.4 on 2026-10-18 18:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stocks', '0006_price_deltas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stock',
+            name='prices_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.0.4 on 2026-10-18 18:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stocks', '0007_stock_prices_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='price',
+            index=models.Index(fields=['stock', 'date', 'id'], name='stocks_pric_stock_i_1f4ba8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trade',
+            index=models.Index(fields=['last_date', 'id'], name='stocks_trad_last_da_e07193_idx'),
+        ),
+    ]
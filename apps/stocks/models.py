@@ -1,9 +1,12 @@
 from django.db import models
 from django.template.defaultfilters import slugify
 from django.urls import reverse
+from django.utils import timezone
 from model_utils import Choices
 
-from .querysets import PriceQuerySet, TradeQuerySet
+from .querysets import (
+    PriceQuerySet, InsiderQuerySet, RelationQuerySet, TradeQuerySet, CrawlJobQuerySet
+)
 
 
 class Stock(models.Model):
@@ -18,6 +21,16 @@ class Stock(models.Model):
         blank=True
     )
 
+    # увеличивается парсером при записи цен, по ней обновляются кэши цен
+    prices_version = models.PositiveIntegerField(
+        default=0
+    )
+
+    # обновляется парсером при записи цен или сделок, по нему строятся ETag и Last-Modified
+    modified = models.DateTimeField(
+        default=timezone.now
+    )
+
     def __str__(self):
         return self.name.upper()
 
@@ -62,11 +75,76 @@ class Price(models.Model):
         default=0
     )
 
+    # изменение цены относительно предыдущей цены акции и накопленная сумма абсолютных
+    # изменений, которые обновляются при записи цен (PriceQuerySet.update_deltas)
+    bar_delta_open = models.DecimalField(
+        max_digits=12,
+        decimal_places=3,
+        default=0
+    )
+
+    bar_delta_high = models.DecimalField(
+        max_digits=12,
+        decimal_places=3,
+        default=0
+    )
+
+    bar_delta_low = models.DecimalField(
+        max_digits=12,
+        decimal_places=3,
+        default=0
+    )
+
+    bar_delta_close = models.DecimalField(
+        max_digits=12,
+        decimal_places=3,
+        default=0
+    )
+
+    bar_delta_volume = models.BigIntegerField(
+        default=0
+    )
+
+    cum_delta_open = models.DecimalField(
+        max_digits=20,
+        decimal_places=3,
+        default=0
+    )
+
+    cum_delta_high = models.DecimalField(
+        max_digits=20,
+        decimal_places=3,
+        default=0
+    )
+
+    cum_delta_low = models.DecimalField(
+        max_digits=20,
+        decimal_places=3,
+        default=0
+    )
+
+    cum_delta_close = models.DecimalField(
+        max_digits=20,
+        decimal_places=3,
+        default=0
+    )
+
+    cum_delta_volume = models.BigIntegerField(
+        default=0
+    )
+
     objects = PriceQuerySet.as_manager()
 
     def __str__(self):
         return f'{self.stock.name} ({self.date.strftime("%m/%d/%Y")})'
 
+    class Meta:
+        unique_together = ('stock', 'date')
+        indexes = [
+            # постраничный вывод цен акции по (date, id)
+            models.Index(fields=['stock', 'date', 'id']),
+        ]
+
 
 class Insider(models.Model):
     full_name = models.CharField(
@@ -78,6 +156,8 @@ class Insider(models.Model):
         unique=True
     )
 
+    objects = InsiderQuerySet.as_manager()
+
     def __str__(self):
         return self.full_name
 
@@ -108,11 +188,14 @@ class Relation(models.Model):
         on_delete=models.CASCADE
     )
 
+    objects = RelationQuerySet.as_manager()
+
     def __str__(self):
         return f'{self.insider} {self.get_position_display()} of {self.stock.company_name}'
 
     class Meta:
         default_related_name = 'relations'
+        unique_together = ('stock', 'insider', 'position')
 
 
 class Trade(models.Model):
@@ -157,3 +240,76 @@ class Trade(models.Model):
 
     class Meta:
         ordering = ('last_date', 'insider_relation__insider__full_name')
+        indexes = [
+            # постраничный вывод сделок по (last_date, id)
+            models.Index(fields=['last_date', 'id']),
+        ]
+        unique_together = ('insider_relation', 'last_date', 'transaction_type', 'owner_type',
+                           'shares_traded', 'shares_held')
+
+
+class CrawlJob(models.Model):
+    METHODS = Choices(
+        ('prices', 'PRICES', 'prices'),
+        ('trades', 'TRADES', 'trades'),
+    )
+
+    STATUSES = Choices(
+        (0, 'PENDING', 'pending'),
+        (1, 'RUNNING', 'running'),
+        (2, 'DONE', 'done'),
+        (3, 'FAILED', 'failed'),
+    )
+
+    method = models.CharField(
+        max_length=10,
+        choices=METHODS
+    )
+
+    stock = models.CharField(
+        max_length=10
+    )
+
+    url = models.CharField(
+        max_length=255,
+        unique=True
+    )
+
+    page = models.PositiveSmallIntegerField(
+        default=1
+    )
+
+    status = models.PositiveSmallIntegerField(
+        choices=STATUSES,
+        default=STATUSES.PENDING
+    )
+
+    worker = models.CharField(
+        max_length=255,
+        default='',
+        blank=True
+    )
+
+    lease_expires = models.DateTimeField(
+        null=True,
+        blank=True
+    )
+
+    attempts = models.PositiveSmallIntegerField(
+        default=0
+    )
+
+    error = models.TextField(
+        default='',
+        blank=True
+    )
+
+    objects = CrawlJobQuerySet.as_manager()
+
+    def __str__(self):
+        return f'{self.get_method_display()} {self.url} ({self.get_status_display()})'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id']),
+        ]
@@ -1,83 +1,248 @@
-from typing import List, Tuple
-
 import itertools
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
 import requests
-from bs4 import BeautifulSoup
-from datetime import datetime
+from django.db.models import F, Max
+from django.template.defaultfilters import slugify
 from django.utils import timezone
+from requests.adapters import HTTPAdapter
 
+from apps.stocks import metrics, profiling
 from apps.stocks.models import Stock, Insider, Relation, Trade, Price
+from .cache import PageCache
+from .extractors import LxmlExtractor, PriceRow, TradeRow, extract
+from .throttling import FailedJournal, Throttle
+
+logger = logging.getLogger(__name__)
+
+
+class StocksFile:
+    """Список акций из файла. Файл читается построчно при каждом обходе, поэтому список не
+    хранится в памяти целиком и его можно обходить несколько раз
+
+    Attributes:
+        path (str): Путь к файлу, одна акция на строку
+    """
 
+    def __init__(self, path: str):
+        self.path = path
 
-def get_stocks_list(path: str) -> List:
-    with open(path) as file:
-        stock_list = file.read().splitlines()
-    return stock_list
+    def __iter__(self) -> Iterator[str]:
+        with open(self.path) as file:
+            for line in file:
+                stock = line.strip()
+                if stock:
+                    yield stock
 
 
 class NasdaqParser:
     """Класс для парсинга Nasdaq.com
 
     Attributes:
-        stocks (list): Список акций для парсинга
+        stocks (Iterable): Список акций для парсинга, обходится лениво
+        session (requests.Session): HTTP-сессия с пулом keep-alive соединений
+        stock_ids (dict): Id акций по названию
+        insider_ids (dict): Id владельцев по slug
+        relation_ids (dict): Id связей по (stock_id, insider_id, position)
+        extractor: Экстрактор строк таблиц, по умолчанию lxml
+        incremental (bool): Записывать только данные не старше уже сохраненных и прекращать
+            обход страниц сделок, когда на странице нет новых сделок
+        last_price_dates (dict): Дата последней сохраненной цены по названию акции
+        last_trade_dates (dict): Дата последней сохраненной сделки по названию акции
+        cache (PageCache): Дисковый кэш страниц
+        replay (bool): Разбирать только страницы из кэша, не обращаясь к Nasdaq.com
+        throttle (Throttle): Ограничение скорости и повторные попытки запросов
+        timeout (float): Таймаут запроса в секундах
+        journal (FailedJournal): Журнал страниц, которые не удалось обработать
+        resume (list): Страницы из журнала, которые нужно обработать вместо всех страниц
+
+    Словари id - общая для всех потоков карта уже записанных объектов. Запись в БД
+    идемпотентна, поэтому гонка между потоками приводит только к лишнему запросу.
     """
 
-    def __init__(self, stocks: List):
+    def __init__(self, stocks: Iterable[str], pool_size: int = 10, extractor=None,
+                 incremental: bool = False, cache: PageCache = None, replay: bool = False,
+                 throttle: Throttle = None, timeout: float = 30, journal: FailedJournal = None,
+                 resume: List[Tuple[str, str, str]] = None):
         self.stocks = stocks
+        self.throttle = throttle or Throttle()
+        self.timeout = timeout
+        self.journal = journal
+        self.resume = resume
+        self.cache = cache
+        self.replay = replay
+        self.incremental = incremental
+        self.last_price_dates = {}
+        self.last_trade_dates = {}
+        self.extractor = extractor or LxmlExtractor()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.stock_ids = {}
+        self.insider_ids = {}
+        self.relation_ids = {}
         self.stocks_prices_url = 'https://www.nasdaq.com/symbol/{stock}/historical'
         self.insider_trades_url = 'https://www.nasdaq.com/symbol/{stock}/insider-trades?page={n}'
 
-    def get_prices_urls(self) -> List:
-        """Возвращает urls страниц с ценами акций
+    def get_prices_urls(self) -> Iterator[Tuple]:
+        """Возвращает urls страниц с ценами акций по мере обхода списка акций
 
         Return:
-            List
+            Iterator[Tuple]
+        """
+        if self.resume is not None:
+            yield from ((stock, url) for method, stock, url in self.resume if method == 'prices')
+            return
+        for stock in self.stocks:
+            yield stock.lower(), self.stocks_prices_url.format(stock=stock.lower())
+
+    def get_trades_urls(self) -> Iterator[Tuple]:
+        """Возвращает urls страниц с данными о продажах акций владельцами компаний по мере
+        обхода списка акций, страницы одной акции идут подряд
+
+        Return:
+            Iterator[Tuple]
         """
-        prices_urls = [(stock.lower(), self.stocks_prices_url.format(stock=stock.lower()))
-                       for stock in self.stocks]
-        return prices_urls
+        if self.resume is not None:
+            yield from ((stock, url) for method, stock, url in self.resume if method == 'trades')
+            return
+        for stock in self.stocks:
+            yield from self.get_stock_trades_urls(stock)
+
+    def get_stock_trades_urls(self, stock: str) -> List:
+        """Возвращает urls страниц с данными о продажах заданной акции по порядку страниц
 
-    def get_trades_urls(self) -> List:
-        """Возвращает urls страниц с данными о продажах акций владельцами компаний
+        Args:
+            stock (str): Название акции
 
         Return:
             List
         """
-        page_numbers = list(range(1, 11))
-        pages_stocks = sorted(list(itertools.product(page_numbers, self.stocks)), key=lambda x: x[1])
-        trades_urls = [(stock.lower(), self.insider_trades_url.format(stock=stock.lower(), n=n))
-                       for (n, stock) in pages_stocks]
-        return trades_urls
+        return [(stock.lower(), self.insider_trades_url.format(stock=stock.lower(), n=n))
+                for n in range(1, 11)]
+
+    def load_high_water_marks(self):
+        """Загружает даты последних сохраненных цен и сделок для всех акций двумя запросами
+        """
+        self.last_price_dates = dict(
+            Price.objects.values_list('stock__name').annotate(Max('date')).order_by()
+        )
+        self.last_trade_dates = dict(
+            Trade.objects.values_list('insider_relation__stock__name').annotate(Max('last_date'))
+            .order_by()
+        )
 
-    def get_html_content(self, url: str) -> BeautifulSoup:
-        """Получает содержимое страницы
+    def get_html(self, url: str) -> Optional[bytes]:
+        """Получает содержимое страницы. Если задан кэш, то отправляет условный запрос, а в
+        режиме повтора берет страницу только из кэша
 
         Args:
             url (str): URL страницы
 
         Returns:
-            BeautifulSoup
+            bytes or None: Содержимое страницы или None, если страница не изменилась с
+                прошлой загрузки
         """
-        html = requests.get(url)
-        content = BeautifulSoup(html.content, 'lxml')
-        return content
+        if self.replay:
+            return self.cache.read(url)
+        if self.cache is None:
+            return self.request(url).content
+        response = self.request(url, headers=self.cache.get_conditional_headers(url))
+        return self.cache.update(url, response.status_code, response.content, response.headers)
+
+    def request(self, url: str, headers: Dict = None) -> requests.Response:
+        """Отправляет запрос с учетом ограничения скорости, повторяя его при ошибках
+
+        Args:
+            url (str): URL страницы
+            headers (Dict): Заголовки запроса
 
-    def get_or_create_stock(self, content: BeautifulSoup, stock: str) -> Stock:
+        Returns:
+            requests.Response
+
+        Raises:
+            FetchError: Если страницу не удалось загрузить после всех попыток или запросы
+                к хосту приостановлены (HostPaused)
+        """
+        for attempt in itertools.count():
+            time.sleep(self.throttle.get_delay(url))
+            start = time.monotonic()
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except requests.RequestException as error:
+                metrics.observe_fetch(time.monotonic() - start, 'error')
+                delay = self.throttle.check(url, attempt, time.monotonic() - start, error=error)
+            else:
+                metrics.observe_fetch(time.monotonic() - start, str(response.status_code))
+                delay = self.throttle.check(url, attempt, time.monotonic() - start,
+                                            status=response.status_code,
+                                            retry_after=response.headers.get('Retry-After'))
+                if delay is None:
+                    return response
+            time.sleep(delay)
+
+    def record_failure(self, method: str, stock: str, url: str, error: Exception):
+        """Записывает в лог и в журнал страницу, которую не удалось обработать, чтобы ошибка
+        одной страницы не прерывала весь запуск
+
+        Args:
+            method (str): Тип страницы (prices или trades)
+            stock (str): Название акции
+            url (str): URL страницы
+            error (Exception): Ошибка
+        """
+        logger.error('Не удалось обработать %s: %r', url, error)
+        if self.journal is not None:
+            self.journal.add(method, stock, url, error)
+
+    @contextmanager
+    def discard_on_error(self, url: str):
+        """Удаляет страницу из кэша, если ее не удалось обработать, чтобы при следующем запуске
+        она не была пропущена как неизмененная
+
+        Args:
+            url (str): URL страницы
+        """
+        try:
+            yield
+        except Exception:
+            if self.cache is not None and not self.replay:
+                self.cache.discard(url)
+            raise
+
+    def extract(self, method: str, html: bytes):
+        """Извлекает строки таблицы со страницы через lxml, а если lxml не смог разобрать
+        страницу, то через BeautifulSoup
+
+        Args:
+            method (str): Метод экстрактора (prices или trades)
+            html (bytes): Содержимое страницы
+        """
+        with metrics.parse_seconds.time(method=method):
+            return extract(self.extractor, method, html)
+
+    def get_or_create_stock(self, stock: str, company_name: str) -> Stock:
         """Создает запись с информацией об акции в БД или отдает существующую
 
         Args:
-            content (BeautifulSoup): HTML content
             stock (str): Название акции
+            company_name (str): Название компании
 
         Returns:
             Stock object
         """
-        # get company name from title
-        title = content.find('h1').text
-        for _ in ('Common Stock Historical Stock Prices', 'Capital Stock Historical Stock Prices'):
-            title = title.replace(_, '').strip()
-
-        stock, _ = Stock.objects.update_or_create(name=stock, defaults={'company_name': title})
+        stock, created = Stock.objects.get_or_create(name=stock,
+                                                     defaults={'company_name': company_name})
+        if company_name and not created and stock.company_name != company_name:
+            # время изменения данных акции входит в ETag страниц со списком акций
+            stock.company_name = company_name
+            stock.modified = timezone.now()
+            stock.save(update_fields=['company_name', 'modified'])
+        self.stock_ids[stock.name] = stock.id
         return stock
 
     def get_stock_prices(self, stock_and_url: Tuple):
@@ -87,28 +252,49 @@ class NasdaqParser:
             stock_and_url (Tuple): Название акции и url страницы
         """
         stock, url = stock_and_url
-        content = self.get_html_content(url)
-        table = content.select('.genTable > div > table > tbody > tr')
-        stock = self.get_or_create_stock(content, stock)
-
-        for row in table:
-            date_or_time = row.select('td')[0].text.strip()
-            if date_or_time:
-                try:
-                    date = datetime.strptime(date_or_time, '%m/%d/%Y')
-                except ValueError:
-                    time = datetime.strptime(date_or_time, '%H:%M')
-                    date = datetime.now().replace(hour=time.hour, minute=time.minute)
-                opn = row.select('td')[1].text.strip().replace(',', '')
-                high = row.select('td')[2].text.strip().replace(',', '')
-                low = row.select('td')[3].text.strip().replace(',', '')
-                close = row.select('td')[4].text.strip().replace(',', '')
-                volume = row.select('td')[5].text.strip().replace(',', '')
-
-                price, _ = Price.objects.get_or_create(
-                    stock=stock, date=timezone.make_aware(date, timezone.get_default_timezone()),
-                    open=opn, high=high, low=low, close=close, volume=volume
-                )
+        try:
+            with self.discard_on_error(url):
+                self.save_stock_prices(stock, self.get_html(url))
+        except Exception as error:
+            self.record_failure('prices', stock, url, error)
+
+    def save_stock_prices(self, stock: str, html: Optional[bytes]):
+        """Сохраняет в БД цены акции со страницы
+
+        Args:
+            stock (str): Название акции
+            html (bytes): Содержимое страницы или None, если страница не изменилась
+        """
+        if html is None:
+            return
+        company_name, rows = self.extract('prices', html)
+        self.write_stock_prices(stock, company_name, rows)
+
+    @metrics.ingest_stage('prices')
+    @profiling.ingest_profile('prices')
+    def write_stock_prices(self, stock: str, company_name: str, rows: List[PriceRow]):
+        """Записывает в БД цены акции одним запросом
+
+        Args:
+            stock (str): Название акции
+            company_name (str): Название компании
+            rows (List[PriceRow]): Цены со страницы
+        """
+        last_date = self.last_price_dates.get(stock)
+        stock = self.get_or_create_stock(stock, company_name)
+        prices = (
+            Price(stock=stock, date=timezone.make_aware(row.date, timezone.get_default_timezone()),
+                  open=row.open, high=row.high, low=row.low, close=row.close, volume=row.volume)
+            for row in rows
+        )
+        # последняя сохраненная цена перезаписывается, так как могла быть исправлена
+        prices = [price for price in prices if last_date is None or price.date >= last_date]
+        count = Price.objects.bulk_upsert(prices)
+        metrics.rows_written.inc(count, stage='prices')
+        if count:
+            Price.objects.update_deltas(stock.id, min(price.date for price in prices))
+            Stock.objects.filter(id=stock.id).update(prices_version=F('prices_version') + 1,
+                                                     modified=timezone.now())
 
     def get_insider_trades(self, stock_and_url: Tuple):
         """Получает данные о торговле заданной акцией на заданной странице, а затем сохраняет
@@ -118,28 +304,145 @@ class NasdaqParser:
             stock_and_url (Tuple): Название акции и url страницы
         """
         stock, url = stock_and_url
-        content = self.get_html_content(url)
-        table = content.select('.genTable > table > tr')
-        stock, _ = Stock.objects.get_or_create(name=stock)
-
-        for row in table:
-            insider_name = row.select('td')[0].text.strip()
-            relation = row.select('td')[1].text.strip()
-            last_date = datetime.strptime(row.select('td')[2].text.strip(), '%m/%d/%Y')
-            transaction_type = row.select('td')[3].text.strip()
-            owner_type = row.select('td')[4].text.strip()
-            shares_traded = row.select('td')[5].text.strip().replace(',', '')
-            last_price = row.select('td')[6].text.strip().replace(',', '')
-            shares_held = row.select('td')[7].text.strip().replace(',', '')
-
-            insider, _ = Insider.objects.get_or_create(full_name=insider_name)
-            relation, _ = Relation.objects.get_or_create(
-                position=getattr(Relation.POSITIONS, relation.upper()), stock=stock,
-                insider=insider
+        try:
+            with self.discard_on_error(url):
+                return self.save_insider_trades(stock, self.get_html(url))
+        except Exception as error:
+            self.record_failure('trades', stock, url, error)
+            return 0
+
+    def get_stock_insider_trades(self, stock: str):
+        """Получает данные о торговле заданной акцией постранично, пока на странице есть новые
+        сделки
+
+        Args:
+            stock (str): Название акции
+        """
+        for stock_and_url in self.get_stock_trades_urls(stock):
+            if not self.get_insider_trades(stock_and_url):
+                break
+
+    def save_insider_trades(self, stock: str, html: Optional[bytes]) -> int:
+        """Сохраняет в БД данные о торговле акцией со страницы
+
+        Args:
+            stock (str): Название акции
+            html (bytes): Содержимое страницы или None, если страница не изменилась
+
+        Returns:
+            int: Количество новых сделок на странице
+        """
+        if html is None:
+            return 0
+        return self.write_insider_trades(stock, self.extract('trades', html))
+
+    @metrics.ingest_stage('trades')
+    @profiling.ingest_profile('trades')
+    def write_insider_trades(self, stock: str, rows: List[TradeRow]) -> int:
+        """Записывает в БД данные о торговле акцией: владельцы и связи берутся из карты id
+        или создаются одним запросом, а сделки записываются одним запросом
+
+        Args:
+            stock (str): Название акции
+            rows (List[TradeRow]): Сделки со страницы
+
+        Returns:
+            int: Количество сделок новее последней сохраненной
+        """
+        last_date = self.last_trade_dates.get(stock)
+        if last_date is not None:
+            # сделки за последний сохраненный день записываются повторно, так как за этот день
+            # могли появиться новые, но новыми считаются только сделки за следующие дни
+            new_count = len([row for row in rows if row.last_date > last_date])
+            rows = [row for row in rows if row.last_date >= last_date]
+        else:
+            new_count = len(rows)
+        if not rows:
+            return new_count
+
+        stock_id = self.get_stock_id(stock)
+        trades = [
+            (row.insider_name, getattr(Relation.POSITIONS, row.relation.upper()), Trade(
+                last_date=row.last_date, transaction_type=row.transaction_type,
+                owner_type=getattr(Trade.OWNER_TYPES, row.owner_type.upper()),
+                shares_traded=row.shares_traded, shares_held=row.shares_held,
+                last_price=row.last_price,
+            ))
+            for row in rows
+        ]
+
+        insider_ids = self.get_insider_ids({insider_name for insider_name, _, _ in trades})
+        relation_ids = self.get_relation_ids({
+            (stock_id, insider_ids[slugify(insider_name)], position)
+            for insider_name, position, _ in trades
+        })
+        for insider_name, position, trade in trades:
+            trade.insider_relation_id = relation_ids[
+                (stock_id, insider_ids[slugify(insider_name)], position)
+            ]
+        count = Trade.objects.bulk_upsert(trade for _, _, trade in trades)
+        metrics.rows_written.inc(count, stage='trades')
+        if count:
+            Stock.objects.filter(id=stock_id).update(modified=timezone.now())
+        return new_count
+
+    def get_stock_id(self, name: str) -> int:
+        """Возвращает id акции, создавая ее при необходимости
+
+        Args:
+            name (str): Название акции
+
+        Returns:
+            int
+        """
+        if name not in self.stock_ids:
+            stock, _ = Stock.objects.get_or_create(name=name)
+            self.stock_ids[name] = stock.id
+        return self.stock_ids[name]
+
+    def get_insider_ids(self, full_names: Set[str]) -> Dict[str, int]:
+        """Возвращает id владельцев по slug, создавая отсутствующих одним запросом
+
+        Args:
+            full_names (Set[str]): Имена владельцев
+
+        Returns:
+            Dict[str, int]
+        """
+        missing = {slugify(full_name): full_name for full_name in full_names}
+        missing = {slug: full_name for slug, full_name in missing.items()
+                   if slug not in self.insider_ids}
+        if missing:
+            Insider.objects.bulk_upsert(
+                Insider(full_name=full_name, slug=slug) for slug, full_name in missing.items()
+            )
+            self.insider_ids.update(
+                Insider.objects.filter(slug__in=missing).values_list('slug', 'id')
+            )
+        return self.insider_ids
+
+    def get_relation_ids(self, keys: Set[Tuple[int, int, int]]) -> Dict[Tuple, int]:
+        """Возвращает id связей по (stock_id, insider_id, position), создавая отсутствующие
+        одним запросом
+
+        Args:
+            keys (Set[Tuple[int, int, int]]): Ключи связей
+
+        Returns:
+            Dict[Tuple, int]
+        """
+        missing = {key for key in keys if key not in self.relation_ids}
+        if missing:
+            Relation.objects.bulk_upsert(
+                Relation(stock_id=stock_id, insider_id=insider_id, position=position)
+                for stock_id, insider_id, position in missing
             )
-            trade, _ = Trade.objects.get_or_create(
-                insider_relation=relation, last_date=last_date, transaction_type=transaction_type,
-                owner_type=getattr(Trade.OWNER_TYPES, owner_type.upper()),
-                shares_traded=shares_traded, shares_held=shares_held,
-                last_price=last_price if last_price != '' else None,
+            relations = Relation.objects.filter(
+                stock_id__in={stock_id for stock_id, _, _ in missing},
+                insider_id__in={insider_id for _, insider_id, _ in missing}
+            ).values_list('stock_id', 'insider_id', 'position', 'id')
+            self.relation_ids.update(
+                ((stock_id, insider_id, position), pk)
+                for stock_id, insider_id, position, pk in relations
             )
+        return self.relation_ids
@@ -0,0 +1,202 @@
+import asyncio
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Iterable, Mapping, Tuple
+
+import aiohttp
+from django.db import connections
+
+from apps.stocks import metrics
+from . import NasdaqParser
+
+
+class AsyncEngine:
+    """Асинхронный движок загрузки страниц Nasdaq.com
+
+    Все запросы идут через один aiohttp клиент с пулом keep-alive соединений, поэтому
+    количество одновременных запросов не привязано к количеству потоков. Разбор страниц и
+    запись в БД выполняются в пуле потоков, так как ORM синхронная.
+
+    Attributes:
+        parser (NasdaqParser): Парсер, который разбирает страницы и сохраняет данные
+        concurrency (int): Максимальное количество одновременных соединений
+        limit_per_host (int): Максимальное количество соединений с одним хостом (0 - без
+            ограничения)
+        threads (int): Количество потоков для записи в БД
+    """
+
+    def __init__(self, parser: NasdaqParser, concurrency: int = 100, limit_per_host: int = 0,
+                 threads: int = 1):
+        self.parser = parser
+        self.concurrency = concurrency
+        self.limit_per_host = limit_per_host
+        self.threads = threads
+
+    async def fetch(self, session: aiohttp.ClientSession, executor: ThreadPoolExecutor,
+                    url: str) -> Tuple:
+        """Получает содержимое страницы с учетом ограничения скорости, повторяя запрос при
+        ошибках. Если у парсера задан кэш, то отправляет условный запрос, а метаданные
+        страницы читаются с диска в пуле потоков
+
+        Args:
+            session (aiohttp.ClientSession): HTTP клиент
+            executor (ThreadPoolExecutor): Пул потоков для работы с кэшем и БД
+            url (str): URL страницы
+
+        Returns:
+            Tuple: HTTP статус, содержимое и заголовки ответа
+
+        Raises:
+            FetchError: Если страницу не удалось загрузить после всех попыток или запросы
+                к хосту приостановлены (HostPaused)
+        """
+        parser = self.parser
+        cache = parser.cache
+        headers = {}
+        if cache is not None:
+            loop = asyncio.get_event_loop()
+            headers = await loop.run_in_executor(executor, cache.get_conditional_headers, url)
+        for attempt in itertools.count():
+            await asyncio.sleep(parser.throttle.get_delay(url))
+            start = time.monotonic()
+            try:
+                async with session.get(url, headers=headers, timeout=parser.timeout) as response:
+                    body = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                metrics.observe_fetch(time.monotonic() - start, 'error')
+                delay = parser.throttle.check(url, attempt, time.monotonic() - start, error=error)
+            else:
+                metrics.observe_fetch(time.monotonic() - start, str(response.status))
+                delay = parser.throttle.check(url, attempt, time.monotonic() - start,
+                                              status=response.status,
+                                              retry_after=response.headers.get('Retry-After'))
+                if delay is None:
+                    return response.status, body, response.headers
+            await asyncio.sleep(delay)
+
+    async def process(self, session: aiohttp.ClientSession, executor: ThreadPoolExecutor,
+                      handler: Callable, stock_and_url: Tuple):
+        """Загружает страницу и передает ее обработчику в пуле потоков
+
+        Args:
+            session (aiohttp.ClientSession): HTTP клиент
+            executor (ThreadPoolExecutor): Пул потоков для записи в БД
+            handler (Callable): Метод парсера, сохраняющий данные страницы
+            stock_and_url (Tuple): Название акции и url страницы
+
+        Returns:
+            Результат обработчика или None, если страницу не удалось обработать
+        """
+        stock, url = stock_and_url
+        try:
+            response = await self.fetch(session, executor, url)
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(executor, self.handle, handler, stock_and_url,
+                                              *response)
+        except Exception as error:
+            method = 'prices' if handler == self.parser.save_stock_prices else 'trades'
+            self.parser.record_failure(method, stock, url, error)
+
+    def handle(self, handler: Callable, stock_and_url: Tuple, status: int, html: bytes,
+               headers: Mapping):
+        """Сохраняет страницу в кэш и передает ее обработчику, выполняется в пуле потоков
+
+        Args:
+            handler (Callable): Метод парсера, сохраняющий данные страницы
+            stock_and_url (Tuple): Название акции и url страницы
+            status (int): HTTP статус ответа
+            html (bytes): Содержимое страницы
+            headers (Mapping): Заголовки ответа
+
+        Returns:
+            Результат обработчика
+        """
+        stock, url = stock_and_url
+        if self.parser.cache is not None:
+            html = self.parser.cache.update(url, status, html, headers)
+        with self.parser.discard_on_error(url):
+            return handler(stock, html)
+
+    async def process_stock_trades(self, session: aiohttp.ClientSession,
+                                   executor: ThreadPoolExecutor, stock: str):
+        """Загружает страницы сделок акции по порядку, пока на странице есть новые сделки
+
+        Args:
+            session (aiohttp.ClientSession): HTTP клиент
+            executor (ThreadPoolExecutor): Пул потоков для записи в БД
+            stock (str): Название акции
+        """
+        for stock_and_url in self.parser.get_stock_trades_urls(stock):
+            if not await self.process(session, executor, self.parser.save_insider_trades,
+                                      stock_and_url):
+                break
+
+    async def crawl(self, executor: ThreadPoolExecutor):
+        """Загружает и обрабатывает все страницы через один пул соединений: сначала цены
+        акций, а затем данные о торговле владельцами компаний
+
+        Args:
+            executor (ThreadPoolExecutor): Пул потоков для записи в БД
+        """
+        parser = self.parser
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.limit_per_host)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await self.consume(partial(self.process, session, executor, parser.save_stock_prices),
+                               parser.get_prices_urls())
+            if parser.incremental:
+                await self.consume(partial(self.process_stock_trades, session, executor),
+                                   parser.stocks)
+            else:
+                await self.consume(
+                    partial(self.process, session, executor, parser.save_insider_trades),
+                    parser.get_trades_urls()
+                )
+
+    async def consume(self, func: Callable, items: Iterable):
+        """Выполняет корутину func для каждого элемента items, но не больше concurrency
+        одновременно. Элементы берутся из итератора по мере освобождения обработчиков, поэтому
+        список заданий не создается в памяти целиком
+
+        Args:
+            func (Callable): Функция, возвращающая корутину для элемента
+            items (Iterable): Элементы
+        """
+        iterator = iter(items)
+
+        async def worker():
+            for item in iterator:
+                await func(item)
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+    def run(self):
+        """Загружает цены акций, а затем данные о торговле владельцами компаний"""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            with ThreadPoolExecutor(self.threads) as executor:
+                loop.run_until_complete(self.crawl(executor))
+                self.close_connections(executor)
+        finally:
+            loop.close()
+
+    def close_connections(self, executor: ThreadPoolExecutor):
+        """Закрывает соединения с БД, открытые в потоках пула
+
+        Соединения Django привязаны к потоку, поэтому закрыть их можно только из того же
+        потока. Барьер гарантирует, что каждая задача выполнится в отдельном потоке.
+
+        Args:
+            executor (ThreadPoolExecutor): Пул потоков для записи в БД
+        """
+        barrier = threading.Barrier(self.threads)
+
+        def close():
+            barrier.wait()
+            connections.close_all()
+
+        for future in [executor.submit(close) for _ in range(self.threads)]:
+            future.result()
@@ -0,0 +1,188 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Mapping, Optional
+
+
+class PageCache:
+    """Дисковый кэш загруженных страниц
+
+    Для каждого url хранится сжатое содержимое страницы и метаданные: ETag, Last-Modified и
+    хэш содержимого. По метаданным формируются условные запросы, а страница, которая не
+    изменилась с прошлой загрузки, не разбирается и не записывается в БД повторно. Когда
+    размер кэша превышает max_size, удаляются давно не использованные записи.
+
+    Attributes:
+        path (Path): Директория кэша
+        max_size (int): Максимальный размер кэша в байтах
+    """
+
+    def __init__(self, path: str, max_size: int = 1024 ** 3):
+        self.path = Path(path)
+        self.max_size = max_size
+        # все изменения size и удаление записей выполняются под одной блокировкой
+        self.lock = threading.RLock()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.size = sum(file.stat().st_size for file in self.path.glob('*/*'))
+
+    def get_paths(self, url: str):
+        key = hashlib.sha1(url.encode()).hexdigest()
+        directory = self.path.joinpath(key[:2])
+        return directory.joinpath(f'{key}.gz'), directory.joinpath(f'{key}.json')
+
+    def get_meta(self, url: str) -> Optional[Dict]:
+        """Возвращает метаданные страницы или None, если страницы нет в кэше
+
+        Args:
+            url (str): URL страницы
+
+        Returns:
+            Dict or None
+        """
+        _, meta_path = self.get_paths(url)
+        try:
+            with open(meta_path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def get_conditional_headers(self, url: str) -> Dict:
+        """Возвращает заголовки условного запроса для страницы
+
+        Args:
+            url (str): URL страницы
+
+        Returns:
+            Dict
+        """
+        meta = self.get_meta(url) or {}
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def read(self, url: str) -> Optional[bytes]:
+        """Возвращает содержимое страницы из кэша
+
+        Args:
+            url (str): URL страницы
+
+        Returns:
+            bytes or None
+        """
+        body_path, _ = self.get_paths(url)
+        try:
+            with gzip.open(body_path) as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def update(self, url: str, status: int, body: bytes, headers: Mapping) -> Optional[bytes]:
+        """Сохраняет ответ сервера в кэш
+
+        Args:
+            url (str): URL страницы
+            status (int): HTTP статус ответа
+            body (bytes): Содержимое ответа
+            headers (Mapping): Заголовки ответа
+
+        Returns:
+            bytes or None: Содержимое страницы или None, если страница не изменилась. Ответ
+                со статусом, кроме 200 и 304, возвращается без изменения кэша
+        """
+        body_path, meta_path = self.get_paths(url)
+        if status == 304:
+            self.touch(body_path, meta_path)
+            return None
+        if status != 200:
+            # страница с ошибкой не должна заменить сохраненную копию
+            return body
+
+        content_hash = hashlib.sha256(body).hexdigest()
+        meta = self.get_meta(url)
+        if meta is not None and meta['hash'] == content_hash:
+            self.touch(body_path, meta_path)
+            return None
+
+        meta = {'url': url, 'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'), 'hash': content_hash}
+        # сжатие выполняется вне блокировки
+        compressed = gzip.compress(body)
+        with self.lock:
+            old_size = self.get_size(body_path, meta_path)
+            body_path.parent.mkdir(exist_ok=True)
+            self.write(body_path, compressed)
+            self.write(meta_path, json.dumps(meta).encode())
+            self.size += self.get_size(body_path, meta_path) - old_size
+            if self.size > self.max_size:
+                self.evict()
+        return body
+
+    def discard(self, url: str):
+        """Удаляет страницу из кэша, например если ее не удалось обработать
+
+        Args:
+            url (str): URL страницы
+        """
+        paths = self.get_paths(url)
+        with self.lock:
+            self.size -= self.get_size(*paths)
+            self.unlink(*paths)
+
+    def evict(self):
+        """Удаляет давно не использованные страницы, пока размер кэша не станет меньше 90%
+        от максимального
+        """
+        with self.lock:
+            entries = sorted(self.path.glob('*/*.gz'), key=lambda path: self.get_mtime(path))
+            for body_path in entries:
+                if self.size <= self.max_size * 0.9:
+                    break
+                self.size -= self.get_size(body_path, body_path.with_suffix('.json'))
+                self.unlink(body_path, body_path.with_suffix('.json'))
+
+    @staticmethod
+    def write(path: Path, data: bytes):
+        # запись через временный файл, чтобы параллельные чтения не видели неполный файл
+        tmp_path = path.with_name(f'{path.name}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def unlink(*paths: Path):
+        for path in paths:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    @staticmethod
+    def touch(*paths: Path):
+        for path in paths:
+            try:
+                path.touch()
+            except OSError:
+                pass
+
+    @staticmethod
+    def get_size(*paths: Path) -> int:
+        size = 0
+        for path in paths:
+            try:
+                size += path.stat().st_size
+            except OSError:
+                pass
+        return size
+
+    @staticmethod
+    def get_mtime(path: Path) -> float:
+        try:
+            return path.stat().st_mtime
+        except OSError:
+            return 0
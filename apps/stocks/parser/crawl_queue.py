@@ -0,0 +1,157 @@
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+from typing import Iterator
+
+from django.db import connections
+
+from apps.stocks.models import CrawlJob
+from . import NasdaqParser
+from .throttling import HostPaused
+
+logger = logging.getLogger(__name__)
+
+
+def get_worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class CrawlQueue:
+    """Очередь заданий загрузки в БД, которую разбирают воркеры на нескольких машинах
+
+    Заданием является одна страница. Страницы цен ставятся в очередь раньше страниц сделок,
+    поэтому обрабатываются первыми. В инкрементальном режиме в очередь ставится только первая
+    страница сделок акции, а следующая добавляется, если на странице были новые сделки.
+
+    Attributes:
+        parser (NasdaqParser): Парсер, который загружает страницы и сохраняет данные
+        worker (str): Имя воркера, по умолчанию хост и pid процесса
+        threads (int): Количество потоков воркера
+        batch_size (int): Количество заданий, которое поток берет за один раз
+        lease (timedelta): Время аренды задания
+        max_attempts (int): Максимальное количество попыток задания
+        poll_interval (float): Пауза в секундах, если свободных заданий нет, но другие воркеры
+            еще не закончили
+    """
+
+    def __init__(self, parser: NasdaqParser, worker: str = None, threads: int = 1,
+                 batch_size: int = 10, lease: float = 300, max_attempts: int = 3,
+                 poll_interval: float = 5):
+        self.parser = parser
+        self.worker = worker or get_worker_name()
+        self.threads = threads
+        self.batch_size = batch_size
+        self.lease = timedelta(seconds=lease)
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+
+    def get_jobs(self) -> Iterator[CrawlJob]:
+        """Возвращает задания для всех страниц парсера
+
+        Returns:
+            Iterator[CrawlJob]
+        """
+        parser = self.parser
+        for stock, url in parser.get_prices_urls():
+            yield CrawlJob(method=CrawlJob.METHODS.PRICES, stock=stock, url=url)
+        if parser.incremental:
+            for stock in parser.stocks:
+                stock, url = parser.get_stock_trades_urls(stock)[0]
+                yield CrawlJob(method=CrawlJob.METHODS.TRADES, stock=stock, url=url)
+        else:
+            for stock, url in parser.get_trades_urls():
+                yield CrawlJob(method=CrawlJob.METHODS.TRADES, stock=stock, url=url)
+
+    def enqueue(self, batch_size: int = 1000) -> int:
+        """Ставит в очередь задания для всех страниц. Уже существующие задания возвращаются
+        в очередь, поэтому новый обход начинается заново. Задания, которые сейчас обрабатывают
+        воркеры, не изменяются
+
+        Args:
+            batch_size (int): Количество заданий в одном запросе
+
+        Returns:
+            int: Количество заданий
+        """
+        count = 0
+        batch = []
+        for job in self.get_jobs():
+            batch.append(job)
+            if len(batch) == batch_size:
+                count += CrawlJob.objects.bulk_upsert(batch)
+                batch = []
+        return count + CrawlJob.objects.bulk_upsert(batch)
+
+    def process(self, job: CrawlJob):
+        """Загружает и сохраняет страницу задания
+
+        Args:
+            job (CrawlJob): Задание
+        """
+        parser = self.parser
+        with parser.discard_on_error(job.url):
+            html = parser.get_html(job.url)
+            if job.method == CrawlJob.METHODS.PRICES:
+                parser.save_stock_prices(job.stock, html)
+                return
+            urls = parser.get_stock_trades_urls(job.stock)
+            if (parser.save_insider_trades(job.stock, html) and parser.incremental
+                    and job.page < len(urls)):
+                stock, url = urls[job.page]
+                # следующая страница, которая уже стоит в очереди или обработана, не сбрасывается
+                CrawlJob.objects.bulk_upsert([CrawlJob(method=job.method, stock=stock, url=url,
+                                                       page=job.page + 1)], update=False)
+
+    def work(self):
+        """Поток воркера: берет задания из очереди, пока в ней есть незавершенные задания"""
+        try:
+            while not self.stopped.is_set():
+                CrawlJob.objects.requeue_expired(self.max_attempts)
+                jobs = CrawlJob.objects.claim(self.worker, self.lease, self.batch_size)
+                if not jobs:
+                    if not CrawlJob.objects.unfinished().exists():
+                        break
+                    self.stopped.wait(self.poll_interval)
+                    continue
+                for job in jobs:
+                    try:
+                        self.process(job)
+                    except HostPaused as error:
+                        # задание возвращается в очередь другим воркерам, а поток ждет паузу
+                        CrawlJob.objects.release(job.id, self.worker)
+                        self.stopped.wait(error.pause)
+                    except Exception as error:
+                        logger.exception('Не удалось обработать %s', job.url)
+                        CrawlJob.objects.fail(job.id, self.worker, error, self.max_attempts)
+                    else:
+                        CrawlJob.objects.complete(job.id, self.worker)
+        finally:
+            connections.close_all()
+
+    def heartbeat(self):
+        """Поток продления аренды заданий воркера"""
+        interval = self.lease.total_seconds() / 3
+        try:
+            while not self.stopped.wait(interval):
+                CrawlJob.objects.heartbeat(self.worker, self.lease)
+        finally:
+            connections.close_all()
+
+    def run(self):
+        """Запускает потоки воркера и дожидается, пока в очереди не останется заданий"""
+        threads = [threading.Thread(target=self.work) for _ in range(self.threads)]
+        heartbeat = threading.Thread(target=self.heartbeat)
+        for thread in threads + [heartbeat]:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        finally:
+            # при прерывании потоки заканчивают взятые задания, а остальные задания вернутся в
+            # очередь по истечении аренды
+            self.stopped.set()
+            for thread in threads + [heartbeat]:
+                thread.join()
@@ -0,0 +1,189 @@
+import time
+from datetime import date, datetime
+from decimal import Decimal
+from typing import List, NamedTuple, Optional, Tuple
+
+import lxml.html
+from bs4 import BeautifulSoup
+from lxml import etree
+
+TITLE_SUFFIXES = ('Common Stock Historical Stock Prices', 'Capital Stock Historical Stock Prices')
+
+
+class PriceRow(NamedTuple):
+    date: datetime
+    open: Decimal
+    high: Decimal
+    low: Decimal
+    close: Decimal
+    volume: int
+
+
+class TradeRow(NamedTuple):
+    insider_name: str
+    relation: str
+    last_date: date
+    transaction_type: str
+    owner_type: str
+    shares_traded: int
+    last_price: Optional[Decimal]
+    shares_held: int
+
+
+def get_company_name(title: str) -> str:
+    """Получает название компании из заголовка страницы с ценами
+
+    Args:
+        title (str): Текст заголовка h1
+
+    Returns:
+        str
+    """
+    for suffix in TITLE_SUFFIXES:
+        title = title.replace(suffix, '').strip()
+    return title
+
+
+def get_number(value: str) -> str:
+    return value.strip().replace(',', '')
+
+
+def get_price_row(cells: List[str]) -> Optional[PriceRow]:
+    """Приводит ячейки строки таблицы цен к типам. Строки без даты пропускаются
+
+    Args:
+        cells (List[str]): Текст ячеек строки
+
+    Returns:
+        PriceRow or None
+    """
+    date_or_time = cells[0].strip()
+    if not date_or_time:
+        return None
+    try:
+        row_date = datetime.strptime(date_or_time, '%m/%d/%Y')
+    except ValueError:
+        time = datetime.strptime(date_or_time, '%H:%M')
+        row_date = datetime.now().replace(hour=time.hour, minute=time.minute, second=0,
+                                          microsecond=0)
+    return PriceRow(
+        row_date, Decimal(get_number(cells[1])), Decimal(get_number(cells[2])),
+        Decimal(get_number(cells[3])), Decimal(get_number(cells[4])), int(get_number(cells[5]))
+    )
+
+
+def get_trade_row(cells: List[str]) -> TradeRow:
+    """Приводит ячейки строки таблицы сделок к типам
+
+    Args:
+        cells (List[str]): Текст ячеек строки
+
+    Returns:
+        TradeRow
+    """
+    last_price = get_number(cells[6])
+    return TradeRow(
+        cells[0].strip(), cells[1].strip(), datetime.strptime(cells[2].strip(), '%m/%d/%Y').date(),
+        cells[3].strip(), cells[4].strip(), int(get_number(cells[5])),
+        Decimal(last_price) if last_price != '' else None, int(get_number(cells[7]))
+    )
+
+
+class LxmlExtractor:
+    """Извлекает строки таблиц .genTable за один проход по дереву lxml
+
+    Ячейки строки берутся одним обходом дочерних элементов, без повторного поиска по
+    селектору для каждой колонки.
+    """
+    gen_table = "//*[contains(concat(' ', normalize-space(@class), ' '), ' genTable ')]"
+    prices_rows = etree.XPath(gen_table + '/div/table/tbody/tr')
+    trades_rows = etree.XPath(gen_table + '/table/tr')
+    title = etree.XPath('(//h1)[1]')
+
+    def get_cells(self, row: etree.ElementBase) -> List[str]:
+        return [cell.text_content() for cell in row.iterchildren('td')]
+
+    def prices(self, html: bytes) -> Tuple[str, List[PriceRow]]:
+        """Извлекает название компании и цены со страницы
+
+        Args:
+            html (bytes): Содержимое страницы
+
+        Returns:
+            Tuple[str, List[PriceRow]]
+        """
+        tree = lxml.html.fromstring(html)
+        title = self.title(tree)
+        rows = (get_price_row(self.get_cells(row)) for row in self.prices_rows(tree))
+        return (get_company_name(title[0].text_content()) if title else '',
+                [row for row in rows if row is not None])
+
+    def trades(self, html: bytes) -> List[TradeRow]:
+        """Извлекает сделки со страницы
+
+        Args:
+            html (bytes): Содержимое страницы
+
+        Returns:
+            List[TradeRow]
+        """
+        tree = lxml.html.fromstring(html)
+        return [get_trade_row(self.get_cells(row)) for row in self.trades_rows(tree)]
+
+
+class SoupExtractor:
+    """Извлекает строки таблиц .genTable через BeautifulSoup"""
+
+    def prices(self, html: bytes) -> Tuple[str, List[PriceRow]]:
+        """Извлекает название компании и цены со страницы
+
+        Args:
+            html (bytes): Содержимое страницы
+
+        Returns:
+            Tuple[str, List[PriceRow]]
+        """
+        content = BeautifulSoup(html, 'lxml')
+        title = content.find('h1')
+        table = content.select('.genTable > div > table > tbody > tr')
+        rows = (get_price_row([cell.text for cell in row.select('td')]) for row in table)
+        return (get_company_name(title.text) if title else '',
+                [row for row in rows if row is not None])
+
+    def trades(self, html: bytes) -> List[TradeRow]:
+        """Извлекает сделки со страницы
+
+        Args:
+            html (bytes): Содержимое страницы
+
+        Returns:
+            List[TradeRow]
+        """
+        content = BeautifulSoup(html, 'lxml')
+        table = content.select('.genTable > table > tr')
+        return [get_trade_row([cell.text for cell in row.select('td')]) for row in table]
+
+
+def extract(extractor, method: str, html: bytes):
+    """Извлекает строки таблицы со страницы заданным экстрактором, а если lxml не смог
+    разобрать страницу, то через BeautifulSoup. Функция не обращается к БД, поэтому ее можно
+    выполнять в пуле процессов
+
+    Args:
+        extractor: Экстрактор строк таблиц
+        method (str): Метод экстрактора (prices или trades)
+        html (bytes): Содержимое страницы
+    """
+    try:
+        return getattr(extractor, method)(html)
+    except etree.LxmlError:
+        return getattr(SoupExtractor(), method)(html)
+
+
+def extract_timed(extractor, method: str, html: bytes) -> Tuple:
+    """То же, что extract, но также возвращает время разбора в секундах, чтобы записать его в
+    метрики процесса, который отправил страницу в пул процессов
+    """
+    start = time.perf_counter()
+    rows = extract(extractor, method, html)
+    return rows, time.perf_counter() - start
@@ -0,0 +1,168 @@
+import os
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterator, NamedTuple, Tuple
+
+from django.db import connections
+
+from apps.stocks import metrics
+from . import NasdaqParser
+from .extractors import extract_timed
+
+
+class Job(NamedTuple):
+    method: str
+    stock: str
+    url: str
+    # urls следующих страниц сделок, которые загружаются, только если на странице были новые
+    # сделки (инкрементальный режим)
+    next_urls: Tuple = ()
+    # задание занимает место в конвейере, продолжения обхода страниц места не занимают
+    slot: bool = True
+
+
+class Pipeline:
+    """Конвейер загрузки Nasdaq.com: загрузка → разбор → запись в БД
+
+    Страницы загружаются в потоках, разбираются в пуле процессов, чтобы разбор не конкурировал
+    за GIL с сетевым вводом-выводом, а записываются в БД несколькими потоками, поэтому
+    соединений с БД столько, сколько потоков записи. Количество страниц, одновременно
+    находящихся в конвейере, ограничено queue_size.
+
+    Attributes:
+        parser (NasdaqParser): Парсер, который загружает страницы и сохраняет данные
+        fetchers (int): Количество потоков загрузки
+        parsers (int): Количество процессов разбора
+        writers (int): Количество потоков записи в БД
+        queue_size (int): Максимальное количество страниц в конвейере
+    """
+
+    def __init__(self, parser: NasdaqParser, fetchers: int = 10, parsers: int = None,
+                 writers: int = 2, queue_size: int = 100):
+        self.parser = parser
+        self.fetchers = fetchers
+        self.parsers = parsers or os.cpu_count()
+        self.writers = writers
+        self.queue_size = queue_size
+        self.jobs = queue.Queue()
+        self.results = queue.Queue(maxsize=queue_size)
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.pending = 0
+        self.done = threading.Condition()
+
+    def get_jobs(self) -> Iterator[Job]:
+        """Возвращает задания на загрузку: сначала страницы цен, затем страницы сделок
+
+        Returns:
+            Iterator[Job]
+        """
+        parser = self.parser
+        for stock, url in parser.get_prices_urls():
+            yield Job('prices', stock, url)
+        if parser.incremental:
+            for stock in parser.stocks:
+                (stock, url), *next_urls = parser.get_stock_trades_urls(stock)
+                yield Job('trades', stock, url, tuple(url for _, url in next_urls))
+        else:
+            for stock, url in parser.get_trades_urls():
+                yield Job('trades', stock, url)
+
+    def add(self, job: Job):
+        with self.done:
+            self.pending += 1
+        self.jobs.put(job)
+
+    def finish(self, job: Job):
+        if job.slot:
+            self.slots.release()
+        with self.done:
+            self.pending -= 1
+            if not self.pending:
+                self.done.notify_all()
+
+    def feed(self):
+        for job in self.get_jobs():
+            self.slots.acquire()
+            self.add(job)
+
+    def fetch(self, pool: ProcessPoolExecutor):
+        """Поток загрузки: загружает страницы и отправляет их на разбор в пул процессов
+
+        Args:
+            pool (ProcessPoolExecutor): Пул процессов разбора
+        """
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                html = self.parser.get_html(job.url)
+            except Exception as error:
+                self.parser.record_failure(job.method, job.stock, job.url, error)
+                self.finish(job)
+                continue
+            if html is None:
+                self.finish(job)
+                continue
+            future = pool.submit(extract_timed, self.parser.extractor, job.method, html)
+            self.results.put((job, future))
+
+    def write(self):
+        """Поток записи: дожидается результата разбора и записывает строки в БД"""
+        try:
+            while True:
+                item = self.results.get()
+                if item is None:
+                    break
+                job, future = item
+                try:
+                    self.write_job(job, future)
+                except Exception as error:
+                    self.parser.record_failure(job.method, job.stock, job.url, error)
+                finally:
+                    self.finish(job)
+        finally:
+            connections.close_all()
+
+    def write_job(self, job: Job, future: Future):
+        """Записывает результат разбора страницы в БД. Если на странице сделок были новые
+        сделки, то добавляет в конвейер следующую страницу
+
+        Args:
+            job (Job): Задание
+            future (Future): Результат разбора страницы в пуле процессов
+        """
+        parser = self.parser
+        with parser.discard_on_error(job.url):
+            rows, seconds = future.result()
+            metrics.parse_seconds.observe(seconds, method=job.method)
+            if job.method == 'prices':
+                company_name, rows = rows
+                parser.write_stock_prices(job.stock, company_name, rows)
+            elif parser.write_insider_trades(job.stock, rows) and job.next_urls:
+                self.add(Job(job.method, job.stock, job.next_urls[0], job.next_urls[1:],
+                             slot=False))
+
+    def run(self):
+        """Запускает все стадии и дожидается обработки всех страниц"""
+        with ProcessPoolExecutor(self.parsers) as pool:
+            fetchers = [threading.Thread(target=self.fetch, args=(pool,))
+                        for _ in range(self.fetchers)]
+            writers = [threading.Thread(target=self.write) for _ in range(self.writers)]
+            for thread in fetchers + writers:
+                thread.start()
+
+            try:
+                self.feed()
+                with self.done:
+                    self.done.wait_for(lambda: not self.pending)
+            finally:
+                for _ in fetchers:
+                    self.jobs.put(None)
+                for thread in fetchers:
+                    thread.join()
+                for _ in writers:
+                    self.results.put(None)
+                for thread in writers:
+                    thread.join()
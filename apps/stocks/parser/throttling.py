@@ -0,0 +1,268 @@
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+from urllib.parse import urlsplit
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+SUCCESS_STATUSES = tuple(range(200, 300)) + (304,)
+THROTTLE_STATUSES = (429, 503)
+
+
+class FetchError(Exception):
+    """Страницу не удалось загрузить после всех попыток"""
+
+
+class HostPaused(FetchError):
+    """Запросы к хосту приостановлены. Страница не ждет окончания паузы, а возвращается
+    вызывающему коду, который записывает ее в журнал или возвращает в очередь заданий
+
+    Attributes:
+        pause (float): Оставшееся время паузы, секунды
+    """
+
+    def __init__(self, message: str, pause: float):
+        super().__init__(message)
+        self.pause = pause
+
+
+class RateLimiter:
+    """Token bucket, скорость которого подстраивается под ответы сервера
+
+    Скорость уменьшается вдвое на ответы 429/503 и на 10% при задержке ответа больше
+    target_latency, а при быстрых успешных ответах постепенно растет до max_rate.
+
+    Attributes:
+        rate (float): Текущая скорость, запросов в секунду
+        min_rate (float): Минимальная скорость
+        max_rate (float): Максимальная скорость
+        burst (int): Размер корзины
+        target_latency (float): Задержка ответа, при превышении которой скорость снижается
+    """
+
+    def __init__(self, rate: float = 10, min_rate: float = 0.5, max_rate: float = 50,
+                 burst: int = 10, target_latency: float = 2):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.target_latency = target_latency
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Резервирует токен на запрос
+
+        Returns:
+            float: Время в секундах, через которое можно отправить запрос
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate)
+
+    def update(self, status: Optional[int], latency: float):
+        """Подстраивает скорость под результат запроса
+
+        Args:
+            status (int): HTTP статус ответа или None, если ответа нет
+            latency (float): Время выполнения запроса в секундах
+        """
+        with self.lock:
+            if status in THROTTLE_STATUSES:
+                self.rate = max(self.min_rate, self.rate / 2)
+            elif status is None or latency > self.target_latency:
+                self.rate = max(self.min_rate, self.rate * 0.9)
+            else:
+                self.rate = min(self.max_rate, self.rate + 0.1)
+
+
+class CircuitBreaker:
+    """Приостанавливает запросы к хосту после нескольких неудачных запросов подряд
+
+    Attributes:
+        threshold (int): Количество неудачных запросов подряд, после которого хост
+            приостанавливается
+        pause (float): Длительность паузы в секундах
+    """
+
+    def __init__(self, threshold: int = 5, pause: float = 30):
+        self.threshold = threshold
+        self.pause = pause
+        self.failures = {}
+        self.paused_until = {}
+        self.lock = threading.Lock()
+
+    def get_pause(self, host: str) -> float:
+        """Возвращает оставшееся время паузы хоста
+
+        Args:
+            host (str): Хост
+
+        Returns:
+            float: Время в секундах
+        """
+        return max(0, self.paused_until.get(host, 0) - time.monotonic())
+
+    def update(self, host: str, success: bool):
+        """Учитывает результат запроса к хосту
+
+        Args:
+            host (str): Хост
+            success (bool): Запрос выполнен успешно
+        """
+        with self.lock:
+            if success:
+                self.failures[host] = 0
+                return
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] >= self.threshold:
+                self.failures[host] = 0
+                self.paused_until[host] = time.monotonic() + self.pause
+
+
+class Throttle:
+    """Ограничение скорости, повторные попытки и приостановка хостов для загрузки страниц
+
+    Перед запросом вызывается get_delay, а после запроса check, который решает, можно ли
+    использовать ответ или запрос нужно повторить. Ответы, кроме 2xx и 304, считаются ошибкой:
+    ответы 4xx, кроме 429, не повторяются, а остальные ошибки повторяются с экспоненциальной
+    задержкой со случайной составляющей. Пока хост приостановлен, запросы к нему не
+    отправляются: get_delay выбрасывает HostPaused, и поток сразу переходит к следующей
+    странице.
+
+    Attributes:
+        limiter (RateLimiter): Ограничение скорости или None
+        breaker (CircuitBreaker): Приостановка хостов
+        retries (int): Количество повторных попыток
+        backoff (float): Базовая задержка перед повторной попыткой в секундах
+        max_backoff (float): Максимальная задержка перед повторной попыткой в секундах
+    """
+
+    def __init__(self, limiter: RateLimiter = None, breaker: CircuitBreaker = None,
+                 retries: int = 3, backoff: float = 1, max_backoff: float = 60):
+        self.limiter = limiter
+        self.breaker = breaker or CircuitBreaker()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def get_delay(self, url: str) -> float:
+        """Возвращает время в секундах, через которое можно отправить запрос
+
+        Args:
+            url (str): URL страницы
+
+        Returns:
+            float
+
+        Raises:
+            HostPaused: Если запросы к хосту приостановлены
+        """
+        host = urlsplit(url).netloc
+        pause = self.breaker.get_pause(host)
+        if pause > 0:
+            raise HostPaused(f'{url}: запросы к {host} приостановлены на {pause:.0f} с', pause)
+        return self.limiter.reserve() if self.limiter is not None else 0
+
+    def check(self, url: str, attempt: int, latency: float, status: int = None,
+              error: Exception = None, retry_after: str = None) -> Optional[float]:
+        """Учитывает результат запроса
+
+        Args:
+            url (str): URL страницы
+            attempt (int): Номер попытки, начиная с 0
+            latency (float): Время выполнения запроса в секундах
+            status (int): HTTP статус ответа или None, если ответа нет
+            error (Exception): Ошибка запроса
+            retry_after (str): Заголовок Retry-After
+
+        Returns:
+            float or None: Задержка перед повторной попыткой или None, если ответ можно
+                использовать
+
+        Raises:
+            FetchError: Если попытки исчерпаны или ответ с ошибкой, которую нет смысла
+                повторять (4xx, кроме 429)
+        """
+        success = error is None and status in SUCCESS_STATUSES
+        if self.limiter is not None:
+            self.limiter.update(status, latency)
+        self.breaker.update(urlsplit(url).netloc, success)
+        if success:
+            return None
+        if attempt >= self.retries or (error is None and status not in RETRY_STATUSES
+                                       and 400 <= status < 500):
+            raise FetchError(f'{url}: {error or status}') from error
+
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(self.max_backoff, int(retry_after)))
+        return delay
+
+
+class FailedJournal:
+    """Журнал страниц, которые не удалось обработать. Страницы из журнала можно обработать
+    повторно при следующем запуске
+
+    Attributes:
+        path (str): Путь к файлу журнала, одна запись JSON на строку
+        output (str): Файл, в который записываются новые страницы
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.output = path
+        self.lock = threading.Lock()
+
+    def add(self, method: str, stock: str, url: str, error: Exception):
+        """Добавляет страницу в журнал
+
+        Args:
+            method (str): Тип страницы (prices или trades)
+            stock (str): Название акции
+            url (str): URL страницы
+            error (Exception): Ошибка
+        """
+        entry = json.dumps({'method': method, 'stock': stock, 'url': url, 'error': repr(error)})
+        with self.lock, open(self.output, 'a') as file:
+            file.write(entry + '\n')
+
+    def read(self) -> List[Tuple[str, str, str]]:
+        """Возвращает страницы из журнала без повторов, журнал не изменяется
+
+        Returns:
+            List[Tuple[str, str, str]]: Тип страницы, название акции и url
+        """
+        try:
+            with open(self.path) as file:
+                entries = [json.loads(line) for line in file if line.strip()]
+        except FileNotFoundError:
+            entries = []
+        entries = {(entry['method'], entry['stock'], entry['url']): None for entry in entries}
+        return list(entries)
+
+    @contextmanager
+    def replacing(self):
+        """Контекстный менеджер повторной обработки страниц журнала: новые ошибки записываются
+        во временный файл, который заменяет журнал только после успешного завершения. Если
+        обработка прервана, то журнал остается прежним и страницы из него не теряются
+        """
+        output = f'{self.path}.new'
+        open(output, 'w').close()
+        self.output = output
+        try:
+            yield self
+        except BaseException:
+            os.remove(output)
+            raise
+        else:
+            os.replace(output, self.path)
+        finally:
+            self.output = self.path
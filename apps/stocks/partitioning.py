@@ -0,0 +1,156 @@
+from datetime import date
+from typing import List, Optional
+
+from django.db import connections, transaction
+
+from .models import Price
+
+SCHEMES = ('year', 'stock')
+
+
+def get_partitions(using: str = 'default') -> List[str]:
+    """Функция, которая возвращает секции таблицы цен
+
+    Args:
+        using (str): БД
+
+    Returns:
+        List[str]: Названия секций или пустой список, если таблица не секционирована
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute('''
+            SELECT child.relname FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = %s ORDER BY child.relname
+        ''', [Price._meta.db_table])
+        return [name for name, in cursor.fetchall()]
+
+
+def rebuild_price_table(scheme: Optional[str], partitions: int = 16, years_ahead: int = 5,
+                        using: str = 'default'):
+    """Функция, которая пересоздает таблицу цен секционированной по году цены (year) или по
+    хэшу акции (stock), либо обычной таблицей (None), и переносит в нее цены
+
+    Ограничения и индексы создаются заново с прежними названиями, поэтому миграции Django
+    находят их как обычно. Для секционированной таблицы в первичный ключ добавляется ключ
+    секционирования, а индексы создаются в каждой секции. Секции по годам создаются от
+    первой цены до years_ahead лет вперед, остальные даты попадают в секцию по умолчанию.
+
+    Args:
+        scheme (str): year, stock или None
+        partitions (int): Количество секций по хэшу акции
+        years_ahead (int): Количество будущих лет, для которых создаются секции
+        using (str): БД
+    """
+    if scheme is not None and scheme not in SCHEMES:
+        raise ValueError(f'Unknown partitioning: {scheme}')
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = Price._meta.db_table
+    old_table = f'{table}_old'
+    pk = Price._meta.pk.column
+    key = {'year': 'date', 'stock': 'stock_id'}.get(scheme)
+    old_partitions = get_partitions(using)
+
+    with transaction.atomic(using), connection.cursor() as cursor:
+        # ALTER TABLE невозможен, пока не проверены отложенные внешние ключи
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        constraints = connection.introspection.get_constraints(cursor, table)
+        cursor.execute(f'SELECT min(date), max(date) FROM {qn(table)}')
+        first_date, last_date = cursor.fetchone()
+
+        cursor.execute(f'ALTER SEQUENCE {qn(f"{table}_{pk}_seq")} OWNED BY NONE')
+        cursor.execute(f'ALTER TABLE {qn(table)} RENAME TO {qn(old_table)}')
+        # названия секций освобождаются для секций новой таблицы
+        for partition in old_partitions:
+            cursor.execute(f'ALTER TABLE {qn(partition)} RENAME TO {qn(f"{partition}_old")}')
+        partition_by = ''
+        if scheme == 'year':
+            partition_by = ' PARTITION BY RANGE (date)'
+        elif scheme == 'stock':
+            partition_by = ' PARTITION BY HASH (stock_id)'
+        cursor.execute(f'CREATE TABLE {qn(table)} (LIKE {qn(old_table)} INCLUDING DEFAULTS '
+                       f'INCLUDING CONSTRAINTS){partition_by}')
+
+        if scheme == 'year':
+            current_year = date.today().year
+            first_year = first_date.year if first_date else current_year
+            last_year = max(last_date.year if last_date else current_year, current_year)
+            for year in range(first_year, last_year + years_ahead + 1):
+                create_year_partition(cursor, qn, table, year)
+            cursor.execute(f'CREATE TABLE {qn(f"{table}_default")} PARTITION OF {qn(table)} '
+                           f'DEFAULT')
+        elif scheme == 'stock':
+            for remainder in range(partitions):
+                cursor.execute(f'CREATE TABLE {qn(f"{table}_p{remainder}")} PARTITION OF '
+                               f'{qn(table)} FOR VALUES WITH (MODULUS {partitions}, '
+                               f'REMAINDER {remainder})')
+
+        cursor.execute(f'INSERT INTO {qn(table)} SELECT * FROM {qn(old_table)}')
+        cursor.execute(f'DROP TABLE {qn(old_table)}')
+        cursor.execute(f'ALTER SEQUENCE {qn(f"{table}_{pk}_seq")} OWNED BY '
+                       f'{qn(table)}.{qn(pk)}')
+
+        for name, constraint in constraints.items():
+            columns = ', '.join(qn(column) for column in constraint['columns'])
+            if constraint['primary_key']:
+                columns = ', '.join(qn(column) for column in [pk] + ([key] if key else []))
+                cursor.execute(f'ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(name)} '
+                               f'PRIMARY KEY ({columns})')
+            elif constraint['foreign_key']:
+                to_table, to_column = constraint['foreign_key']
+                cursor.execute(f'ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(name)} '
+                               f'FOREIGN KEY ({columns}) REFERENCES {qn(to_table)} '
+                               f'({qn(to_column)}) DEFERRABLE INITIALLY DEFERRED')
+            elif constraint['unique']:
+                cursor.execute(f'ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(name)} '
+                               f'UNIQUE ({columns})')
+            elif constraint['index']:
+                cursor.execute(f'CREATE INDEX {qn(name)} ON {qn(table)} ({columns})')
+        cursor.execute(f'ANALYZE {qn(table)}')
+        cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+
+
+def create_year_partition(cursor, qn, table: str, year: int):
+    cursor.execute(f'CREATE TABLE {qn(f"{table}_y{year}")} PARTITION OF {qn(table)} '
+                   f"FOR VALUES FROM ('{year}-01-01 00:00+00') TO ('{year + 1}-01-01 00:00+00')")
+
+
+def add_year_partitions(until_year: int, using: str = 'default') -> List[int]:
+    """Функция, которая добавляет секции таблицы цен по годам до until_year включительно.
+    Цены этих лет переносятся из секции по умолчанию в новые секции
+
+    Args:
+        until_year (int): Последний год
+        using (str): БД
+
+    Returns:
+        List[int]: Годы добавленных секций
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = Price._meta.db_table
+    partitions = set(get_partitions(using))
+    years = [int(name[len(table) + 2:]) for name in partitions
+             if name.startswith(f'{table}_y')]
+    if not years:
+        raise ValueError('Prices aren\'t partitioned by year')
+    added = [year for year in range(min(years), until_year + 1)
+             if f'{table}_y{year}' not in partitions]
+    if not added:
+        return added
+
+    default = f'{table}_default'
+    with transaction.atomic(using), connection.cursor() as cursor:
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        cursor.execute(f'ALTER TABLE {qn(table)} DETACH PARTITION {qn(default)}')
+        for year in added:
+            create_year_partition(cursor, qn, table, year)
+            bounds = [f'{year}-01-01 00:00+00', f'{year + 1}-01-01 00:00+00']
+            cursor.execute(f'INSERT INTO {qn(table)} SELECT * FROM {qn(default)} '
+                           f'WHERE date >= %s AND date < %s', bounds)
+            cursor.execute(f'DELETE FROM {qn(default)} WHERE date >= %s AND date < %s', bounds)
+        cursor.execute(f'ALTER TABLE {qn(table)} ATTACH PARTITION {qn(default)} DEFAULT')
+        cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+    return added
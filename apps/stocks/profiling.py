@@ -0,0 +1,306 @@
+import cProfile
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import connection
+from django.http import FileResponse, Http404
+from django.shortcuts import render
+from django.template.defaultfilters import slugify
+from django.utils.crypto import constant_time_compare
+
+# файлы профиля: статистика cProfile, стеки в формате flamegraph.pl/speedscope и описание с SQL
+FORMATS = {
+    'prof': 'application/octet-stream',
+    'folded': 'text/plain; charset=utf-8',
+    'json': 'application/json',
+}
+PROFILE_ID = re.compile(r'^[\w-]+$')
+
+
+class StackSampler:
+    """Поток, который с интервалом interval снимает стек потока thread_id и считает
+    одинаковые стеки. В отличие от cProfile стеки содержат весь путь вызова, поэтому по ним
+    строится flame graph
+
+    Attributes:
+        thread_id (int): Идентификатор потока
+        interval (float): Интервал снятия стека, секунды
+        stacks (Counter): Количество снятий каждого стека
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{frame.f_globals.get("__name__", "?")}:{code.co_name}:'
+                             f'{code.co_firstlineno}')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+class Profiler:
+    """Профилирование отдельных запросов и записей парсера в БД по выборке
+
+    Для каждого профиля сохраняются статистика cProfile (.prof, открывается pstats, snakeviz),
+    стеки потока в формате collapsed stacks (.folded, flamegraph.pl, speedscope) и описание
+    (.json): время выполнения, самые долгие функции и выполненные SQL запросы с временем.
+    Профили пишутся в директорию directory, а самые старые удаляются, когда ее размер
+    превышает max_size.
+
+    Attributes:
+        directory (str): Директория профилей, None - профилирование выключено
+        max_size (int): Максимальный размер директории, байты
+        rate (float): Доля профилируемых запросов к сайту
+        ingest_rate (float): Доля профилируемых записей парсера в БД
+        token (str): Значение заголовка X-Profile, при котором запрос профилируется всегда
+        interval (float): Интервал снятия стека, секунды
+    """
+
+    def __init__(self, directory: Optional[str], max_size: int, rate: float = 0,
+                 ingest_rate: float = 0, token: Optional[str] = None, interval: float = 0.005):
+        self.directory = directory
+        self.max_size = max_size
+        self.rate = rate
+        self.ingest_rate = ingest_rate
+        self.token = token
+        self.interval = interval
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def sampled(self, rate: float) -> bool:
+        return self.enabled and rate > 0 and random.random() < rate
+
+    @contextmanager
+    def profile(self, name: str, **info):
+        """Контекстный менеджер, который профилирует код в текущем потоке и сохраняет профиль.
+        Вложенный профиль не создается
+
+        Args:
+            name (str): Название профиля
+            info: Дополнительные поля описания
+
+        Yields:
+            Dict: Описание профиля, в которое можно добавить поля до его сохранения
+        """
+        if getattr(self.local, 'active', False):
+            yield info
+            return
+        queries = []
+
+        def record(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries.append({'sql': sql, 'params': params, 'many': many,
+                                'time': time.perf_counter() - start})
+
+        profile = cProfile.Profile()
+        sampler = StackSampler(threading.get_ident(), self.interval)
+        self.local.active = True
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(record), sampler:
+                profile.enable()
+                try:
+                    yield info
+                finally:
+                    profile.disable()
+        finally:
+            self.local.active = False
+            info.update(name=name, duration=time.perf_counter() - start, queries=queries)
+            self.save(profile, sampler, info)
+
+    def save(self, profile: cProfile.Profile, sampler: StackSampler, info: Dict):
+        """Записывает файлы профиля и удаляет старые профили
+
+        Args:
+            profile (cProfile.Profile): Статистика cProfile
+            sampler (StackSampler): Стеки потока
+            info (Dict): Описание профиля
+        """
+        created = datetime.now()
+        name = slugify(info['name'].replace('/', ' '))[:50]
+        profile_id = f'{created:%Y%m%d-%H%M%S-%f}-{name}'
+        info.update(id=profile_id, created=created.isoformat(),
+                    query_time=sum(query['time'] for query in info['queries']),
+                    functions=self.get_functions(profile))
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, profile_id)
+        profile.dump_stats(f'{path}.prof')
+        with open(f'{path}.folded', 'w') as file:
+            file.write(sampler.folded())
+        # описание пишется последним: профиль без него не попадает в список
+        with open(f'{path}.json', 'w') as file:
+            json.dump(info, file, default=str)
+        self.prune()
+
+    @staticmethod
+    def get_functions(profile: cProfile.Profile, limit: int = 20) -> List[Dict]:
+        """Возвращает функции с наибольшим временем выполнения с учетом вложенных вызовов"""
+        stats = pstats.Stats(profile).stats
+        functions = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+        return [
+            {'function': f'{filename}:{line}({function})', 'calls': calls,
+             'own_time': own_time, 'time': total_time}
+            for (filename, line, function), (_, calls, own_time, total_time, _)
+            in functions
+        ]
+
+    def prune(self):
+        """Удаляет самые старые профили, пока размер директории больше max_size"""
+        with self.lock:
+            sizes = Counter()
+            for entry in os.scandir(self.directory):
+                sizes[entry.name.rsplit('.', 1)[0]] += entry.stat().st_size
+            total = sum(sizes.values())
+            # идентификатор начинается со времени создания
+            for profile_id in sorted(sizes):
+                if total <= self.max_size:
+                    break
+                for extension in FORMATS:
+                    path = os.path.join(self.directory, f'{profile_id}.{extension}')
+                    if os.path.exists(path):
+                        os.remove(path)
+                total -= sizes[profile_id]
+
+    def get_profiles(self) -> List[Dict]:
+        """Возвращает описания профилей от новых к старым без SQL запросов и функций
+
+        Returns:
+            List[Dict]
+        """
+        if not self.enabled or not os.path.isdir(self.directory):
+            return []
+        profiles = []
+        for entry in sorted(os.scandir(self.directory), key=lambda entry: entry.name,
+                            reverse=True):
+            if entry.name.endswith('.json'):
+                info = self.get_profile(entry.name[:-5])
+                if info is not None:
+                    info['query_count'] = len(info.pop('queries'))
+                    del info['functions']
+                    profiles.append(info)
+        return profiles
+
+    def get_profile(self, profile_id: str) -> Optional[Dict]:
+        try:
+            with open(os.path.join(self.directory, f'{profile_id}.json')) as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+profiler = Profiler(
+    getattr(settings, 'PROFILING_DIR', None),
+    max_size=getattr(settings, 'PROFILING_MAX_SIZE', 100) * 1024 ** 2,
+    rate=getattr(settings, 'PROFILING_RATE', 0),
+    ingest_rate=getattr(settings, 'PROFILING_INGEST_RATE', 0),
+    token=getattr(settings, 'PROFILING_TOKEN', None),
+)
+
+
+@contextmanager
+def ingest_profile(stage: str):
+    """Контекстный менеджер, который профилирует долю ingest_rate записей парсера в БД
+
+    Args:
+        stage (str): Этап записи (prices или trades)
+    """
+    if not profiler.sampled(profiler.ingest_rate):
+        yield
+        return
+    with profiler.profile(f'ingest {stage}', stage=stage):
+        yield
+
+
+class ProfilingMiddleware:
+    """Middleware, которое профилирует долю rate запросов и запросы с заголовком X-Profile,
+    равным PROFILING_TOKEN. Отдача потокового ответа не профилируется
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not self.requested(request):
+            return self.get_response(request)
+        with profiler.profile(request.path, method=request.method,
+                              query=request.GET.urlencode()) as info:
+            response = self.get_response(request)
+            match = getattr(request, 'resolver_match', None)
+            info.update(view=match.view_name if match is not None else None,
+                        status=response.status_code)
+        return response
+
+    @staticmethod
+    def requested(request) -> bool:
+        if not profiler.enabled:
+            return False
+        header = request.META.get('HTTP_X_PROFILE')
+        if header and profiler.token and constant_time_compare(header, profiler.token):
+            return True
+        return profiler.sampled(profiler.rate)
+
+
+@staff_member_required
+def profiles_view(request):
+    return render(request, 'stocks/profiles.html', {'profiles': profiler.get_profiles()})
+
+
+@staff_member_required
+def profile_view(request, profile_id: str):
+    info = profiler.get_profile(profile_id) if PROFILE_ID.match(profile_id) else None
+    if info is None:
+        raise Http404
+    info['queries'].sort(key=lambda query: query['time'], reverse=True)
+    return render(request, 'stocks/profile_detail.html', {'profile': info, 'formats': FORMATS})
+
+
+@staff_member_required
+def profile_file_view(request, profile_id: str, profile_format: str):
+    if not PROFILE_ID.match(profile_id) or profile_format not in FORMATS:
+        raise Http404
+    path = os.path.join(profiler.directory or '', f'{profile_id}.{profile_format}')
+    if not profiler.enabled or not os.path.isfile(path):
+        raise Http404
+    response = FileResponse(open(path, 'rb'), content_type=FORMATS[profile_format])
+    response['Content-Disposition'] = f'attachment; filename="{profile_id}.{profile_format}"'
+    return response
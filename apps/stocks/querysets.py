@@ -1,30 +1,189 @@
-from django.db import models
-from django.db.models import Window, F, Q, Value, DecimalField
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from django.db import models, connections, transaction
+from django.db.models import Window, F, Q, Value, DecimalField, Case, When
 from django.db.models.functions import Lag
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+
+def get_day_range(value: Optional[str]) -> Optional[Tuple[datetime, datetime]]:
+    """Функция, которая возвращает начало дня и начало следующего дня в текущем часовом поясе
+
+    Args:
+        value (str): Дата в формате ГГГГ-ММ-ДД
+
+    Returns:
+        Tuple[datetime, datetime] or None: Границы дня или None, если дата неверная
+    """
+    try:
+        day = parse_date(value or '')
+    except ValueError:
+        return None
+    if day is None:
+        return None
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    return start, timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min))
+
+
+class BulkUpsertQuerySet(models.QuerySet):
+    """QuerySet с пакетной записью по естественному ключу
+
+    Attributes:
+        upsert_key (tuple): Поля уникального ограничения, по которому определяется конфликт
+        upsert_fields (tuple): Поля, обновляемые при конфликте. Если не указаны, существующие
+            записи не изменяются
+    """
+    upsert_key = ()
+    upsert_fields = ()
+
+    def get_upsert_condition(self, table: str) -> str:
+        """Возвращает дополнительное условие SQL, при котором существующая запись обновляется
+
+        Args:
+            table (str): Название таблицы в кавычках
 
+        Returns:
+            str: Условие или пустая строка
+        """
+        return ''
+
+    def bulk_upsert(self, objs: Iterable, batch_size: int = 1000, update: bool = True) -> int:
+        """Метод для пакетной записи объектов. Объекты вставляются одним запросом на пачку, а
+        существующие по upsert_key записи обновляются, если значения изменились
+
+        Args:
+            objs (Iterable[Model]): Несохраненные объекты
+            batch_size (int): Количество строк в одном запросе
+            update (bool): Обновлять ли существующие записи
+
+        Returns:
+            int: Количество вставленных или обновленных строк
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        key_fields = [opts.get_field(name) for name in self.upsert_key]
+        update_fields = [opts.get_field(name) for name in self.upsert_fields] if update else []
+        fields = [field for field in opts.concrete_fields if not field.primary_key]
+
+        # один запрос не может затронуть строку дважды, поэтому оставляем последний объект
+        # для каждого ключа, а сортировка по ключу задает одинаковый порядок блокировок для
+        # параллельных запросов
+        objs = {tuple(getattr(obj, field.attname) for field in key_fields): obj for obj in objs}
+        objs = [objs[key] for key in sorted(objs)]
+
+        table = qn(opts.db_table)
+        sql = 'INSERT INTO {table} ({columns}) VALUES {{rows}} ON CONFLICT ({key}) '.format(
+            table=table, columns=', '.join(qn(field.column) for field in fields),
+            key=', '.join(qn(field.column) for field in key_fields)
+        )
+        if update_fields:
+            columns = [qn(field.column) for field in update_fields]
+            sql += 'DO UPDATE SET {updates} WHERE ({current}) IS DISTINCT FROM ({excluded})'.format(
+                updates=', '.join(f'{column} = EXCLUDED.{column}' for column in columns),
+                current=', '.join(f'{table}.{column}' for column in columns),
+                excluded=', '.join(f'EXCLUDED.{column}' for column in columns),
+            )
+            condition = self.get_upsert_condition(table)
+            if condition:
+                sql += f' AND {condition}'
+        else:
+            sql += 'DO NOTHING'
+        placeholder = f'({", ".join(["%s"] * len(fields))})'
 
-class PriceQuerySet(models.QuerySet):
+        count = 0
+        with connection.cursor() as cursor:
+            for start in range(0, len(objs), batch_size):
+                batch = objs[start:start + batch_size]
+                params = [field.get_db_prep_save(getattr(obj, field.attname), connection)
+                          for obj in batch for field in fields]
+                cursor.execute(sql.format(rows=', '.join([placeholder] * len(batch))), params)
+                count += cursor.rowcount
+        return count
+
+
+class PriceQuerySet(BulkUpsertQuerySet):
+    upsert_key = ('stock', 'date')
+    upsert_fields = ('open', 'high', 'low', 'close', 'volume')
+    price_types = ('open', 'high', 'low', 'close', 'volume')
+
+    def update_deltas(self, stock_id: int, date_from: datetime = None) -> int:
+        """Метод для пересчета сохраненных изменений цен акции, начиная с date_from
+
+        Изменения считаются одним запросом от последней цены перед date_from, а накопленная
+        сумма продолжается от ее сохраненного значения, поэтому после записи новых цен
+        пересчитываются только они. Без date_from пересчитываются все цены акции.
+
+        Args:
+            stock_id (int): Id акции
+            date_from (datetime): Дата первой измененной цены
+
+        Returns:
+            int: Количество обновленных цен
+        """
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        types = self.price_types
+        sql = f'''
+            WITH anchor AS (
+                SELECT date, {', '.join(f'cum_delta_{t}' for t in types)} FROM {table}
+                WHERE stock_id = %(stock_id)s AND date < %(date_from)s
+                ORDER BY date DESC LIMIT 1
+            ), deltas AS (
+                SELECT id, date, {', '.join(f'{t} - LAG({t}, 1, {t}) OVER w AS delta_{t}'
+                                            for t in types)}
+                FROM {table}
+                WHERE stock_id = %(stock_id)s
+                    AND date >= COALESCE((SELECT date FROM anchor), %(date_from)s)
+                WINDOW w AS (ORDER BY date)
+            ), sums AS (
+                SELECT id, date, {', '.join(f'delta_{t}' for t in types)},
+                    {', '.join(f'SUM(ABS(delta_{t})) OVER w AS sum_{t}' for t in types)}
+                FROM deltas
+                WINDOW w AS (ORDER BY date)
+            )
+            UPDATE {table} p SET {', '.join(
+                f'bar_delta_{t} = s.delta_{t}, cum_delta_{t} = '
+                f'COALESCE((SELECT cum_delta_{t} FROM anchor), 0) + s.sum_{t}' for t in types
+            )}
+            FROM sums s
+            WHERE p.id = s.id AND s.date >= %(date_from)s
+        '''
+        if date_from is None:
+            date_from = datetime.min.replace(tzinfo=timezone.utc)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, {'stock_id': stock_id, 'date_from': date_from})
+            return cursor.rowcount
 
     def with_delta(self):
+        """Метод для получения изменения цен относительно предыдущей цены той же акции"""
         qs = self.annotate(
             prev_open=Window(
                 expression=Lag('open', default=F('open')),
+                partition_by=F('stock_id'),
                 order_by=F('date').asc(),
             ),
             prev_high=Window(
                 expression=Lag('high', default=F('high')),
+                partition_by=F('stock_id'),
                 order_by=F('date').asc(),
             ),
             prev_low=Window(
                 expression=Lag('low', default=F('low')),
+                partition_by=F('stock_id'),
                 order_by=F('date').asc(),
             ),
             prev_close=Window(
                 expression=Lag('close', default=F('close')),
+                partition_by=F('stock_id'),
                 order_by=F('date').asc(),
             ),
             prev_volume=Window(
                 expression=Lag('volume', default=F('volume')),
+                partition_by=F('stock_id'),
                 order_by=F('date').asc(),
             )
         )
@@ -38,33 +197,214 @@ class PriceQuerySet(models.QuerySet):
         return qs
 
     def get_delta_between_dates(self, request):
-        """Метод для получения разницы цен в датах
+        """Метод для получения разницы цен в датах. Даты задаются диапазонами времени, а не
+        приведением даты цены к дню, поэтому условие использует индексы (stock, date) и
+        отсекает лишние секции таблицы цен
         """
         get_params = request.GET
-        date_from = get_params.get('date_from')
-        date_to = get_params.get('date_to')
-        return self.with_delta().filter(Q(date__date=date_from) | Q(date__date=date_to))
+        dates = Q()
+        for param in ('date_from', 'date_to'):
+            day_range = get_day_range(get_params.get(param))
+            if day_range is None:
+                return self.none()
+            dates |= Q(date__gte=day_range[0], date__lt=day_range[1])
+        return self.with_delta().filter(dates)
 
-    def get_prices_for_delta(self, request):
+    def get_prices_for_delta(self, value: str, price_type: str, name: str):
         """Метод для получения цен в интервале, когда цена изменилась более чем на указанное
-        число
+        число. Период ищется по колонкам цен акции из кэша
+
+        Args:
+            value (str): Значение, на которое изменилась цена
+            price_type (str): Тип цены
+            name (str): Название акции
         """
-        from .utils import get_min_period_with_delta_price
-        qs = self.with_delta()
-        get_params = request.GET
-        value = get_params.get('value')
-        price_type = get_params.get('type')
-        data = get_min_period_with_delta_price(qs, value, price_type)
+        from .series import price_series
+        series = price_series.get(name)
+        data = series.get_min_period(price_type, Decimal(value)) if series is not None else None
         if data:
             period = sorted(data['period'])
             absolute_delta = data['absolute_delta']
-            return qs.filter(date__gte=period[0], date__lte=period[1]).annotate(
+            return self.filter(date__gte=period[0], date__lte=period[1]).annotate(
                 absolute_delta=Value(absolute_delta, output_field=DecimalField())
             )
-        return qs.none()
+        return self.none()
+
+    def get_periods_for_deltas(self, values: Sequence[str], price_types: Sequence[str],
+                               name: str) -> Dict:
+        """Метод для получения минимальных периодов сразу для нескольких значений и типов цены.
+        Периоды ищутся по колонкам цен акции из кэша, а цены всех найденных периодов
+        загружаются одним запросом
+
+        Args:
+            values (Sequence[str]): Значения, на которые изменилась цена
+            price_types (Sequence[str]): Типы цены
+            name (str): Название акции
+
+        Returns:
+            Dict: Периоды по значению и типу цены. Для каждого периода указаны даты,
+                изменение цены, количество дней и цены за период, или None, если периода нет
+        """
+        from .series import price_series
+        series = price_series.get(name)
+        periods = {value: {price_type: series and series.get_min_period(price_type, Decimal(value))
+                           for price_type in price_types}
+                   for value in values}
+
+        found = [period for types in periods.values() for period in types.values() if period]
+        prices = []
+        if found:
+            dates = Q()
+            for start, end in {tuple(period['period']) for period in found}:
+                dates |= Q(date__gte=start, date__lte=end)
+            prices = list(self.filter(dates).select_related('stock').order_by('date'))
+        for period in found:
+            start, end = period['period']
+            period['prices'] = [price for price in prices if start <= price.date <= end]
+        return periods
+
+
+class InsiderQuerySet(BulkUpsertQuerySet):
+    upsert_key = ('slug',)
+
 
+class RelationQuerySet(BulkUpsertQuerySet):
+    upsert_key = ('stock', 'insider', 'position')
 
-class TradeQuerySet(models.QuerySet):
+
+class TradeQuerySet(BulkUpsertQuerySet):
+    upsert_key = ('insider_relation', 'last_date', 'transaction_type', 'owner_type',
+                  'shares_traded', 'shares_held')
+    upsert_fields = ('last_price',)
 
     def default(self):
         return self.select_related('insider_relation__insider', 'insider_relation__stock')
+
+
+class CrawlJobQuerySet(BulkUpsertQuerySet):
+    """QuerySet очереди заданий загрузки, которую несколько процессов на разных машинах
+    разбирают через SELECT ... FOR UPDATE SKIP LOCKED
+
+    Взятое задание арендуется воркером на время lease. Воркер продлевает аренду, пока
+    обрабатывает задание, а задания с истекшей арендой (воркер упал или завис) возвращаются в
+    очередь.
+    """
+    upsert_key = ('url',)
+    # повторная постановка задания в очередь сбрасывает его состояние
+    upsert_fields = ('method', 'stock', 'page', 'status', 'worker', 'lease_expires', 'attempts',
+                     'error')
+
+    def get_upsert_condition(self, table: str) -> str:
+        # задание, которое сейчас обрабатывает воркер, не возвращается в очередь
+        return f'{table}.status <> {self.model.STATUSES.RUNNING:d}'
+
+    def claim(self, worker: str, lease: timedelta, limit: int = 1) -> List:
+        """Метод для взятия заданий из очереди. Задания, заблокированные другими воркерами,
+        пропускаются, поэтому воркеры не ждут друг друга и не получают одно задание дважды
+
+        Args:
+            worker (str): Имя воркера
+            lease (timedelta): Время аренды задания
+            limit (int): Максимальное количество заданий
+
+        Returns:
+            List[CrawlJob]: Взятые задания
+        """
+        model = self.model
+        with transaction.atomic(using=self.db):
+            jobs = list(
+                self.filter(status=model.STATUSES.PENDING).order_by('id')
+                .select_for_update(skip_locked=True)[:limit]
+            )
+            if jobs:
+                self.filter(id__in=[job.id for job in jobs]).update(
+                    status=model.STATUSES.RUNNING, worker=worker,
+                    lease_expires=timezone.now() + lease, attempts=F('attempts') + 1
+                )
+        return jobs
+
+    def heartbeat(self, worker: str, lease: timedelta) -> int:
+        """Метод для продления аренды всех заданий, которые обрабатывает воркер
+
+        Args:
+            worker (str): Имя воркера
+            lease (timedelta): Время аренды задания
+
+        Returns:
+            int: Количество заданий
+        """
+        return self.filter(status=self.model.STATUSES.RUNNING, worker=worker).update(
+            lease_expires=timezone.now() + lease
+        )
+
+    def requeue_expired(self, max_attempts: int) -> int:
+        """Метод для возврата в очередь заданий с истекшей арендой. Задания, у которых
+        исчерпаны попытки, помечаются как неудачные
+
+        Args:
+            max_attempts (int): Максимальное количество попыток
+
+        Returns:
+            int: Количество возвращенных заданий
+        """
+        STATUSES = self.model.STATUSES
+        expired = self.filter(status=STATUSES.RUNNING, lease_expires__lt=timezone.now())
+        expired.filter(attempts__gte=max_attempts).update(
+            status=STATUSES.FAILED, error='Истекла аренда задания'
+        )
+        return expired.update(status=STATUSES.PENDING, worker='', lease_expires=None)
+
+    def complete(self, job_id: int, worker: str) -> int:
+        """Метод для завершения задания. Задание, аренду которого уже забрал другой воркер,
+        не изменяется
+
+        Args:
+            job_id (int): Id задания
+            worker (str): Имя воркера
+
+        Returns:
+            int: 1, если задание завершено, иначе 0
+        """
+        return self.filter(id=job_id, status=self.model.STATUSES.RUNNING, worker=worker).update(
+            status=self.model.STATUSES.DONE, lease_expires=None, error=''
+        )
+
+    def fail(self, job_id: int, worker: str, error: Exception, max_attempts: int) -> int:
+        """Метод для возврата задания с ошибкой в очередь. Если попытки исчерпаны, то задание
+        помечается как неудачное
+
+        Args:
+            job_id (int): Id задания
+            worker (str): Имя воркера
+            error (Exception): Ошибка
+            max_attempts (int): Максимальное количество попыток
+
+        Returns:
+            int: 1, если задание изменено, иначе 0
+        """
+        STATUSES = self.model.STATUSES
+        return self.filter(id=job_id, status=STATUSES.RUNNING, worker=worker).update(
+            status=Case(When(attempts__gte=max_attempts, then=Value(STATUSES.FAILED)),
+                        default=Value(STATUSES.PENDING),
+                        output_field=models.PositiveSmallIntegerField()),
+            worker='', lease_expires=None, error=repr(error)
+        )
+
+    def release(self, job_id: int, worker: str) -> int:
+        """Метод для возврата задания в очередь без учета попытки, например если запросы к
+        хосту приостановлены
+
+        Args:
+            job_id (int): Id задания
+            worker (str): Имя воркера
+
+        Returns:
+            int: 1, если задание возвращено, иначе 0
+        """
+        return self.filter(id=job_id, status=self.model.STATUSES.RUNNING, worker=worker).update(
+            status=self.model.STATUSES.PENDING, worker='', lease_expires=None,
+            attempts=F('attempts') - 1
+        )
+
+    def unfinished(self):
+        return self.filter(status__in=(self.model.STATUSES.PENDING, self.model.STATUSES.RUNNING))
@@ -0,0 +1,252 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_FLOOR
+from typing import Dict, List, Optional
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .models import Stock, Price
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECONDS_PER_DAY = 24 * 60 * 60 * 10 ** 6
+
+
+class PriceSeries:
+    """Цены акции в виде колонок NumPy
+
+    Даты хранятся в микросекундах от начала эпохи, цены в тысячных долях (как в БД), объем
+    без изменений, все колонки в int64, поэтому вычисления точные.
+
+    Attributes:
+        version (int): Версия цен акции, для которой загружены колонки
+        ids (np.ndarray): Id цен
+        dates (np.ndarray): Даты цен
+        columns (Dict[str, np.ndarray]): Колонки цен по типу цены
+        sums (Dict[str, np.ndarray]): Накопленные суммы абсолютных изменений цены по типу цены
+    """
+    # множитель перевода значения колонки в целое число
+    scales = {'open': 3, 'high': 3, 'low': 3, 'close': 3, 'volume': 0}
+
+    def __init__(self, ids: np.ndarray, dates: np.ndarray, columns: Dict[str, np.ndarray],
+                 sums: Dict[str, np.ndarray] = None, version: int = 0):
+        self.ids = ids
+        self.dates = dates
+        self.columns = columns
+        self.sums = sums or {}
+        self.version = version
+
+    @classmethod
+    def load(cls, stock_id: int, version: int = 0) -> 'PriceSeries':
+        """Загружает цены акции и сохраненные накопленные суммы изменений одним запросом.
+        Значения переводятся в целые числа в БД, поэтому объекты Decimal и datetime не создаются
+
+        Args:
+            stock_id (int): Id акции
+            version (int): Версия цен акции
+
+        Returns:
+            PriceSeries
+        """
+        columns = ', '.join(f'({prefix}{price_type} * {10 ** scale})::bigint'
+                            for prefix in ('', 'cum_delta_')
+                            for price_type, scale in cls.scales.items())
+        sql = (f'SELECT id, (EXTRACT(EPOCH FROM date) * 1000000)::bigint, {columns} '
+               f'FROM {Price._meta.db_table} WHERE stock_id = %s ORDER BY date')
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [stock_id])
+            rows = np.array(cursor.fetchall(), dtype=np.int64)
+        # строки матрицы после транспонирования - непрерывные в памяти колонки
+        columns = np.ascontiguousarray(rows.reshape(-1, len(cls.scales) * 2 + 2).T)
+        count = len(cls.scales)
+        return cls(
+            columns[0], columns[1],
+            {price_type: columns[index] for index, price_type in enumerate(cls.scales, 2)},
+            {price_type: columns[index] for index, price_type in enumerate(cls.scales, 2 + count)},
+            version
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_date(self, index: int) -> datetime:
+        return EPOCH + timedelta(microseconds=int(self.dates[index]))
+
+    def get_sums(self, price_type: str) -> np.ndarray:
+        """Возвращает накопленные суммы абсолютных изменений цены. Если они не загружены из БД,
+        то считаются по колонке цены. Первая цена не изменялась
+
+        Args:
+            price_type (str): Тип цены
+
+        Returns:
+            np.ndarray
+        """
+        if price_type not in self.sums:
+            deltas = np.abs(np.diff(self.columns[price_type]))
+            self.sums[price_type] = np.concatenate(([0], np.cumsum(deltas)))
+        return self.sums[price_type]
+
+    def aggregate(self, groups: np.ndarray) -> 'PriceSeries':
+        """Объединяет цены в бары по номерам групп: цена открытия первой цены, максимальная и
+        минимальная цены, цена закрытия последней цены и суммарный объем. Бар получает id и
+        дату первой цены группы
+
+        Args:
+            groups (np.ndarray): Неубывающие номера групп цен
+
+        Returns:
+            PriceSeries
+        """
+        if not len(self):
+            return self
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(groups)) + 1))
+        ends = np.concatenate((starts[1:], [len(self)])) - 1
+        columns = self.columns
+        return PriceSeries(self.ids[starts], self.dates[starts], {
+            'open': columns['open'][starts],
+            'high': np.maximum.reduceat(columns['high'], starts),
+            'low': np.minimum.reduceat(columns['low'], starts),
+            'close': columns['close'][ends],
+            'volume': np.add.reduceat(columns['volume'], starts),
+        }, version=self.version)
+
+    def resample(self, bucket: str, days: int = 1) -> 'PriceSeries':
+        """Объединяет цены в недельные (с понедельника), месячные или N-дневные бары.
+        N-дневные бары отсчитываются от первой цены
+
+        Args:
+            bucket (str): week, month или day
+            days (int): Количество дней в баре для bucket=day
+
+        Returns:
+            PriceSeries
+        """
+        day = self.dates // MICROSECONDS_PER_DAY
+        if bucket == 'week':
+            # 01.01.1970 был четвергом
+            groups = (day + 3) // 7
+        elif bucket == 'month':
+            groups = self.dates.astype('datetime64[us]').astype('datetime64[M]').astype(np.int64)
+        else:
+            groups = (day - day[:1]) // days
+        return self.aggregate(groups)
+
+    def downsample(self, max_points: int) -> 'PriceSeries':
+        """Объединяет соседние цены в бары поровну, чтобы баров было не больше max_points.
+        Максимальные и минимальные цены сохраняются, поэтому график не теряет экстремумы
+
+        Args:
+            max_points (int): Максимальное количество баров
+
+        Returns:
+            PriceSeries
+        """
+        size = -(-len(self) // max_points)
+        if size <= 1:
+            return self
+        return self.aggregate(np.arange(len(self)) // size)
+
+    def get_rows(self) -> List[Dict]:
+        """Возвращает цены в виде словарей
+
+        Returns:
+            List[Dict]
+        """
+        rows = []
+        for index in range(len(self)):
+            row = {'date': self.get_date(index)}
+            for price_type, scale in self.scales.items():
+                value = int(self.columns[price_type][index])
+                row[price_type] = Decimal(value).scaleb(-scale) if scale else value
+            rows.append(row)
+        return rows
+
+    def get_min_period(self, price_type: str, value: Decimal) -> Optional[Dict]:
+        """Находит минимальный период, когда сумма абсолютных изменений цены больше value
+
+        Для всех начал периода сразу первый подходящий конец ищется бинарным поиском по
+        накопленным суммам, а из найденных периодов выбирается самый короткий. Результат
+        совпадает с utils.get_min_period
+
+        Args:
+            price_type (str): Тип цены
+            value (Decimal): Значение, на которое изменилась цена
+
+        Returns:
+            Dict or None: Даты и id начала и конца периода, изменение цены и количество дней
+        """
+        if len(self) < 2:
+            return None
+        scale = self.scales[price_type]
+        sums = self.get_sums(price_type)
+        # суммы целые, поэтому сумма больше value, только если она больше целой части value
+        threshold = int(value.scaleb(scale).to_integral_value(rounding=ROUND_FLOOR))
+        starts = np.arange(len(self) - 1)
+        ends = np.maximum(np.searchsorted(sums, sums[:-1] + threshold, side='right'), starts + 1)
+        found = ends < len(self)
+        if not found.any():
+            return None
+        starts, ends = starts[found], ends[found]
+        days = (self.dates[ends] - self.dates[starts]) // MICROSECONDS_PER_DAY
+        # argmin возвращает первый минимум, то есть более ранний период
+        index = int(np.argmin(days))
+        start, end = int(starts[index]), int(ends[index])
+        return {'period': [self.get_date(start), self.get_date(end)],
+                'ids': [int(self.ids[start]), int(self.ids[end])],
+                'absolute_delta': Decimal(int(sums[end] - sums[start])).scaleb(-scale),
+                'delta_days': int(days[index])}
+
+
+class PriceSeriesCache:
+    """LRU кэш колонок цен акций в памяти процесса
+
+    Колонки загружаются при первом обращении. Парсер увеличивает версию цен акции при записи
+    новых цен, поэтому при следующем обращении колонки загружаются заново, в том числе в
+    других процессах.
+
+    Attributes:
+        max_size (int): Максимальное количество акций в кэше
+    """
+
+    def __init__(self, max_size: int = 128):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, name: str) -> Optional[PriceSeries]:
+        """Возвращает колонки цен акции
+
+        Args:
+            name (str): Название акции
+
+        Returns:
+            PriceSeries or None: Колонки или None, если акции нет
+        """
+        stock = Stock.objects.filter(name=name).values_list('id', 'prices_version').first()
+        if stock is None:
+            return None
+        stock_id, version = stock
+        with self.lock:
+            series = self.entries.get(stock_id)
+            if series is not None and series.version == version:
+                self.entries.move_to_end(stock_id)
+                return series
+
+        series = PriceSeries.load(stock_id, version)
+        with self.lock:
+            self.entries[stock_id] = series
+            self.entries.move_to_end(stock_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return series
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+price_series = PriceSeriesCache(getattr(settings, 'PRICE_SERIES_CACHE_SIZE', 128))
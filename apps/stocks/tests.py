@@ -1,3 +1,991 @@
-from django.test import TestCase
+import io
+import json
+import multiprocessing
+import pstats
+import random
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from typing import Dict, List
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection, connections
+from django.db.models import F
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLResolver, reverse
+from django.utils import timezone
+
+from . import metrics
+from .cache import result_cache
+from .export import Exporter
+from .loader import HistoryLoader
+from .profiling import profiler
+from .partitioning import add_year_partitions, get_partitions, rebuild_price_table
+from .models import Stock, Price, Insider, Relation, Trade, CrawlJob
+from .parser import NasdaqParser
+from .parser.async_engine import AsyncEngine
+from .parser.cache import PageCache
+from .parser.crawl_queue import CrawlQueue
+from .parser.pipeline import Pipeline
+from .parser.extractors import LxmlExtractor, SoupExtractor
+from .parser.throttling import CircuitBreaker, FailedJournal, FetchError, HostPaused, Throttle
+from . import urls as stocks_urls
+from .series import EPOCH, PriceSeries, PriceSeriesCache, price_series
+from .utils import get_min_period
+
+PRICES_PAGE = '''
+<html><body>
+<h1>Chevron Corporation Common Stock Historical Stock Prices</h1>
+<div class="genTable"><div><table>
+<thead><tr><th>Date</th><th>Open</th><th>High</th><th>Low</th><th>Close</th><th>Volume</th></tr></thead>
+<tbody>
+<tr><td></td><td></td><td></td><td></td><td></td><td></td></tr>
+<tr><td> 04/17/2018 </td><td> 118.48 </td><td> 119.81 </td><td> 117.93 </td><td> 119.3 </td><td> 5,844,123 </td></tr>
+<tr><td> 04/16/2018 </td><td> 117.2 </td><td> 118.56 </td><td> 116.85 </td><td> 118.25 </td><td> 6,102,337 </td></tr>
+<tr><td> 04/13/2018 </td><td> 1,116.79 </td><td> 1,117.49 </td><td> 1,115.18 </td><td> 1,116.66 </td><td> 5,004,981 </td></tr>
+</tbody>
+</table></div></div>
+</body></html>
+'''
+
+TRADES_PAGE = '''
+<html><body>
+<div class="genTable"><table>
+<tr><td>WIRTH MICHAEL K</td><td>Officer</td><td>03/28/2018</td><td>Sell</td><td>direct</td><td>12,500</td><td>113.35</td><td>171,020</td></tr>
+<tr><td>JOHNSON JAMES W</td><td>Director</td><td>03/02/2018</td><td>Automatic Sell</td><td>indirect</td><td>1,000</td><td></td><td>22,345</td></tr>
+</table></div>
+</body></html>
+'''
+
+
+TEST_DATA_DIR = Path(__file__).resolve().parent.joinpath('testdata')
+
+
+def get_test_page(name: str) -> bytes:
+    """Возвращает сохраненную страницу Nasdaq.com из testdata"""
+    return TEST_DATA_DIR.joinpath(name).read_bytes()
+
+
+class RecordedPagesHandler(BaseHTTPRequestHandler):
+    """Отдает записанные страницы вместо Nasdaq.com"""
+    paths = []
+    # статусы ошибок, которые отдаются перед страницами
+    errors = []
+
+    def do_GET(self):
+        self.paths.append(self.path)
+        if self.errors:
+            self.send_response(self.errors.pop(0))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        page = TRADES_PAGE if 'insider-trades' in self.path else PRICES_PAGE
+        body = page.encode()
+        etag = '"{}"'.format(len(body))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RecordedPagesTestMixin:
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = HTTPServer(('127.0.0.1', 0), RecordedPagesHandler)
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def get_parser(self, stocks):
+        parser = NasdaqParser(stocks)
+        host = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        parser.stocks_prices_url = host + '/symbol/{stock}/historical'
+        parser.insider_trades_url = host + '/symbol/{stock}/insider-trades?page={n}'
+        return parser
+
+
+class AsyncEngineTestCase(RecordedPagesTestMixin, TransactionTestCase):
+
+    def test_run(self):
+        parser = self.get_parser(['CVX', 'AAPL'])
+        AsyncEngine(parser, concurrency=4, limit_per_host=2, threads=4).run()
+
+        self.assertEqual(Stock.objects.count(), 2)
+        cvx = Stock.objects.get(name='cvx')
+        self.assertEqual(cvx.company_name, 'Chevron Corporation')
+        self.assertEqual(cvx.prices.count(), 3)
+        self.assertEqual(str(cvx.prices.order_by('date').first().open), '1116.790')
+        self.assertEqual(Trade.objects.filter(insider_relation__stock=cvx).count(), 2)
+        self.assertEqual(Price.objects.count(), 6)
+
+
+class PipelineTestCase(RecordedPagesTestMixin, TransactionTestCase):
+
+    def test_run(self):
+        parser = self.get_parser(['CVX', 'AAPL'])
+        Pipeline(parser, fetchers=4, parsers=2, writers=2, queue_size=4).run()
+
+        self.assertEqual(Stock.objects.get(name='aapl').company_name, 'Chevron Corporation')
+        self.assertEqual(Price.objects.count(), 6)
+        self.assertEqual(Trade.objects.count(), 4)
+
+    def test_incremental(self):
+        parser = self.get_parser(['CVX'])
+        parser.save_insider_trades('cvx', TRADES_PAGE.encode())
+        parser.load_high_water_marks()
+        parser.incremental = True
+
+        RecordedPagesHandler.paths.clear()
+        Pipeline(parser, fetchers=2, parsers=1, writers=1).run()
+        self.assertEqual(sorted(RecordedPagesHandler.paths),
+                         ['/symbol/cvx/historical', '/symbol/cvx/insider-trades?page=1'])
+
+
+class IncrementalTestCase(RecordedPagesTestMixin, TransactionTestCase):
+
+    def test_stops_at_known_trades(self):
+        parser = self.get_parser(['CVX'])
+        parser.save_insider_trades('cvx', TRADES_PAGE.encode())
+        parser.load_high_water_marks()
+        parser.incremental = True
+
+        RecordedPagesHandler.paths.clear()
+        parser.get_stock_insider_trades('CVX')
+        self.assertEqual(RecordedPagesHandler.paths, ['/symbol/cvx/insider-trades?page=1'])
+        self.assertEqual(Trade.objects.count(), 2)
+
+    def test_stored_deltas(self):
+        parser = self.get_parser(['CVX'])
+        company_name, rows = parser.extract('prices', PRICES_PAGE.encode())
+        parser.write_stock_prices('cvx', company_name, rows[1:])
+        parser.load_high_water_marks()
+        parser.write_stock_prices('cvx', company_name, rows[:2])
+
+        fields = [f'{prefix}delta_{price_type}' for prefix in ('bar_', '')
+                  for price_type in ('open', 'high', 'low', 'close', 'volume')]
+        stored = list(Price.objects.with_delta().order_by('date').values_list(*fields))
+        self.assertEqual([row[:5] for row in stored], [row[5:] for row in stored])
+        self.assertEqual(list(Price.objects.order_by('date').values_list('cum_delta_open',
+                                                                         flat=True)),
+                         [0, Decimal('999.59'), Decimal('1000.87')])
+
+    def test_writes_only_newer_prices(self):
+        parser = self.get_parser(['CVX'])
+        company_name, rows = parser.extract('prices', PRICES_PAGE.encode())
+        parser.write_stock_prices('cvx', company_name, rows[1:])
+        Price.objects.update(volume=0)
+        parser.load_high_water_marks()
+
+        parser.write_stock_prices('cvx', company_name, rows)
+        self.assertEqual(list(Price.objects.order_by('date').values_list('volume', flat=True)),
+                         [0, 6102337, 5844123])
+
+
+class InsiderTradesTestCase(TestCase):
+
+    def test_save_insider_trades(self):
+        Stock.objects.create(name='cvx')
+        parser = NasdaqParser(['CVX'])
+        content = TRADES_PAGE.encode()
+        # акция, владельцы (вставка и выборка), связи (вставка и выборка), сделки и время
+        # изменения акции
+        with self.assertNumQueries(7):
+            parser.save_insider_trades('cvx', content)
+        # повторная страница использует карту id и записывает сделки одним запросом
+        with self.assertNumQueries(1):
+            parser.save_insider_trades('cvx', content)
+
+        self.assertEqual(Insider.objects.count(), 2)
+        self.assertEqual(Relation.objects.count(), 2)
+        self.assertEqual(Trade.objects.count(), 2)
+        trade = Trade.objects.get(insider_relation__insider__slug='johnson-james-w')
+        self.assertEqual(trade.insider_relation.position, Relation.POSITIONS.DIRECTOR)
+        self.assertEqual(trade.owner_type, Trade.OWNER_TYPES.INDIRECT)
+        self.assertIsNone(trade.last_price)
+
+
+class ExtractorsTestCase(TestCase):
+
+    def test_parity(self):
+        lxml_extractor, soup_extractor = LxmlExtractor(), SoupExtractor()
+        self.assertEqual(lxml_extractor.prices(PRICES_PAGE.encode()),
+                         soup_extractor.prices(PRICES_PAGE.encode()))
+        self.assertEqual(lxml_extractor.trades(TRADES_PAGE.encode()),
+                         soup_extractor.trades(TRADES_PAGE.encode()))
+
+    def test_recorded_pages_parity(self):
+        lxml_extractor, soup_extractor = LxmlExtractor(), SoupExtractor()
+        html = get_test_page('cvx_historical.html')
+        company_name, rows = lxml_extractor.prices(html)
+        self.assertEqual((company_name, len(rows)), ('Chevron Corporation', 64))
+        self.assertEqual((company_name, rows), soup_extractor.prices(html))
+
+        html = get_test_page('cvx_insider_trades.html')
+        rows = lxml_extractor.trades(html)
+        self.assertEqual(len(rows), 15)
+        self.assertTrue(any(row.last_price is None for row in rows))
+        self.assertEqual(rows, soup_extractor.trades(html))
+
+    def test_prices(self):
+        company_name, rows = LxmlExtractor().prices(PRICES_PAGE.encode())
+        self.assertEqual(company_name, 'Chevron Corporation')
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[-1].open, Decimal('1116.79'))
+        self.assertEqual(rows[-1].volume, 5004981)
+
+    def test_fallback(self):
+        parser = NasdaqParser([])
+        self.assertEqual(parser.extract('trades', b''), [])
+
+
+class PageCacheTestCase(RecordedPagesTestMixin, SimpleTestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+
+    def test_conditional_request(self):
+        parser = self.get_parser(['CVX'])
+        parser.cache = PageCache(self.cache_dir.name)
+        _, url = next(parser.get_prices_urls())
+        self.assertEqual(parser.get_html(url), PRICES_PAGE.encode())
+        self.assertIsNone(parser.get_html(url))
+
+        parser.replay = True
+        RecordedPagesHandler.paths.clear()
+        self.assertEqual(parser.get_html(url), PRICES_PAGE.encode())
+        self.assertEqual(RecordedPagesHandler.paths, [])
+
+    def test_same_content_is_skipped(self):
+        cache = PageCache(self.cache_dir.name)
+        self.assertEqual(cache.update('http://a', 200, b'page', {}), b'page')
+        self.assertIsNone(cache.update('http://a', 200, b'page', {}))
+        self.assertEqual(cache.update('http://a', 200, b'changed', {}), b'changed')
+
+    def test_error_is_not_cached(self):
+        cache = PageCache(self.cache_dir.name)
+        cache.update('http://a', 200, b'page', {'ETag': '"1"'})
+        self.assertEqual(cache.update('http://a', 500, b'error', {'ETag': '"2"'}), b'error')
+        self.assertEqual(cache.read('http://a'), b'page')
+        self.assertEqual(cache.get_conditional_headers('http://a'), {'If-None-Match': '"1"'})
+
+    def test_eviction(self):
+        cache = PageCache(self.cache_dir.name, max_size=500)
+        for n in range(20):
+            cache.update(f'http://a/{n}', 200, b'page %d' % n, {})
+        self.assertLessEqual(cache.size, 500)
+        self.assertIsNone(cache.read('http://a/0'))
+        self.assertEqual(cache.read('http://a/19'), b'page 19')
+
+    def test_concurrent_size(self):
+        cache = PageCache(self.cache_dir.name, max_size=2000)
+
+        def update(n):
+            for m in range(50):
+                cache.update(f'http://a/{m % 10}', 200, b'page %d %d' % (n, m), {})
+                if m % 7 == 0:
+                    cache.discard(f'http://a/{(m + n) % 10}')
+
+        threads = [threading.Thread(target=update, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.size, PageCache(self.cache_dir.name).size)
+
+
+class ThrottleTestCase(RecordedPagesTestMixin, SimpleTestCase):
+
+    def setUp(self):
+        RecordedPagesHandler.paths.clear()
+        self.addCleanup(RecordedPagesHandler.errors.clear)
+
+    def test_retry(self):
+        parser = self.get_parser(['CVX'])
+        parser.throttle = Throttle(retries=1, backoff=0.01)
+        _, url = next(parser.get_prices_urls())
+        RecordedPagesHandler.errors[:] = [503]
+        self.assertEqual(parser.get_html(url), PRICES_PAGE.encode())
+        self.assertEqual(len(RecordedPagesHandler.paths), 2)
+
+    def test_client_error(self):
+        journal_file = tempfile.NamedTemporaryFile()
+        self.addCleanup(journal_file.close)
+        parser = self.get_parser(['CVX'])
+        parser.throttle = Throttle(retries=3, backoff=0.01)
+        parser.journal = FailedJournal(journal_file.name)
+        stock_and_url = next(parser.get_prices_urls())
+        RecordedPagesHandler.errors[:] = [404]
+        parser.get_stock_prices(stock_and_url)
+
+        # страница с ошибкой не повторяется и не разбирается как пустая
+        self.assertEqual(len(RecordedPagesHandler.paths), 1)
+        with open(journal_file.name) as file:
+            entry = json.loads(file.read())
+        self.assertEqual((entry['url'], entry['error']),
+                         (stock_and_url[1], repr(FetchError(f'{stock_and_url[1]}: 404'))))
+
+    def test_paused_host(self):
+        journal_file = tempfile.NamedTemporaryFile()
+        self.addCleanup(journal_file.close)
+        parser = self.get_parser(['CVX', 'AAPL'])
+        parser.throttle = Throttle(breaker=CircuitBreaker(threshold=1, pause=60), retries=0)
+        parser.journal = FailedJournal(journal_file.name)
+        urls = list(parser.get_prices_urls())
+        RecordedPagesHandler.errors[:] = [503]
+        for stock_and_url in urls:
+            parser.get_stock_prices(stock_and_url)
+
+        # страница приостановленного хоста сразу записывается в журнал без запроса
+        self.assertEqual(len(RecordedPagesHandler.paths), 1)
+        self.assertEqual(parser.journal.read(), [('prices',) + url for url in urls])
+        with self.assertRaises(HostPaused):
+            parser.get_html(urls[0][1])
+
+    def test_journal(self):
+        journal_file = tempfile.NamedTemporaryFile()
+        self.addCleanup(journal_file.close)
+        parser = self.get_parser(['CVX'])
+        parser.throttle = Throttle(retries=1, backoff=0.01)
+        parser.journal = FailedJournal(journal_file.name)
+        stock_and_url = next(parser.get_prices_urls())
+        RecordedPagesHandler.errors[:] = [503, 503]
+        parser.get_stock_prices(stock_and_url)
+
+        entries = parser.journal.read()
+        self.assertEqual(entries, [('prices',) + stock_and_url])
+        parser.resume = entries
+        self.assertEqual(list(parser.get_prices_urls()), [stock_and_url])
+        self.assertEqual(list(parser.get_trades_urls()), [])
+
+        # прерванный повторный запуск не очищает журнал
+        with self.assertRaises(KeyboardInterrupt), parser.journal.replacing():
+            raise KeyboardInterrupt
+        self.assertEqual(parser.journal.read(), entries)
+        with parser.journal.replacing():
+            self.assertEqual(parser.journal.read(), entries)
+        self.assertEqual(parser.journal.read(), [])
+
+
+def run_queue_worker(parser, worker):
+    CrawlQueue(parser, worker=worker, threads=2, batch_size=2, poll_interval=0.1).run()
+
+
+class CrawlQueueTestCase(RecordedPagesTestMixin, TransactionTestCase):
+
+    def test_workers(self):
+        parser = self.get_parser(['CVX', 'AAPL'])
+        self.assertEqual(CrawlQueue(parser).enqueue(), 22)
+        # дочерние процессы открывают свои соединения с БД
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=run_queue_worker, args=(parser, f'worker-{n}'))
+                     for n in range(3)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        self.assertEqual([process.exitcode for process in processes], [0, 0, 0])
+        self.assertEqual(set(CrawlJob.objects.values_list('status', 'attempts')),
+                         {(CrawlJob.STATUSES.DONE, 1)})
+        self.assertEqual(Price.objects.count(), 6)
+        self.assertEqual(Trade.objects.count(), 4)
+
+    def test_expired_lease(self):
+        job = CrawlJob.objects.create(method='prices', stock='cvx', url='http://a')
+        self.assertEqual(CrawlJob.objects.claim('a', timedelta(seconds=-1)), [job])
+        self.assertEqual(CrawlJob.objects.claim('b', timedelta(seconds=60)), [])
+
+        self.assertEqual(CrawlJob.objects.requeue_expired(max_attempts=3), 1)
+        self.assertEqual(CrawlJob.objects.claim('b', timedelta(seconds=60)), [job])
+        # задание уже забрал другой воркер
+        self.assertEqual(CrawlJob.objects.complete(job.id, 'a'), 0)
+        self.assertEqual(CrawlJob.objects.complete(job.id, 'b'), 1)
+        self.assertFalse(CrawlJob.objects.unfinished().exists())
+
+    def test_release(self):
+        job = CrawlJob.objects.create(method='prices', stock='cvx', url='http://a')
+        self.assertEqual(CrawlJob.objects.claim('a', timedelta(seconds=60)), [job])
+        self.assertEqual(CrawlJob.objects.release(job.id, 'a'), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker, job.attempts),
+                         (CrawlJob.STATUSES.PENDING, '', 0))
+
+    def test_enqueue_keeps_running_jobs(self):
+        parser = self.get_parser(['CVX'])
+        count = CrawlQueue(parser).enqueue()
+        job, = CrawlJob.objects.claim('a', timedelta(seconds=60))
+        CrawlJob.objects.exclude(id=job.id).update(status=CrawlJob.STATUSES.DONE)
+
+        self.assertEqual(CrawlQueue(parser).enqueue(), count - 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker), (CrawlJob.STATUSES.RUNNING, 'a'))
+        self.assertEqual(CrawlJob.objects.filter(status=CrawlJob.STATUSES.PENDING).count(),
+                         count - 1)
+        self.assertEqual(CrawlJob.objects.complete(job.id, 'a'), 1)
+
+
+def get_min_period_quadratic(rows, value):
+    """Прежний перебор всех периодов, с которым сравнивается линейный поиск"""
+    sums = []
+    sum_delta = Decimal('0')
+    for _, _, delta in rows:
+        sum_delta += abs(delta)
+        sums.append(sum_delta)
+    result_list = []
+    for j in range(len(rows) - 1):
+        for k in range(j + 1, len(rows)):
+            result_list.append(
+                {'period': [rows[j][1], rows[k][1]],
+                 'ids': [rows[j][0], rows[k][0]],
+                 'absolute_delta': sums[k] - sums[j],
+                 'delta_days': abs(rows[j][1] - rows[k][1]).days}
+            )
+    periods = sorted([x for x in result_list if x['absolute_delta'] > value],
+                     key=lambda x: x['delta_days'])
+    return periods[0] if periods else None
+
+
+class MinPeriodTestCase(TestCase):
+
+    def test_equivalence(self):
+        rng = random.Random(0)
+        for _ in range(300):
+            date = datetime(2018, 1, 1, tzinfo=timezone.utc)
+            rows, prices, dates = [], [], []
+            for n in range(rng.randint(0, 30)):
+                date += timedelta(hours=rng.choice([6, 24, 24, 48, 72]))
+                delta = rng.randint(-300, 300) * 10 if n else 0
+                prices.append((prices[-1] if n else 100000) + delta)
+                dates.append(int((date - EPOCH).total_seconds()) * 10 ** 6)
+                rows.append((n, date, Decimal(delta).scaleb(-3)))
+            series = PriceSeries(np.arange(len(rows)), np.array(dates, dtype=np.int64),
+                                 {'open': np.array(prices, dtype=np.int64)})
+            value = Decimal(rng.randint(-1000, 20000)).scaleb(-4)
+            expected = get_min_period_quadratic(rows, value)
+            self.assertEqual(get_min_period(rows, value), expected)
+            self.assertEqual(series.get_min_period('open', value), expected)
+
+    def test_series_cache(self):
+        parser = NasdaqParser(['CVX'])
+        company_name, rows = parser.extract('prices', PRICES_PAGE.encode())
+        parser.write_stock_prices('cvx', company_name, rows[1:])
+        cache = PriceSeriesCache(max_size=1)
+        series = cache.get('cvx')
+        self.assertEqual(len(series), 2)
+        self.assertTrue(all(column.flags.c_contiguous for column in
+                            [series.ids, series.dates, *series.columns.values(),
+                             *series.sums.values()]))
+        self.assertIsNone(series.get_min_period('open', Decimal('1000')))
+        with self.assertNumQueries(1):
+            self.assertIs(cache.get('cvx'), series)
+
+        # запись новых цен увеличивает версию и колонки загружаются заново
+        parser.write_stock_prices('cvx', company_name, rows)
+        series = cache.get('cvx')
+        self.assertEqual(len(series), 3)
+        data = series.get_min_period('open', Decimal('1'))
+        self.assertEqual(data['absolute_delta'], Decimal('1.28'))
+        self.assertEqual(data['delta_days'], 1)
+        self.assertEqual(data['ids'], list(Price.objects.order_by('date').values_list(
+            'id', flat=True))[1:])
+        self.assertIsNone(cache.get('aapl'))
+
+
+class DeltaAPITestCase(TestCase):
+
+    def test_multiple_values_and_types(self):
+        parser = NasdaqParser(['CVX'])
+        parser.save_stock_prices('cvx', PRICES_PAGE.encode())
+        # версия данных для ETag, версия цен акции для кэша результатов и кэша колонок, колонки
+        # цен и цены найденных периодов
+        with self.assertNumQueries(5):
+            response = self.client.get('/api/cvx/delta/?value=1,1000&type=open,close')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(list(data), ['1', '1000'])
+        self.assertEqual(data['1']['open']['absolute_delta'], '1.280')
+        self.assertEqual(data['1']['close']['absolute_delta'], '1.050')
+        self.assertEqual(len(data['1']['close']['prices']), 2)
+        self.assertEqual(data['1000']['open']['delta_days'], 4)
+        self.assertEqual(len(data['1000']['open']['prices']), 3)
+        self.assertIsNone(data['1000']['close'])
+
+    def test_single_value(self):
+        parser = NasdaqParser(['CVX'])
+        parser.save_stock_prices('cvx', PRICES_PAGE.encode())
+        response = self.client.get('/api/cvx/delta/?value=1&type=open')
+        self.assertEqual([price['absolute_delta'] for price in response.json()], [1.28, 1.28])
+        self.assertEqual(self.client.get('/api/cvx/delta/?value=1&type=id').status_code, 404)
+
+    def test_invalid_params(self):
+        parser = NasdaqParser(['CVX'])
+        parser.save_stock_prices('cvx', PRICES_PAGE.encode())
+        self.assertEqual(self.client.get('/cvx/delta/?value=1&type=open').status_code, 200)
+        for params in ('value=abc&type=open', 'value=1&type=foo', 'value=inf&type=open',
+                       'value=1,2&type=open'):
+            self.assertEqual(self.client.get(f'/cvx/delta/?{params}').status_code, 404, params)
+        self.assertEqual(self.client.get('/api/cvx/delta/?value=abc&type=open').status_code,
+                         404)
+
+
+class KeysetPaginationTestCase(TestCase):
+
+    def setUp(self):
+        parser = NasdaqParser(['CVX'])
+        parser.save_stock_prices('cvx', PRICES_PAGE.encode())
+        parser.save_insider_trades('cvx', TRADES_PAGE.encode())
+
+    def test_prices(self):
+        data = self.client.get('/api/cvx/?page_size=2').json()
+        self.assertEqual([price['date'][:10] for price in data['results']],
+                         ['2018-04-13', '2018-04-16'])
+        data = self.client.get(data['next']).json()
+        self.assertEqual([price['date'][:10] for price in data['results']], ['2018-04-17'])
+        self.assertIsNone(data['next'])
+        self.assertEqual(self.client.get('/api/cvx/?cursor=abc').status_code, 404)
+
+    def test_trades(self):
+        data = self.client.get('/api/cvx/insider/?page_size=1').json()
+        self.assertEqual([trade['last_date'] for trade in data['results']], ['2018-03-28'])
+        data = self.client.get(data['next']).json()
+        self.assertEqual([trade['last_date'] for trade in data['results']], ['2018-03-02'])
+        self.assertIsNone(data['next'])
+
+
+class ExportTestCase(TestCase):
+
+    def setUp(self):
+        parser = NasdaqParser(['CVX'])
+        parser.save_stock_prices('cvx', PRICES_PAGE.encode())
+        parser.save_insider_trades('cvx', TRADES_PAGE.encode())
+
+    def test_formats(self):
+        response = self.client.get('/api/export/prices/?stocks=CVX')
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'stock,date,open,high,low,close,volume')
+        self.assertEqual(lines[1], 'cvx,2018-04-13 00:00:00+00:00,1116.790,1117.490,1115.180,'
+                                   '1116.660,5004981')
+        self.assertEqual(len(lines), 4)
+
+        response = self.client.get('/api/export/trades/?format=ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([row['last_date'] for row in rows], ['2018-03-02', '2018-03-28'])
+        self.assertIsNone(rows[0]['last_price'])
+
+        self.assertEqual(self.client.get('/api/export/prices/?format=xml').status_code, 404)
+        self.assertEqual(self.client.get('/api/export/stocks/').status_code, 404)
+
+    def test_columns(self):
+        # пачки по две строки
+        parts = list(Exporter('prices', ['cvx'], chunk_size=2).stream('columns'))
+        self.assertEqual(len(parts), 2)
+        self.assertEqual(json.loads(parts[1])['close'], ['119.300'])
+        output = io.StringIO()
+        call_command('export_history', 'prices', 'aapl', stdout=output)
+        self.assertEqual(output.getvalue(), 'stock,date,open,high,low,close,volume\r\n')
+
+
+def create_dataset(size: int):
+    """Добавляет акции cvx size цен по дням и size сделок одного владельца"""
+    stock, _ = Stock.objects.get_or_create(name='cvx', defaults={'company_name': 'Chevron'})
+    insider, _ = Insider.objects.get_or_create(full_name='Wirth Michael K')
+    relation, _ = Relation.objects.get_or_create(stock=stock, insider=insider)
+    offset = Price.objects.filter(stock=stock).count()
+    start = datetime(2018, 1, 1, tzinfo=timezone.utc)
+    Price.objects.bulk_create(
+        Price(stock=stock, date=start + timedelta(days=offset + n), open=100 + n % 7,
+              high=110 + n % 5, low=90 + n % 3, close=100 + n % 11, volume=1000 + n)
+        for n in range(size)
+    )
+    Price.objects.update_deltas(stock.id)
+    Stock.objects.filter(id=stock.id).update(prices_version=F('prices_version') + 1)
+    Trade.objects.bulk_create(
+        Trade(insider_relation=relation, last_date=start.date() + timedelta(days=offset + n),
+              transaction_type='Sell', shares_traded=n + 1, shares_held=n)
+        for n in range(size)
+    )
+
+
+# url, GET параметры и допустимое количество запросов для каждого url приложения
+QUERY_BUDGETS = {
+    'list': ({}, {}, 2),
+    'api_list': ({}, {}, 2),
+    'api_cache_stats': ({}, {}, 0),
+    'api_analytics': ({}, {'stocks': 'cvx,aapl', 'date_from': '2018-01-02',
+                           'date_to': '2018-01-05'}, 2),
+    'api_export': ({'kind': 'prices'}, {'stocks': 'cvx'}, 2),
+    'prices': ({'name': 'cvx'}, {}, 4),
+    'prices_analytics': ({'name': 'cvx'}, {'date_from': '2018-01-02',
+                                           'date_to': '2018-01-05'}, 5),
+    'prices_delta': ({'name': 'cvx'}, {'value': '5', 'type': 'open'}, 7),
+    'insiders_list': ({'name': 'cvx'}, {}, 3),
+    'insider_trades': ({'name': 'cvx', 'slug': 'wirth-michael-k'}, {}, 3),
+    'api_prices': ({'name': 'cvx'}, {}, 2),
+    'api_prices_analytics': ({'name': 'cvx'}, {'date_from': '2018-01-02',
+                                               'date_to': '2018-01-05'}, 3),
+    'api_prices_delta': ({'name': 'cvx'}, {'value': '5', 'type': 'open,close'}, 5),
+    'api_prices_resample': ({'name': 'cvx'}, {'bucket': 'week'}, 4),
+    'api_insiders_list': ({'name': 'cvx'}, {}, 2),
+    'api_insider_trades': ({'name': 'cvx', 'slug': 'wirth-michael-k'}, {}, 2),
+}
+
+
+def get_url_names(patterns, namespace: str = 'stocks') -> List[str]:
+    names = []
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            names += get_url_names(pattern.url_patterns, namespace)
+        else:
+            names.append(f'{namespace}:{pattern.name}')
+    return names
+
+
+class ConditionalResponseTestCase(TestCase):
+
+    def test_not_modified(self):
+        parser = NasdaqParser(['CVX'])
+        company_name, rows = parser.extract('prices', PRICES_PAGE.encode())
+        parser.write_stock_prices('cvx', company_name, rows[1:])
+        response = self.client.get('/api/cvx/')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=0')
+        # ответ 304 отдается после запроса версии данных, без выполнения представления
+        with self.assertNumQueries(1):
+            cached = self.client.get('/api/cvx/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached['ETag'], response['ETag'])
+        self.assertIn('Accept', cached['Vary'])
+        self.assertIn('Accept', response['Vary'])
+        cached = self.client.get('/cvx/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(cached.status_code, 304)
+
+        parser.write_stock_prices('cvx', company_name, rows)
+        response = self.client.get('/api/cvx/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 3)
+        self.assertEqual(self.client.get('/api/aapl/').status_code, 200)
+
+    def test_company_name_change(self):
+        parser = NasdaqParser(['CVX'])
+        parser.save_stock_prices('cvx', PRICES_PAGE.encode())
+        response = self.client.get('/api/')
+        parser.get_or_create_stock('cvx', 'Chevron Corporation')
+        self.assertEqual(self.client.get('/api/', HTTP_IF_NONE_MATCH=response['ETag']).status_code,
+                         304)
+        parser.get_or_create_stock('cvx', 'Chevron Corp')
+        response = self.client.get('/api/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]['company_name'], 'Chevron Corp')
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        metrics.registry.clear()
+
+    def test_metrics(self):
+        parser = NasdaqParser(['CVX'])
+        company_name, rows = parser.extract('prices', PRICES_PAGE.encode())
+        parser.write_stock_prices('cvx', company_name, rows)
+        self.assertEqual(metrics.rows_written.get(stage='prices'), 3)
+        self.assertGreater(metrics.ingest_queries.get(stage='prices'), 0)
+        self.client.get('/api/cvx/')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertIn('nasdaq_rows_written_total{stage="prices"} 3', content)
+        self.assertIn('stocks_view_seconds_count{view="stocks:api_prices"} 1', content)
+        self.assertIn('stocks_view_queries_bucket{view="stocks:api_prices",le="+Inf"} 1', content)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = f'{directory}/nasdaq.prom'
+            with metrics.TextfileWriter(path, interval=60):
+                pass
+            with open(path) as file:
+                self.assertIn('nasdaq_rows_written_total{stage="prices"} 3', file.read())
+
+    def test_access(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 403)
+        with self.settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 200)
+
+
+class ProfilingTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = vars(profiler).copy()
+        profiler.directory = self.directory.name
+        profiler.token = 'secret'
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def tearDown(self):
+        vars(profiler).update(self.settings)
+        self.directory.cleanup()
+
+    def test_profiles(self):
+        parser = NasdaqParser(['CVX'])
+        company_name, rows = parser.extract('prices', PRICES_PAGE.encode())
+        parser.write_stock_prices('cvx', company_name, rows)
+        self.client.get('/api/cvx/delta/?value=1&type=open')
+        self.assertEqual(profiler.get_profiles(), [])
+
+        self.client.get('/api/cvx/delta/?value=1&type=open', HTTP_X_PROFILE='secret')
+        profiler.ingest_rate = 1
+        parser.write_stock_prices('cvx', company_name, rows)
+        profiles = profiler.get_profiles()
+        self.assertEqual([profile['name'] for profile in profiles],
+                         ['ingest prices', '/api/cvx/delta/'])
+        self.assertEqual(profiles[1]['view'], 'stocks:api_prices_delta')
+        self.assertGreater(profiles[1]['query_count'], 0)
+
+        self.assertEqual(self.client.get('/profiles/').status_code, 302)
+        self.client.login(username='admin', password='password')
+        self.assertContains(self.client.get('/profiles/'), '/api/cvx/delta/')
+        response = self.client.get(f'/profiles/{profiles[1]["id"]}/')
+        self.assertContains(response, 'stocks_stock')
+        response = self.client.get(f'/profiles/{profiles[1]["id"]}/prof/')
+        self.assertEqual(response.status_code, 200)
+        pstats.Stats(self.write_file(b''.join(response.streaming_content)))
+        self.assertEqual(self.client.get(f'/profiles/{profiles[1]["id"]}/txt/').status_code, 404)
+
+        # старые профили удаляются, когда директория больше max_size
+        profiler.max_size = 1
+        profiler.prune()
+        self.assertEqual(profiler.get_profiles(), [])
+
+    def write_file(self, content: bytes) -> str:
+        path = f'{self.directory.name}/downloaded.prof'
+        with open(path, 'wb') as file:
+            file.write(content)
+        return path
+
+
+class QueryBudgetTestCase(TestCase):
+    """Количество запросов каждого url не должно превышать бюджет и расти с количеством строк.
+    Новый url приложения должен получить бюджет в QUERY_BUDGETS
+    """
+
+    def get_query_counts(self) -> Dict[str, int]:
+        counts = {}
+        for name, (kwargs, params, _) in QUERY_BUDGETS.items():
+            # каждый url считается без кэшей результатов и колонок цен
+            result_cache.clear()
+            caches['default'].clear()
+            price_series.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse(f'stocks:{name}', kwargs=kwargs), params)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+            self.assertEqual(response.status_code, 200, name)
+            counts[name] = len(queries)
+        return counts
+
+    def test_budgets(self):
+        self.assertEqual(sorted(get_url_names(stocks_urls.urlpatterns)),
+                         sorted(f'stocks:{name}' for name in QUERY_BUDGETS))
+        create_dataset(10)
+        counts = self.get_query_counts()
+        for name, (_, _, budget) in QUERY_BUDGETS.items():
+            self.assertLessEqual(counts[name], budget, name)
+        create_dataset(50)
+        self.assertEqual(self.get_query_counts(), counts)
+
+
+class LoadHistoryTestCase(TestCase):
+
+    def test_round_trip(self):
+        parser = NasdaqParser(['CVX'])
+        parser.save_stock_prices('cvx', PRICES_PAGE.encode())
+        parser.save_insider_trades('cvx', TRADES_PAGE.encode())
+        prices = list(Price.objects.order_by('date').values_list(
+            'date', 'close', 'bar_delta_open', 'cum_delta_close'))
+        trades = list(Trade.objects.order_by('last_date').values_list(
+            'insider_relation__insider__slug', 'insider_relation__position', 'last_date',
+            'last_price'))
+        dumps = {(kind, export_format): ''.join(Exporter(kind).stream(export_format))
+                 for kind in ('prices', 'trades') for export_format in ('csv', 'ndjson')}
+        Stock.objects.all().delete()
+        Insider.objects.all().delete()
+
+        stats = HistoryLoader('prices').load([io.StringIO(dumps['prices', 'csv'])], 'csv')
+        self.assertEqual((stats['staged'], stats['merged']), (3, 3))
+        output = io.StringIO()
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson') as file:
+            file.write(dumps['trades', 'ndjson'])
+            file.flush()
+            call_command('load_history', 'trades', file.name, format='ndjson',
+                         defer_indexes=True, stdout=output)
+        self.assertIn('Merged rows: 2', output.getvalue())
+        self.assertEqual(list(Price.objects.order_by('date').values_list(
+            'date', 'close', 'bar_delta_open', 'cum_delta_close')), prices)
+        self.assertEqual(list(Trade.objects.order_by('last_date').values_list(
+            'insider_relation__insider__slug', 'insider_relation__position', 'last_date',
+            'last_price')), trades)
+
+        # повторная загрузка ничего не изменяет
+        stats = HistoryLoader('prices').load([io.StringIO(dumps['prices', 'ndjson'])], 'ndjson')
+        self.assertEqual(stats['merged'], 0)
+        columns = ''.join(Exporter('trades').stream('columns'))
+        stats = HistoryLoader('trades').load([io.StringIO(columns)], 'columns')
+        self.assertEqual((stats['staged'], stats['merged']), (2, 0))
+        with self.assertRaises(ValueError):
+            HistoryLoader('trades').load([io.StringIO(dumps['prices', 'csv'])], 'csv')
+
+
+class PartitioningTestCase(TestCase):
+
+    def setUp(self):
+        self.parser = NasdaqParser(['CVX'])
+        self.company_name, self.rows = self.parser.extract('prices', PRICES_PAGE.encode())
+        self.parser.write_stock_prices('cvx', self.company_name, self.rows[1:])
+        self.prices = list(Price.objects.order_by('date').values_list())
+
+    def test_year(self):
+        rebuild_price_table('year')
+        partitions = get_partitions()
+        self.assertIn('stocks_price_y2018', partitions)
+        self.assertIn('stocks_price_default', partitions)
+        self.assertEqual(list(Price.objects.order_by('date').values_list()), self.prices)
+
+        # диапазоны дат отсекают секции других лет
+        request = RequestFactory().get('/', {'date_from': '2018-04-13', 'date_to': '2018-04-16'})
+        qs = Price.objects.filter(stock__name='cvx').get_delta_between_dates(request)
+        sql, params = qs.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN {sql}', params)
+            plan = '\n'.join(row for row, in cursor.fetchall())
+        self.assertIn('stocks_price_y2018', plan)
+        self.assertNotIn('stocks_price_y2019', plan)
+        self.assertEqual([price.delta_open for price in qs], [0, Decimal('-999.590')])
+
+        # цены пишутся в секции через ON CONFLICT
+        self.parser.write_stock_prices('cvx', self.company_name, self.rows)
+        self.assertEqual(Price.objects.count(), 3)
+        last_year = max(int(name[len('stocks_price_y'):]) for name in partitions
+                        if name.startswith('stocks_price_y'))
+        Price.objects.create(stock=Stock.objects.get(), date=datetime(
+            last_year + 2, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(add_year_partitions(last_year + 2), [last_year + 1, last_year + 2])
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM stocks_price_y{last_year + 2}')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_stock(self):
+        rebuild_price_table('stock', partitions=4)
+        self.assertEqual(len(get_partitions()), 4)
+        self.parser.write_stock_prices('cvx', self.company_name, self.rows)
+        self.assertEqual(Price.objects.count(), 3)
+        rebuild_price_table(None)
+        self.assertEqual(get_partitions(), [])
+        self.assertEqual(list(Price.objects.order_by('date').values_list())[:2], self.prices)
+
+
+class ResultCacheTestCase(TestCase):
+
+    def setUp(self):
+        result_cache.clear()
+        self.parser = NasdaqParser(['CVX'])
+        self.company_name, self.rows = self.parser.extract('prices', PRICES_PAGE.encode())
+        self.parser.write_stock_prices('cvx', self.company_name, self.rows[1:])
+
+    def test_api(self):
+        url = '/api/cvx/analytics/?date_to=2018-04-16&date_from=2018-04-13'
+        response = self.client.get(url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        # порядок параметров не влияет на ключ, остаются только запросы версий данных для ETag
+        # и цен акции
+        with self.assertNumQueries(2):
+            cached = self.client.get('/api/cvx/analytics/?date_from=2018-04-13&date_to=2018-04-16')
+        self.assertEqual(cached['X-Cache'], 'HIT')
+        self.assertEqual(cached.json(), response.json())
+
+        self.parser.write_stock_prices('cvx', self.company_name, self.rows)
+        self.assertEqual(self.client.get(url)['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get('/api/cache-stats/').json(),
+                         {'local_hits': 1, 'shared_hits': 0, 'misses': 2, 'size': 2})
+        response = self.client.get('/api/cache-stats/', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
+
+    def test_html(self):
+        response = self.client.get('/cvx/delta/?value=1&type=open')
+        cached = self.client.get('/cvx/delta/?value=1&type=open')
+        self.assertEqual(cached['X-Cache'], 'HIT')
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(self.client.get('/cvx/delta/').status_code, 404)
+
+
+class StocksAnalyticsAPITestCase(TestCase):
+
+    def test_stocks(self):
+        parser = NasdaqParser(['CVX', 'AAPL'])
+        company_name, rows = parser.extract('prices', PRICES_PAGE.encode())
+        parser.write_stock_prices('cvx', company_name, rows)
+        parser.write_stock_prices('aapl', company_name,
+                                  [row._replace(open=row.open * 2) for row in rows])
+
+        # версия данных акций для ETag и цены
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/analytics/?stocks=CVX,aapl,goog'
+                                       '&date_from=2018-04-16&date_to=2018-04-17')
+        data = response.json()
+        self.assertEqual(list(data), ['aapl', 'cvx'])
+        # изменения считаются внутри каждой акции
+        self.assertEqual([price['delta_open'] for price in data['cvx']], [0, 1.28])
+        self.assertEqual([price['delta_open'] for price in data['aapl']], [0, 2.56])
+        self.assertEqual(self.client.get('/api/analytics/?stocks=cvx').status_code, 404)
+
+
+class ResampleTestCase(TestCase):
+
+    def setUp(self):
+        parser = NasdaqParser(['CVX'])
+        company_name, rows = parser.extract('prices', PRICES_PAGE.encode())
+        parser.write_stock_prices('cvx', company_name, rows)
+
+    def test_week(self):
+        data = self.client.get('/api/cvx/resample/?bucket=week').json()
+        self.assertEqual([price['date'][:10] for price in data], ['2018-04-13', '2018-04-16'])
+        self.assertEqual(data[1], {'date': '2018-04-16T00:00:00Z', 'open': '117.200',
+                                   'high': '119.810', 'low': '116.850', 'close': '119.300',
+                                   'volume': 11946460})
+
+    def test_buckets(self):
+        self.assertEqual(len(self.client.get('/api/cvx/resample/?bucket=month').json()), 1)
+        self.assertEqual(len(self.client.get('/api/cvx/resample/?bucket=4d').json()), 2)
+        data = self.client.get('/api/cvx/resample/?max_points=2').json()
+        self.assertEqual([(price['open'], price['close']) for price in data],
+                         [('1116.790', '118.250'), ('118.480', '119.300')])
+        self.assertEqual(len(self.client.get('/api/cvx/resample/?max_points=5').json()), 3)
+        self.assertEqual(self.client.get('/api/cvx/resample/?bucket=0d').status_code, 404)
+        self.assertEqual(self.client.get('/api/aapl/resample/?bucket=week').status_code, 404)
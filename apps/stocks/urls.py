@@ -9,6 +9,12 @@ urlpatterns = [
     path('', stocks_list_view, name='list'),
     # {% url('stocks:api_list') %}
     path('api/', stocks_list_api_view, name='api_list'),
+    # {% url('stocks:api_cache_stats') %}
+    path('api/cache-stats/', result_cache_stats_api_view, name='api_cache_stats'),
+    # {% url('stocks:api_analytics') %}
+    path('api/analytics/', stocks_analytics_api_view, name='api_analytics'),
+    # {% url('stocks:api_export') 'prices' %}
+    path('api/export/<slug:kind>/', export_api_view, name='api_export'),
     path('<slug:name>/', include([
         # {% url('stocks:prices') stock.name %}
         path('', stock_prices_list_view, name='prices'),
@@ -30,6 +36,8 @@ urlpatterns = [
         path('analytics/', stock_prices_analytics_api_view, name='api_prices_analytics'),
         # {% url('stocks:api_prices_delta') stock.name %}
         path('delta/', stock_prices_delta_api_view, name='api_prices_delta'),
+        # {% url('stocks:api_prices_resample') stock.name %}
+        path('resample/', stock_prices_resample_api_view, name='api_prices_resample'),
         path('insider/', include([
             # {% url('stocks:api_insiders_list') stock.name %}
             path('', stock_insiders_list_api_view, name='api_insiders_list'),
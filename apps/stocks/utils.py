@@ -1,44 +1,54 @@
 from decimal import Decimal
-from typing import Dict
+from itertools import accumulate
+from typing import Dict, List, Optional, Sequence, Tuple
 
-from django.db.models import QuerySet
+def get_delta_sums(rows: Sequence[Tuple]) -> List[Decimal]:
+    """Функция, которая возвращает накопленные суммы абсолютных изменений цены
 
+    Args:
+        rows (Sequence[Tuple]): Id, дата и изменение цены, отсортированные по дате
+
+    Returns:
+        List[Decimal]
+    """
+    return list(accumulate(abs(delta) for _, _, delta in rows))
 
-def get_min_period_with_delta_price(prices: QuerySet, value: str, price_type: str) -> Dict or None:
-    """Функция, которая возвращает минимальный период, когда указанная цена изменилась более чем
-    на указанное число
+
+def get_min_period(rows: Sequence[Tuple], value: Decimal,
+                   sums: List[Decimal] = None) -> Optional[Dict]:
+    """Функция, которая находит минимальный период, когда сумма абсолютных изменений цены
+    больше value
+
+    Сумма изменений за период равна разнице накопленных сумм на его концах. Накопленная сумма
+    не убывает, поэтому для каждого начала периода достаточно найти первый подходящий конец, а
+    при сдвиге начала вправо этот конец тоже сдвигается только вправо. Поэтому оба указателя
+    проходят строки один раз, и поиск выполняется за линейное время.
 
     Args:
-        prices (PriceQuerySet): список цен
-        value (str): Значение, на которое изменилась цена
-        price_type (str): Тип цены
+        rows (Sequence[Tuple]): Id, дата и изменение цены, отсортированные по дате
+        value (Decimal): Значение, на которое изменилась цена
+        sums (List[Decimal]): Накопленные суммы изменений, если они уже посчитаны или
+            сохранены в БД. Тогда изменения цены в rows не используются
 
     Returns:
-        BeautifulSoup
+        Dict or None: Даты и id начала и конца периода, изменение цены и количество дней
     """
-
-    prices_values = prices.values('id', 'date', f'delta_{price_type}')
-    sum_delta = Decimal('0')
-    # складываем последовательно значения дельта
-    for price in prices_values:
-        sum_delta += abs(price[f'delta_{price_type}'])
-        price['sum_delta'] = sum_delta
-
-    result_list = []
-    # определяем абсолютное значение дельта для каждого возможного периода
-    for j in range(len(prices_values) - 1):
-        start_period = prices_values[j]
-        for end_period in prices_values[j + 1:]:
-            result_list.append(
-                {'period': [start_period['date'], end_period['date']],
-                 'ids': [start_period['id'], end_period['id']],
-                 'absolute_delta': end_period['sum_delta'] - start_period['sum_delta'],
-                 'delta_days': abs(start_period['date'] - end_period['date']).days}
-            )
-    # определяем периоды подходящие под условие и сортируем по величине периода (т.е. разнице в
-    # днях между начальной и конечной датами)
-    periods = sorted([x for x in result_list if x['absolute_delta'] > Decimal(value)],
-                     key=lambda x: x['delta_days'])
-    if periods:
-        return periods[0]
-    return None
+    if sums is None:
+        sums = get_delta_sums(rows)
+    result = None
+    end = 0
+    for start in range(len(rows) - 1):
+        end = max(end, start + 1)
+        while end < len(rows) and sums[end] - sums[start] <= value:
+            end += 1
+        if end == len(rows):
+            # для следующих начал периода сумма изменений будет еще меньше
+            break
+        delta_days = abs(rows[start][1] - rows[end][1]).days
+        # при равной длине остается более ранний период
+        if result is None or delta_days < result['delta_days']:
+            result = {'period': [rows[start][1], rows[end][1]],
+                      'ids': [rows[start][0], rows[end][0]],
+                      'absolute_delta': sums[end] - sums[start],
+                      'delta_days': delta_days}
+    return result
@@ -1,8 +1,13 @@
+from decimal import Decimal, InvalidOperation
+from typing import List, Tuple
+
 from django.http import Http404
 from django.views.generic import ListView
 from django.views.generic.detail import SingleObjectMixin
 
+from .cache import CachedResponseMixin, ConditionalResponseMixin
 from .models import Stock, Trade, Insider
+from .querysets import PriceQuerySet
 
 __all__ = (
     'stocks_list_view', 'stock_prices_list_view', 'stock_insiders_list_view',
@@ -10,7 +15,35 @@ __all__ = (
 )
 
 
-class StocksListView(ListView):
+def get_delta_params(request) -> Tuple[List[str], List[str]]:
+    """Функция, которая проверяет параметры value и type страниц с минимальными периодами.
+    Несколько значений и типов цены указываются через запятую
+
+    Args:
+        request: Запрос
+
+    Returns:
+        Tuple[List[str], List[str]]: Значения и типы цены
+
+    Raises:
+        Http404: Если параметры не указаны, значение не является числом или тип цены неизвестен
+    """
+    if 'value' not in request.GET or 'type' not in request.GET:
+        raise Http404('Value and type aren\'t specified')
+    values = request.GET['value'].split(',')
+    price_types = request.GET['type'].split(',')
+    if any(price_type not in PriceQuerySet.price_types for price_type in price_types):
+        raise Http404('Unknown price type')
+    try:
+        numbers = [Decimal(value) for value in values]
+    except InvalidOperation:
+        raise Http404('Value isn\'t a number')
+    if not all(number.is_finite() for number in numbers):
+        raise Http404('Value isn\'t a number')
+    return values, price_types
+
+
+class StocksListView(ConditionalResponseMixin, ListView):
     model = Stock
     context_object_name = 'stocks'
     template_name = 'stocks/stocks_list.html'
@@ -18,7 +51,7 @@ class StocksListView(ListView):
 stocks_list_view = StocksListView.as_view()
 
 
-class StockPricesListView(SingleObjectMixin, ListView):
+class StockPricesListView(ConditionalResponseMixin, SingleObjectMixin, ListView):
     template_name = 'stocks/stock_prices.html'
     queryset = Stock.objects.all()
     slug_field = 'name'
@@ -34,7 +67,7 @@ class StockPricesListView(SingleObjectMixin, ListView):
 stock_prices_list_view = StockPricesListView.as_view()
 
 
-class StockInsidersListView(SingleObjectMixin, ListView):
+class StockInsidersListView(ConditionalResponseMixin, SingleObjectMixin, ListView):
     template_name = 'stocks/stock_insiders.html'
     queryset = Stock.objects.all()
     slug_field = 'name'
@@ -50,10 +83,13 @@ class StockInsidersListView(SingleObjectMixin, ListView):
 stock_insiders_list_view = StockInsidersListView.as_view()
 
 
-class InsiderTradesListView(SingleObjectMixin, ListView):
+class InsiderTradesListView(ConditionalResponseMixin, SingleObjectMixin, ListView):
     template_name = 'stocks/insider_trades.html'
     queryset = Insider.objects.all()
 
+    def get_stocks(self):
+        return Stock.objects.filter(relations__insider__slug=self.kwargs['slug'])
+
     def get(self, request, *args, **kwargs):
         self.object = self.get_object(queryset=self.queryset)
         return super().get(request, *args, **kwargs)
@@ -64,7 +100,7 @@ class InsiderTradesListView(SingleObjectMixin, ListView):
 insider_trades_list_view = InsiderTradesListView.as_view()
 
 
-class StockPricesAnalyticsView(StockPricesListView):
+class StockPricesAnalyticsView(CachedResponseMixin, StockPricesListView):
     template_name = 'stocks/stock_prices_analytics.html'
 
     def get_object(self, queryset=None):
@@ -79,16 +115,18 @@ class StockPricesAnalyticsView(StockPricesListView):
 stock_prices_analytics_view = StockPricesAnalyticsView.as_view()
 
 
-class StockPricesDeltaView(StockPricesListView):
+class StockPricesDeltaView(CachedResponseMixin, StockPricesListView):
     template_name = 'stocks/stock_prices_delta.html'
 
     def get_object(self, queryset=None):
-        if 'value' not in self.request.GET or 'type' not in self.request.GET:
-            raise Http404('Value and type aren\'t specified')
+        values, price_types = get_delta_params(self.request)
+        if len(values) > 1 or len(price_types) > 1:
+            raise Http404('Only one value and type are supported')
         return super().get_object(queryset)
 
     def get_queryset(self):
         qs = super().get_queryset().reverse()
-        return qs.get_prices_for_delta(self.request)
+        return qs.get_prices_for_delta(self.request.GET['value'], self.request.GET['type'],
+                                       self.object.name)
 
 stock_prices_delta_view = StockPricesDeltaView.as_view()
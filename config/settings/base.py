@@ -46,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'apps.stocks.metrics.MetricsMiddleware',
+    'apps.stocks.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -112,3 +114,34 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/2.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
+# Количество акций, колонки цен которых хранятся в памяти процесса (apps.stocks.series)
+PRICE_SERIES_CACHE_SIZE = 128
+
+# Кэш результатов аналитики (apps.stocks.cache): кэш Django, время хранения в секундах и
+# количество записей в памяти процесса
+RESULT_CACHE_ALIAS = 'default'
+RESULT_CACHE_TIMEOUT = 24 * 60 * 60
+RESULT_CACHE_SIZE = 256
+
+# Cache-Control: max-age в секундах для ответов с ETag и Last-Modified (apps.stocks.cache).
+# При 0 клиенты и прокси проверяют ответ условным запросом при каждом обращении
+HTTP_CACHE_MAX_AGE = 0
+
+# Сбор метрик парсера и представлений (apps.stocks.metrics), которые отдаются по /metrics
+# персоналу и запросам с адресов METRICS_ALLOWED_IPS, а если задан METRICS_TOKEN, то только с
+# заголовком Authorization: Bearer METRICS_TOKEN
+METRICS_ENABLED = True
+METRICS_ALLOWED_IPS = ['127.0.0.1']
+METRICS_TOKEN = None
+
+# Профилирование по выборке (apps.stocks.profiling): профили запросов и записей парсера в БД
+# сохраняются в PROFILING_DIR (None - выключено) размером не больше PROFILING_MAX_SIZE МБ.
+# PROFILING_RATE и PROFILING_INGEST_RATE - доли профилируемых запросов и записей, запрос с
+# заголовком X-Profile, равным PROFILING_TOKEN, профилируется всегда. Профили доступны
+# персоналу по /profiles/
+PROFILING_DIR = None
+PROFILING_MAX_SIZE = 100
+PROFILING_RATE = 0
+PROFILING_INGEST_RATE = 0
+PROFILING_TOKEN = None
@@ -18,8 +18,16 @@ from django.conf.urls import url
 from django.contrib import admin
 from django.urls import path, include
 
+from apps.stocks.metrics import metrics_view
+from apps.stocks.profiling import profile_file_view, profile_view, profiles_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
+    path('profiles/', profiles_view, name='profiles'),
+    path('profiles/<slug:profile_id>/', profile_view, name='profile'),
+    path('profiles/<slug:profile_id>/<slug:profile_format>/', profile_file_view,
+         name='profile_file'),
     path('', include('apps.stocks.urls', namespace='stocks'))
 ]
 